@@ -18,6 +18,11 @@ export PYTHONPATH=$(pwd):$PYTHONPATH
 #     --start_year 2022 \
 #     --end_year 2023
 
+echo "Precomputing calendar features..."
+python src/data/calendar_features.py \
+    --start_year 2022 \
+    --end_year 2023
+
 echo "Processing training data..."
 python src/data/data_processing.py \
     --process_raw_data \
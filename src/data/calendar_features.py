@@ -0,0 +1,248 @@
+"""
+Script to precompute the calendar features of every region.
+
+Demand follows local time, so the features are computed on the local (DST-aware) time of each
+region rather than on the UTC timestamps. They are stored in a table indexed by
+(region, hour ordinal), where the hour ordinal is the number of hours since the start of the
+table. Joining them into a panel is then a single integer gather instead of per-row datetime work.
+"""
+# General imports
+import argparse
+import os
+
+# Data related imports
+import numpy as np
+import pandas as pd
+
+# Local imports
+from src.definitions import (
+    EXTERNAL_DATA_DIR,
+    REGIONS,
+    REGION_MAPPING,
+    REGION_TIMEZONE,
+)
+from src.config import setup_logger
+
+# Setup logger
+logger = setup_logger()
+
+CALENDAR_FEATURES = [
+    'local_hour',
+    'local_dayofweek',
+    'local_month',
+    'is_dst',
+    'is_weekend',
+    'is_holiday',
+    'is_pre_holiday',
+    'is_post_holiday',
+]
+
+CALENDAR_PATH = os.path.join(EXTERNAL_DATA_DIR, 'calendar.npz')
+
+### GENERAL FUNCTIONS ###
+
+def get_holidays_path(region):
+    return os.path.join(EXTERNAL_DATA_DIR, f'{REGION_MAPPING[region]}_holidays.csv')
+
+def get_holiday_sources(regions):
+    """
+    Get the modification time of the holiday file of every region, 0 for a missing file. A table
+    built from other files than the current ones is stale.
+    """
+    return np.array([
+        os.path.getmtime(get_holidays_path(region)) if os.path.exists(get_holidays_path(region)) else 0.0
+        for region in regions
+    ])
+
+def load_holidays(region):
+    """
+    Load the holiday dates of a region fetched by holiday_ingestion.py.
+
+    :param region: Region code.
+    :return: Array of datetime64[D] holiday dates, empty if the file is not available.
+    """
+    path = get_holidays_path(region)
+    if not os.path.exists(path):
+        logger.warning(f"No holidays for {region} at {path}, its holiday features are all 0 (run src/data/holiday_ingestion.py)")
+        return np.array([], dtype='datetime64[D]')
+    holidays = pd.read_csv(path, parse_dates=['Date'])
+    return holidays['Date'].to_numpy(dtype='datetime64[D]')
+
+def compute_calendar(hours, timezone, holidays):
+    """
+    Compute the calendar features of a region.
+
+    :param hours: UTC DatetimeIndex with hourly frequency.
+    :param timezone: Timezone of the region.
+    :param holidays: Array of datetime64[D] holiday dates of the region.
+    :return: Array of shape (hours x calendar features).
+    """
+    local = hours.tz_convert(timezone)
+    dates = local.tz_localize(None).to_numpy(dtype='datetime64[D]')
+
+    # DST is on when the UTC offset is larger than the standard (winter) one
+    offsets = local.tz_localize(None) - hours.tz_localize(None)
+    standard = pd.Timestamp('2000-01-01', tz=timezone).utcoffset()
+
+    one_day = np.timedelta64(1, 'D')
+    features = np.column_stack([
+        local.hour,
+        local.dayofweek,
+        local.month,
+        offsets > standard,
+        local.dayofweek >= 5,
+        np.isin(dates, holidays),
+        np.isin(dates + one_day, holidays),
+        np.isin(dates - one_day, holidays),
+    ])
+    return features.astype(np.int16)
+
+### CALENDAR TABLE ###
+
+class CalendarTable:
+    """
+    Table of calendar features indexed by (region, hour ordinal).
+
+    :param values: Array of shape (regions x hours x features).
+    :param start: UTC timestamp of hour ordinal 0.
+    :param regions: Region codes of the first axis.
+    :param features: Feature names of the last axis.
+    :param holiday_sources: Modification time of the holiday file of every region (see
+        get_holiday_sources), None if unknown.
+    """
+    def __init__(self, values, start, regions=REGIONS, features=CALENDAR_FEATURES, holiday_sources=None):
+        self.values = values
+        self.start = pd.Timestamp(start)
+        self.regions = list(regions)
+        self.features = list(features)
+        self.holiday_sources = holiday_sources
+
+    @classmethod
+    def build(cls, start, end, regions=REGIONS):
+        """
+        Compute the table for every hour between two dates.
+
+        :param start: First date (inclusive).
+        :param end: Last date (exclusive).
+        :param regions: Region codes of the table.
+        """
+        hours = pd.date_range(pd.Timestamp(start, tz='UTC'), pd.Timestamp(end, tz='UTC'), freq='h', inclusive='left')
+        holiday_sources = get_holiday_sources(regions)
+        values = np.stack([
+            compute_calendar(hours, REGION_TIMEZONE[region], load_holidays(region)) for region in regions
+        ])
+        return cls(values, hours[0], regions, holiday_sources=holiday_sources)
+
+    @property
+    def end(self):
+        return self.start + pd.Timedelta(hours=self.values.shape[1])
+
+    def covers(self, timestamps):
+        return len(timestamps) == 0 or (timestamps.min() >= self.start and timestamps.max() < self.end)
+
+    def ordinals(self, timestamps):
+        """
+        Get the hour ordinal of every timestamp.
+
+        :param timestamps: UTC DatetimeIndex.
+        """
+        timestamps = pd.DatetimeIndex(timestamps)
+        if timestamps.tz is None:
+            timestamps = timestamps.tz_localize('UTC')
+        if not self.covers(timestamps):
+            raise ValueError(f"Calendar covers [{self.start}, {self.end}), timestamps are outside of it")
+        return ((timestamps - self.start) // pd.Timedelta(hours=1)).to_numpy(dtype=np.int64)
+
+    def gather(self, region_codes, ordinals):
+        """
+        Get the calendar features of (region, hour ordinal) pairs.
+
+        :param region_codes: Array of region indexes.
+        :param ordinals: Array of hour ordinals, broadcastable with region_codes.
+        :return: Array of shape (pairs x features).
+        """
+        return self.values[region_codes, ordinals]
+
+    def fill_panel(self, panel):
+        """
+        Fill in place the calendar features allocated in a panel.
+
+        :param panel: Panel whose regions are in the table.
+        :return: Panel with the calendar features filled.
+        """
+        ordinals = self.ordinals(panel.timestamps)
+        region_codes = np.array([self.regions.index(region) for region in panel.regions])
+        gathered = self.gather(region_codes[None, :], ordinals[:, None])  # (timestamp x region x features)
+
+        for j, feature in enumerate(self.features):
+            if feature in panel.features:
+                panel[feature] = gathered[:, :, j]
+        return panel
+
+    ### SERIALIZATION ###
+
+    def save(self, path=CALENDAR_PATH):
+        np.savez_compressed(
+            path,
+            values=self.values,
+            start=np.array(self.start.value),
+            regions=np.array(self.regions),
+            features=np.array(self.features),
+            holiday_sources=np.asarray(self.holiday_sources, dtype=np.float64),
+        )
+
+    @classmethod
+    def load(cls, path=CALENDAR_PATH):
+        with np.load(path) as data:
+            return cls(
+                data['values'],
+                pd.Timestamp(int(data['start']), tz='UTC'),
+                data['regions'].tolist(),
+                data['features'].tolist(),
+                data['holiday_sources'] if 'holiday_sources' in data else None,
+            )
+
+def get_calendar(timestamps, regions=REGIONS, path=CALENDAR_PATH):
+    """
+    Get a calendar table covering the timestamps, from the precomputed file if it covers them and
+    was built from the current holiday files. Otherwise the table is computed for the whole years
+    spanned by the timestamps.
+
+    :param timestamps: UTC DatetimeIndex to cover.
+    :param regions: Region codes needed.
+    :param path: Path to the precomputed table.
+    """
+    timestamps = pd.DatetimeIndex(timestamps)
+    if timestamps.tz is None:
+        timestamps = timestamps.tz_localize('UTC')
+
+    if os.path.exists(path):
+        table = CalendarTable.load(path)
+        if table.covers(timestamps) and set(regions) <= set(table.regions) \
+                and table.features == CALENDAR_FEATURES \
+                and table.holiday_sources is not None \
+                and np.array_equal(table.holiday_sources, get_holiday_sources(table.regions)):
+            missing = [region for region, source in zip(table.regions, table.holiday_sources) if region in regions and source == 0]
+            if missing:
+                logger.warning(f"No holidays for {', '.join(missing)}, their holiday features are all 0 (run src/data/holiday_ingestion.py)")
+            return table
+
+    return CalendarTable.build(f'{timestamps.min().year}-01-01', f'{timestamps.max().year + 1}-01-01', regions)
+
+### MAIN ###
+
+def add_parser_args(parser):
+    parser.add_argument('--start_year', type=int, default=2022, help='First year of the calendar')
+    parser.add_argument('--end_year', type=int, default=2023, help='Last year of the calendar')
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute the calendar features of each region')
+    add_parser_args(parser)
+    args = parser.parse_args()
+
+    table = CalendarTable.build(f'{args.start_year}-01-01', f'{args.end_year + 1}-01-01')
+    table.save()
+    print(f'Calendar of {len(table.regions)} regions and {table.values.shape[1]} hours saved in {CALENDAR_PATH}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""
+Script containing the panel container shared by every model.
+
+A panel stores the prepared data as one contiguous (timestamp x region x feature) array:
+
+    values[t, r, f] -> value of feature f for region r at timestamp t
+
+The long format (one row per timestamp and region, as the boosting models expect) and the wide
+format (one row per timestamp, as the classifier expects) are reshapes of that same memory, so
+moving between them never melts, pivots or copies the data.
+"""
+# Data related imports
+import numpy as np
+import pandas as pd
+
+# Local imports
+from src.definitions import REGIONS
+
+### PANEL ###
+
+class Panel:
+    """
+    Container of a (timestamp x region x feature) array with its indexes.
+
+    :param values: Array of shape (n_timestamps, n_regions, n_features).
+    :param timestamps: Timestamps of the first axis.
+    :param regions: Region codes of the second axis.
+    :param features: Feature names of the third axis.
+    """
+    def __init__(self, values, timestamps, regions=REGIONS, features=('surplus',)):
+        self.values = np.ascontiguousarray(values)
+        self.timestamps = pd.DatetimeIndex(timestamps)
+        self.regions = list(regions)
+        self.features = list(features)
+
+        expected = (len(self.timestamps), len(self.regions), len(self.features))
+        if self.values.shape != expected:
+            raise ValueError(f"Panel values have shape {self.values.shape}, expected {expected}")
+
+    @classmethod
+    def from_wide(cls, df, features=('surplus',), regions=REGIONS, dtype=np.float32):
+        """
+        Build a panel from a wide DataFrame (one row per timestamp).
+
+        A feature is filled from the '{region}_{feature}' columns if they exist, or broadcast to every
+        region from a column named as the feature (e.g., is_weekend). Any other feature is allocated
+        as NaN so it can be filled in place afterwards, avoiding reallocations of the array.
+
+        :param df: Wide DataFrame with a 'timestamp' column.
+        :param features: Names of the features of the panel.
+        :param regions: Region codes of the panel.
+        :param dtype: Data type of the values.
+        """
+        if not df['timestamp'].is_monotonic_increasing:
+            df = df.sort_values('timestamp')
+
+        values = np.full((len(df), len(regions), len(features)), np.nan, dtype=dtype)
+        for j, feature in enumerate(features):
+            columns = [f'{region}_{feature}' for region in regions]
+            if all(column in df.columns for column in columns):
+                values[:, :, j] = df[columns].to_numpy(dtype=dtype)
+            elif feature in df.columns:
+                values[:, :, j] = df[feature].to_numpy(dtype=dtype)[:, None]
+        return cls(values, df['timestamp'], regions, features)
+
+    ### INDEXING ###
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def feature_index(self, feature):
+        return self.features.index(feature)
+
+    def __getitem__(self, feature):
+        """
+        Get a (timestamp x region) view of a feature.
+        """
+        return self.values[:, :, self.feature_index(feature)]
+
+    def __setitem__(self, feature, value):
+        """
+        Fill a feature in place. The value is broadcast to (timestamp x region).
+        """
+        self.values[:, :, self.feature_index(feature)] = value
+
+    def valid_mask(self, features=('surplus',)):
+        """
+        Get a (timestamp x region) mask of the observations usable by the models, i.e., those
+        where none of the given features is missing or zero.
+
+        :param features: Features that must be available.
+        """
+        mask = np.ones(self.shape[:2], dtype=bool)
+        for feature in features:
+            values = self[feature]
+            mask &= ~np.isnan(values) & (values != 0)
+        return mask
+
+    ### VIEWS ###
+
+    def long(self):
+        """
+        Get a (timestamp * region x feature) view. Row t * n_regions + r holds region r at timestamp t.
+        """
+        return self.values.reshape(-1, self.shape[2])
+
+    def wide(self):
+        """
+        Get a (timestamp x region * feature) view. Column r * n_features + f holds feature f of region r.
+        """
+        return self.values.reshape(self.shape[0], -1)
+
+    @property
+    def wide_columns(self):
+        return [f'{region}_{feature}' for region in self.regions for feature in self.features]
+
+    def series_codes(self):
+        """
+        Get the region code of every row of the long view.
+        """
+        return np.tile(np.arange(len(self.regions)), len(self.timestamps))
+
+    def to_long_frame(self, series_id=True, timestamp=False):
+        """
+        Get the long view as a DataFrame backed by the panel memory.
+
+        :param series_id: Whether to add the region of every row as a categorical 'series_id' column.
+        :param timestamp: Whether to add the timestamp of every row.
+        """
+        df = pd.DataFrame(self.long(), columns=self.features, copy=False)
+        if series_id:
+            df['series_id'] = pd.Categorical.from_codes(self.series_codes(), categories=self.regions)
+        if timestamp:
+            df.insert(0, 'timestamp', np.repeat(self.timestamps, len(self.regions)))
+        return df
+
+    def to_wide_frame(self, timestamp=True):
+        """
+        Get the wide view as a DataFrame backed by the panel memory.
+
+        :param timestamp: Whether to add the 'timestamp' column.
+        """
+        df = pd.DataFrame(self.wide(), columns=self.wide_columns, copy=False)
+        if timestamp:
+            df.insert(0, 'timestamp', self.timestamps)
+        return df
+
+    def unstack(self, values):
+        """
+        Reshape an array aligned with the long view back to (timestamp x region, ...).
+        """
+        values = np.asarray(values)
+        return values.reshape(self.shape[0], self.shape[1], *values.shape[1:])
+
+    ### DECODING ###
+
+    def max_region(self, forecasts):
+        """
+        Get the region with the maximum forecast at every timestamp.
+
+        :param forecasts: Array of shape (timestamp x region). NaNs are ignored.
+        :return: Array with the region code of each timestamp, None where no forecast is available.
+        """
+        return max_region(forecasts, self.regions)
+
+    def to_predictions_frame(self, forecasts):
+        """
+        Build the predictions output (timestamp | target) from the (timestamp x region) forecasts.
+        """
+        return pd.DataFrame({'timestamp': self.timestamps, 'target': self.max_region(forecasts)})
+
+    def to_horizon_predictions_frame(self, forecasts, horizons):
+        """
+        Build the multi-horizon predictions output (timestamp | horizon | target) where target is the
+        region with the maximum forecast horizon hours after the timestamp.
+
+        :param forecasts: Array of shape (timestamp x region x horizon).
+        :param horizons: Horizon of every forecast of the last axis.
+        """
+        frames = [
+            pd.DataFrame({
+                'timestamp': self.timestamps,
+                'horizon': horizon,
+                'target': self.max_region(forecasts[:, :, k]),
+            })
+            for k, horizon in enumerate(horizons)
+        ]
+        return pd.concat(frames, ignore_index=True)
+
+### GENERAL FUNCTIONS ###
+
+def max_region(forecasts, regions=REGIONS):
+    """
+    Get the region with the maximum value at every row of a (row x region) matrix.
+
+    :param forecasts: Array of shape (row x region). NaNs are ignored.
+    :param regions: Region code of every column.
+    :return: Array with the region code of each row, None where all values are missing.
+    """
+    forecasts = np.asarray(forecasts, dtype=np.float64)
+    missing = np.isnan(forecasts)
+    codes = np.argmax(np.where(missing, -np.inf, forecasts), axis=1)
+    return np.where(missing.all(axis=1), None, np.asarray(regions, dtype=object)[codes])
@@ -4,12 +4,13 @@ Script to prepare data for modelling either for forecasting or classification.
 For classification, the label of the next hour maximum surplus region is added.
 The idea is then to predict that label based on the previous hour only.
 
-For forecasting, the data is converted to a time series format with the following features:
-- series_id
-- timestamp
+For forecasting, the data is converted to a (timestamp x region x feature) panel (see src/data/panel.py) with:
 - surplus*
+- Lags of the surplus
 - Additional metadata (e.g., is_weekend)
 
+Its long view (one row per timestamp and region, with the region as series_id) is what the models consume.
+
 *Another option would be to train different models for every region, or two models, one for generated data and another one for loaded data.
 Since there is not much data, I think it is better to train a single model for all regions and both types of data.
 
@@ -23,13 +24,18 @@ import argparse
 import os
 
 # General data imports
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import pandas as pd
 
 # Local imports
+from src.data.panel import Panel
+from src.data.calendar_features import get_calendar
 from src.definitions import (
     PROCESSED_DATA_DIR, 
     EXTERNAL_DATA_DIR,
     REGION,
+    REGIONS,
     REGION_MAPPING,
     PREDICTIONS_DIR
 )
@@ -99,6 +105,22 @@ def get_ohe_from_cat(df, cat='curr_max'):
     df = pd.concat([df, pd.get_dummies(df[cat], prefix=cat)], axis=1)
     return df
 
+def get_cat_from_col(df, cat='curr_max', categories=REGIONS):
+    """
+    Encode a categorical column as a pandas categorical with a fixed set of categories.
+
+    Unlike one-hot encoding, the feature width does not grow with the number of categories: the
+    integer codes are consumed directly by native categorical splits (XGBoost, LightGBM) or by an
+    embedding layer (LSTM). The fixed categories keep the codes stable between training and prediction.
+
+    :param df: DataFrame with the data.
+    :param cat: Name of the categorical column.
+    :param categories: Ordered categories, the code of each one is its position.
+    :return: DataFrame with the column converted to categorical.
+    """
+    df[cat] = pd.Categorical(df[cat], categories=categories)
+    return df
+
 ### FORECASTING ENERGY FUNCTIONS ###
 
 def convert_to_timeseries(df, value_columns=[], metadata_columns=[]):
@@ -202,9 +224,103 @@ def normalize_values(ts, value_col='value', series_id_col='series_id'):
     :param series_id_col: Name of the column containing series identifiers.
     :return: DataFrame with values normalized.
     """
-    ts[value_col] = ts.groupby(series_id_col)[value_col].apply(lambda x: (x - x.min()) / (x.max() - x.min()))
+    grouped = ts.groupby(series_id_col)[value_col]
+    minimum = grouped.transform('min')
+    maximum = grouped.transform('max')
+    ts[value_col] = (ts[value_col] - minimum) / (maximum - minimum)
     return ts
 
+### PANEL FUNCTIONS ###
+
+def get_panel(df, features, regions=REGIONS):
+    """
+    Build the (timestamp x region x feature) panel used by the models from the wide data.
+
+    Features that are not in the data (lags, holidays, ...) are allocated up front and filled in place
+    by the functions below, so the panel array is never reallocated.
+
+    :param df: Wide DataFrame with the data.
+    :param features: Names of the features of the panel.
+    :param regions: Region codes of the panel.
+    :return: Panel with the data.
+    """
+    return Panel.from_wide(df, features=features, regions=regions)
+
+def get_panel_features(panel, required=None):
+    """
+    Get the long-format feature matrix of a panel and the mask of the rows usable by the models.
+
+    Rows with a missing or zero required feature are masked instead of dropped, so that every row
+    stays aligned with the panel and predictions can be reshaped back without pivoting.
+
+    :param panel: Panel with the data.
+    :param required: Features that must be available. Defaults to the surplus and its lags.
+    :return: Tuple of the feature DataFrame (backed by the panel memory) and the boolean row mask.
+    """
+    if required is None:
+        required = [feature for feature in panel.features if feature.startswith('surplus')]
+    return panel.to_long_frame(), panel.valid_mask(required).reshape(-1)
+
+def get_panel_lags(panel, lags, value='surplus'):
+    """
+    Fill the lagged values of a panel feature, named '{value}_lag_{lag}'.
+
+    The whole panel is shifted along the time axis at once, so lags never leak across regions.
+
+    :param panel: Panel with the lag features allocated.
+    :param lags: List of lag values.
+    :param value: Name of the lagged feature.
+    :return: Panel with the lags filled.
+    """
+    values = panel[value]
+    for lag in lags:
+        lagged = panel[f'{value}_lag_{lag}']
+        lagged[:lag] = np.nan
+        lagged[lag:] = values[:-lag]
+    return panel
+
+def get_panel_forecast_target(panel, prediction_horizon, value='surplus'):
+    """
+    Get the future value of a panel feature.
+
+    :param panel: Panel with the data.
+    :param prediction_horizon: Number of hours to predict ahead.
+    :param value: Name of the forecasted feature.
+    :return: Array (timestamp x region) with the target, NaN where the future is unknown.
+    """
+    return get_panel_horizon_targets(panel, [prediction_horizon], value=value)[:, :, 0]
+
+def get_panel_horizon_targets(panel, horizons, value='surplus'):
+    """
+    Get the future values of a panel feature at several horizons in a single pass.
+
+    The feature is padded once with the unknown future and every horizon is read from a strided
+    window view over the time axis, instead of shifting the data once per horizon.
+
+    :param panel: Panel with the data.
+    :param horizons: List of horizons (hours ahead).
+    :param value: Name of the forecasted feature.
+    :return: Array (timestamp x region x horizon) where [t, r, k] is the value of region r at t + horizons[k],
+        NaN where the future is unknown.
+    """
+    values = panel[value]
+    max_horizon = max(horizons)
+    padded = np.full((values.shape[0] + max_horizon, values.shape[1]), np.nan, dtype=values.dtype)
+    padded[:values.shape[0]] = values
+
+    windows = sliding_window_view(padded, max_horizon + 1, axis=0)  # (timestamp x region x max_horizon + 1)
+    return windows[:values.shape[0], :, list(horizons)]
+
+def add_panel_calendar(panel):
+    """
+    Fill the calendar features allocated in the panel (local hour, day of week, month, DST, weekend and
+    holiday flags, see src/data/calendar_features.py) with an integer gather from the precomputed table.
+
+    :param panel: Panel with the calendar features allocated.
+    :return: Panel with the calendar features filled.
+    """
+    return get_calendar(panel.timestamps, regions=panel.regions).fill_panel(panel)
+
 ### GROUND TRUTH FOR VALIDATION ###
 
 def prepare_reference_predictions(validation_file):
@@ -0,0 +1,198 @@
+"""
+Script containing the per-series scaler used to normalize model inputs and targets.
+
+The last axis of an array is always treated as the series axis (one statistic per column), so
+arrays of any rank (rows x series, samples x lags x features, ...) can be scaled without
+reshaping them. Statistics are accumulated with Welford's algorithm, which allows fitting in
+chunks and refreshing a fitted scaler with new observations without rescanning the history.
+"""
+# Data related imports
+import numpy as np
+
+### SCALER ###
+
+class SeriesScaler:
+    """
+    Per-series scaler fitted with Welford statistics.
+
+    :param method: 'standard' to center and scale to unit variance, 'minmax' to map to [0, 1].
+    :param chunk_size: Number of rows reduced at once when fitting, bounds the temporary memory.
+    """
+    METHODS = ('standard', 'minmax')
+
+    def __init__(self, method='standard', chunk_size=65536):
+        if method not in self.METHODS:
+            raise ValueError("Invalid scaler")
+        self.method = method
+        self.chunk_size = chunk_size
+        self.count = None
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+
+    @property
+    def is_fitted(self):
+        return self.count is not None
+
+    def _reset(self, n_series):
+        self.count = np.zeros(n_series, dtype=np.int64)
+        self.mean = np.zeros(n_series, dtype=np.float64)
+        self.m2 = np.zeros(n_series, dtype=np.float64)
+        self.min = np.full(n_series, np.inf)
+        self.max = np.full(n_series, -np.inf)
+
+    def _update(self, chunk):
+        """
+        Merge the statistics of a 2-D chunk (rows x series) into the running ones.
+        NaNs are ignored, so every series keeps its own observation count.
+        """
+        chunk = chunk.astype(np.float64, copy=False)
+        valid = ~np.isnan(chunk)
+        count = valid.sum(axis=0)
+        if not count.any():
+            return
+
+        safe_count = np.maximum(count, 1)
+        mean = np.where(valid, chunk, 0.0).sum(axis=0) / safe_count
+        m2 = np.where(valid, chunk - mean, 0.0)
+        m2 = (m2 * m2).sum(axis=0)
+
+        # Chan et al. parallel combination of two Welford states
+        total = self.count + count
+        safe_total = np.maximum(total, 1)
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / safe_total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / safe_total
+        self.count = total
+
+        self.min = np.fmin(self.min, np.where(valid, chunk, np.inf).min(axis=0))
+        self.max = np.fmax(self.max, np.where(valid, chunk, -np.inf).max(axis=0))
+
+    def partial_fit(self, x):
+        """
+        Update the statistics with new observations.
+
+        :param x: Array of any rank whose last axis holds the series.
+        :return: The scaler itself.
+        """
+        x = np.asarray(x)
+        if x.ndim == 1:
+            x = x[:, None]
+        if not self.is_fitted:
+            self._reset(x.shape[-1])
+        elif x.shape[-1] != self.count.shape[0]:
+            raise ValueError(f"Expected {self.count.shape[0]} series, got {x.shape[-1]}")
+
+        # Iterate over the leading axis so that only one chunk is ever materialized in 2-D
+        step = max(1, self.chunk_size // max(1, int(np.prod(x.shape[1:-1], dtype=np.int64))))
+        for start in range(0, x.shape[0], step):
+            self._update(x[start:start + step].reshape(-1, x.shape[-1]))
+        return self
+
+    def fit(self, x):
+        """
+        Fit the scaler from scratch.
+
+        :param x: Array of any rank whose last axis holds the series.
+        :return: The scaler itself.
+        """
+        self.count = None
+        return self.partial_fit(x)
+
+    def _params(self):
+        """
+        Get the offset and scale that map raw values to scaled ones.
+        Constant series get a unit scale, as sklearn does.
+        """
+        if not self.is_fitted:
+            raise ValueError("Scaler has not been fitted")
+        if self.method == 'standard':
+            offset = self.mean
+            scale = np.sqrt(self.m2 / np.maximum(self.count, 1))
+        else:
+            offset = self.min
+            scale = self.max - self.min
+        scale = np.where(scale > 0, scale, 1.0)
+        return offset, scale
+
+    def _prepare(self, x, copy):
+        x = np.asarray(x)
+        if not np.issubdtype(x.dtype, np.floating):
+            return x.astype(np.float32)
+        if copy or not x.flags.writeable:
+            return x.copy()
+        return x
+
+    def transform(self, x, copy=False):
+        """
+        Scale the array. Floating arrays are modified in place unless copy is True.
+
+        :param x: Array of any rank whose last axis holds the series.
+        :param copy: Whether to leave the input untouched.
+        :return: Scaled array.
+        """
+        x = self._prepare(x, copy)
+        offset, scale = self._params()
+        x -= offset.astype(x.dtype)
+        x /= scale.astype(x.dtype)
+        return x
+
+    def inverse_transform(self, x, copy=False):
+        """
+        Undo the scaling. Floating arrays are modified in place unless copy is True.
+
+        :param x: Array of any rank whose last axis holds the series.
+        :param copy: Whether to leave the input untouched.
+        :return: Array in the original units.
+        """
+        x = self._prepare(x, copy)
+        offset, scale = self._params()
+        x *= scale.astype(x.dtype)
+        x += offset.astype(x.dtype)
+        return x
+
+    def fit_transform(self, x, copy=False):
+        return self.fit(x).transform(x, copy=copy)
+
+    ### SERIALIZATION ###
+
+    def state_dict(self):
+        """
+        Get the fitted statistics as plain arrays.
+        """
+        return {
+            'method': np.array(self.method),
+            'count': self.count,
+            'mean': self.mean,
+            'm2': self.m2,
+            'min': self.min,
+            'max': self.max,
+        }
+
+    def load_state_dict(self, state):
+        """
+        Restore the statistics returned by state_dict.
+        """
+        self.method = str(state['method'])
+        for key in ('count', 'mean', 'm2', 'min', 'max'):
+            setattr(self, key, np.asarray(state[key]))
+        return self
+
+    def save(self, path):
+        """
+        Save the statistics to a compressed .npz file.
+
+        :param path: Path to the output file.
+        """
+        np.savez_compressed(path, **self.state_dict())
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a scaler saved with save.
+
+        :param path: Path to the .npz file.
+        """
+        with np.load(path) as state:
+            return cls(str(state['method'])).load_state_dict(state)
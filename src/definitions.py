@@ -45,6 +45,9 @@ REGION = {
     "NE": 8 # Netherlands
 }
 
+# Regions ordered by their code, used as the fixed category order of categorical features
+REGIONS = sorted(REGION, key=REGION.get)
+
 REGION_MAPPING = {
     "SP": "ES",
     "UK": "GB",
@@ -57,6 +60,19 @@ REGION_MAPPING = {
     "NE": "NL",
 }
 
+# Local timezone of each region, used to compute calendar features on local time
+REGION_TIMEZONE = {
+    "SP": "Europe/Madrid",
+    "UK": "Europe/London",
+    "DE": "Europe/Berlin",
+    "DK": "Europe/Copenhagen",
+    "HU": "Europe/Budapest",
+    "SE": "Europe/Stockholm",
+    "IT": "Europe/Rome",
+    "PO": "Europe/Warsaw",
+    "NE": "Europe/Amsterdam",
+}
+
 SEED = 3
 VAL_SIZE = 0.1
 
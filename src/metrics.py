@@ -158,17 +158,13 @@ def get_model_performance(actual, predictions):
     recall = recall_score(actual, predictions, average='weighted')
     return f1, precision, recall
 
-### MAIN ###
-
-def main():
-    parser = argparse.ArgumentParser(description='Compute evaluation metrics')
-    parser.add_argument('--predictions', type=str, help='Path to predictions file')
-    args = parser.parse_args()
-
-    # Load predictions and actual values from the .json files
-    actual = pd.read_json(os.path.join(PREDICTIONS_DIR, 'val_predictions.json'))
-    predictions = pd.read_json(args.predictions)
+def get_predictions_performance(actual, predictions):
+    """
+    Compute the f1 score, precision and recall of a predictions DataFrame.
 
+    :param actual: DataFrame with the actual values (val_predictions.json).
+    :param predictions: DataFrame with the predicted values.
+    """
     # Ensure the values are paired by timestamp if possible
     if 'timestamp' in actual and 'timestamp' in predictions: # forecasting
         merged = actual.merge(predictions, how='inner', on='timestamp')
@@ -179,8 +175,21 @@ def main():
         actual = actual.iloc[:-1].target.tolist()
         predictions = predictions.iloc[:-1].target.tolist()
 
+    return get_model_performance(actual, predictions)
+
+### MAIN ###
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute evaluation metrics')
+    parser.add_argument('--predictions', type=str, help='Path to predictions file')
+    args = parser.parse_args()
+
+    # Load predictions and actual values from the .json files
+    actual = pd.read_json(os.path.join(PREDICTIONS_DIR, 'val_predictions.json'))
+    predictions = pd.read_json(args.predictions)
+
     # Compute the f1 score
-    f1, precision, recall = get_model_performance(actual, predictions)
+    f1, precision, recall = get_predictions_performance(actual, predictions)
 
     # termcolor
     print(colored(f'F1 Score: {f1}', 'blue'))
@@ -0,0 +1,54 @@
+"""
+Script containing the versioning of the saved model artifacts.
+
+Every trained or refreshed artifact is saved at its usual path, the one the prediction scripts
+read, and copied under a versions directory next to it, named with the UTC time it was saved at:
+
+    models/forecasting/xgboost/model.json
+    models/forecasting/xgboost/versions/model_20240101T020000.json
+
+A refresh therefore never overwrites the only copy of the model it started from, and a bad
+artifact can be rolled back by copying a previous version over the current one.
+"""
+# General imports
+import glob
+import os
+import shutil
+import time
+
+VERSIONS_DIR = 'versions'
+
+### GENERAL FUNCTIONS ###
+
+def get_version_path(path, version):
+    """
+    Get the path of a version of an artifact.
+
+    :param path: Path of the current artifact.
+    :param version: Version name.
+    """
+    stem, extension = os.path.splitext(os.path.basename(path))
+    return os.path.join(os.path.dirname(path), VERSIONS_DIR, f'{stem}_{version}{extension}')
+
+def get_versions(path):
+    """
+    Get the paths of the saved versions of an artifact, from the oldest to the latest.
+
+    :param path: Path of the current artifact.
+    """
+    return sorted(glob.glob(get_version_path(path, '*')))
+
+def save_artifact(path, save):
+    """
+    Save an artifact at its path and keep a copy of it as a new version.
+
+    :param path: Path of the current artifact.
+    :param save: Function (path) -> None writing the artifact.
+    :return: Path of the saved version.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    save(path)
+    version_path = get_version_path(path, time.strftime('%Y%m%dT%H%M%S', time.gmtime()))
+    os.makedirs(os.path.dirname(version_path), exist_ok=True)
+    shutil.copyfile(path, version_path)
+    return version_path
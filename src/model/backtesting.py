@@ -0,0 +1,459 @@
+"""
+Script to backtest the models with rolling-origin folds.
+
+The trainers validate on a single held-out split, which gives one noisy score. A backtest re-fits
+every model at several origins and scores it on the hours after each origin only:
+
+- The test windows are the last --folds blocks of --step hours of the training data (52 weekly
+  blocks by default, a year of weekly re-fits).
+- With the expanding scheme a fold is trained on every hour before its origin, with the sliding
+  scheme on the last --window hours only. The rows whose label is after the origin are left out,
+  so no fold ever sees its test period.
+
+Features are built once per model family in the main process. The folds run in a process pool whose
+workers inherit them through fork instead of receiving a pickled copy per fold. Every fold writes its
+F1 (maximum surplus region of the next hour), MSE of the surplus forecasts and fit/predict timings to
+reports/backtest_{scheme}.csv, and a per-model summary is written next to it.
+"""
+# General imports
+import argparse
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    as_completed,
+)
+import json
+import os
+import time
+import warnings
+warnings.filterwarnings('ignore', category=FutureWarning)
+
+# Data related imports
+import numpy as np
+import pandas as pd
+import lightgbm as lgb
+from sklearn.model_selection import train_test_split
+from sklearn.preprocessing import LabelEncoder
+import torch
+import xgboost as xgb
+
+# Local imports
+from src.definitions import (
+    REPORTS_DIR,
+    SEED,
+    VAL_SIZE,
+    REGIONS,
+    XGBOOST_LAGS,
+    LIGHTGBM_LAGS,
+    LSTM_LAGS,
+)
+from src.data.panel import max_region
+from src.data.prepare_data import (
+    load_data,
+    get_surplus,
+    get_panel,
+    get_panel_features,
+    get_panel_horizon_targets,
+)
+from src.data.scaling import SeriesScaler
+from src.metrics import get_model_performance
+from src.model.gbm_datasets import (
+    get_xgb_dataset,
+    get_xgb_params,
+    get_lgb_dataset,
+    get_lgb_params,
+)
+from src.model.classification.xgboost import model_training as xgb_cls_training
+from src.model.forecasting.xgboost import model_training as xgb_training
+from src.model.forecasting.lightgbm import model_training as lgb_training
+from src.model.forecasting.lstm import model_training as lstm_training
+from src.config import setup_logger
+
+# Setup logger
+logger = setup_logger()
+
+SCHEMES = ('expanding', 'sliding')
+EARLY_STOPPING_ROUNDS = 50
+LSTM_PATIENCE = 3
+
+# Features of every model family, inherited by the worker processes instead of being pickled per fold
+_BACKTEST_DATA = {}
+
+### GENERAL FUNCTIONS ###
+
+def get_origins(n_timestamps, step=168, folds=52, scheme='expanding', window=None, min_train=336):
+    """
+    Get the rolling-origin folds over a time axis.
+
+    The test windows are the last folds blocks of step timestamps. Every fold is trained on the
+    timestamps before its origin: all of them with the expanding scheme, the last window of them with
+    the sliding one. Folds with less than min_train training timestamps are skipped.
+
+    :param n_timestamps: Number of timestamps.
+    :param step: Number of timestamps between two origins, i.e., of every test window.
+    :param folds: Maximum number of folds.
+    :param scheme: 'expanding' or 'sliding'.
+    :param window: Number of training timestamps of the sliding scheme.
+    :param min_train: Minimum number of training timestamps of a fold.
+    :return: List of (train start, origin, test end) timestamp indexes.
+    """
+    if scheme not in SCHEMES:
+        raise ValueError("Invalid scheme")
+    if scheme == 'sliding' and not window:
+        raise ValueError("The sliding scheme needs a window")
+
+    origins = []
+    for k in range(folds, 0, -1):
+        origin = n_timestamps - k * step
+        start = 0 if scheme == 'expanding' else max(0, origin - window)
+        if origin - start >= min_train:
+            origins.append((start, origin, origin + step))
+    return origins
+
+def get_long_rows(mask, start, stop, n_regions):
+    """
+    Get the positions of the usable long rows (row t * regions + r) of the timestamps in [start, stop).
+    """
+    return start * n_regions + np.flatnonzero(mask[start * n_regions:stop * n_regions])
+
+def scatter_long(values, rows, start, stop, n_regions):
+    """
+    Scatter the predictions of long rows into a (timestamp x region) matrix of the timestamps in
+    [start, stop), NaN for the rows without prediction.
+    """
+    forecasts = np.full(((stop - start) * n_regions,) + values.shape[1:], np.nan)
+    forecasts[rows - start * n_regions] = values
+    return forecasts.reshape((stop - start, n_regions) + values.shape[1:])
+
+def fit_early_stopping(x, y):
+    """
+    Split the latest rows of a fold training data as the early stopping set, as the trainers do.
+    """
+    return train_test_split(x, y, test_size=VAL_SIZE, shuffle=False)
+
+def load_config(module, name='model_config.json'):
+    """
+    Load the configuration saved next to a training script.
+    """
+    with open(os.path.join(os.path.dirname(os.path.realpath(module.__file__)), name), 'r') as f:
+        return json.load(f)
+
+### MODELS ###
+
+# Every model is a (prepare, fit, predict) triple:
+# - prepare(df) -> data, built once in the main process and shared by all the folds.
+# - fit(data, start, origin, threads) -> model, trained on the labels known at the origin.
+# - predict(data, model, origin, stop) -> (timestamp x region) scores, the surplus forecasts of the
+#   regressors or the class probabilities of the classifier.
+
+def prepare_baseline(df):
+    panel = get_panel(get_surplus(df), features=['surplus'])
+    return {'surplus': panel['surplus']}
+
+def fit_baseline(data, start, origin, threads):
+    return None
+
+def predict_baseline(data, model, origin, stop):
+    # The current surplus is the forecast
+    return data['surplus'][origin:stop]
+
+def prepare_gbm(df, module, lags):
+    panel = module.prepare_data(df, lags=lags)
+    features, mask = get_panel_features(panel)
+    target = get_panel_horizon_targets(panel, [1])[:, :, 0].reshape(-1)
+    return {
+        'features': features,
+        'target': target,
+        'mask': mask & ~np.isnan(target),
+        'predict_mask': mask,
+        'n_regions': len(panel.regions),
+        'config': load_config(module),
+    }
+
+def get_gbm_train(data, start, origin):
+    # The label of timestamp t is the surplus at t + 1, only known at the origin for t + 1 < origin
+    rows = get_long_rows(data['mask'], start, origin - 1, data['n_regions'])
+    return fit_early_stopping(data['features'].iloc[rows], data['target'][rows])
+
+def get_gbm_test(data, origin, stop):
+    rows = get_long_rows(data['predict_mask'], origin, stop, data['n_regions'])
+    return rows, data['features'].iloc[rows]
+
+def fit_xgboost(data, start, origin, threads):
+    x_fit, x_val, y_fit, y_val = get_gbm_train(data, start, origin)
+    params, num_boost_round = get_xgb_params(data['config'])
+    dfit = get_xgb_dataset(x_fit, y_fit)
+    return xgb.train(
+        {**params, 'nthread': threads},
+        dfit,
+        num_boost_round=num_boost_round,
+        evals=[(get_xgb_dataset(x_val, y_val, ref=dfit), 'validation')],
+        early_stopping_rounds=EARLY_STOPPING_ROUNDS,
+        verbose_eval=False,
+    )
+
+def predict_xgboost(data, model, origin, stop):
+    rows, x_test = get_gbm_test(data, origin, stop)
+    predictions = model.inplace_predict(x_test, iteration_range=(0, model.best_iteration + 1))
+    return scatter_long(predictions, rows, origin, stop, data['n_regions'])
+
+def fit_lightgbm(data, start, origin, threads):
+    x_fit, x_val, y_fit, y_val = get_gbm_train(data, start, origin)
+    params, num_boost_round = get_lgb_params(data['config'])
+    params['num_threads'] = threads
+    fit_set = get_lgb_dataset(x_fit, y_fit, params)
+    return lgb.train(
+        params,
+        fit_set,
+        num_boost_round=num_boost_round,
+        valid_sets=[lgb.Dataset(x_val, y_val, reference=fit_set)],
+        callbacks=[lgb.early_stopping(EARLY_STOPPING_ROUNDS, verbose=False)],
+    )
+
+def predict_lightgbm(data, model, origin, stop):
+    rows, x_test = get_gbm_test(data, origin, stop)
+    return scatter_long(model.predict(x_test), rows, origin, stop, data['n_regions'])
+
+def prepare_xgboost_cls(df):
+    frame = xgb_cls_training.prepare_data(df)
+    target = frame['curr_max'].shift(-1)  # Region with the maximum surplus at the next hour
+    return {
+        'features': frame.drop(['timestamp'], axis=1),
+        'target': target.to_numpy(dtype=object),
+        'config': load_config(xgb_cls_training),
+    }
+
+def fit_xgboost_cls(data, start, origin, threads):
+    rows = start + np.flatnonzero(pd.notna(data['target'][start:origin - 1]))
+    x_fit, x_val, y_fit, y_val = fit_early_stopping(data['features'].iloc[rows], data['target'][rows])
+
+    # Classes are the regions seen in the fit rows, the early stopping rows of other regions are left out
+    label_encoder = LabelEncoder().fit(y_fit)
+    seen = np.isin(y_val, label_encoder.classes_)
+    model = xgb.XGBClassifier(**{**data['config'], 'n_jobs': threads}, early_stopping_rounds=EARLY_STOPPING_ROUNDS)
+    model.fit(
+        x_fit,
+        label_encoder.transform(y_fit),
+        eval_set=[(x_val[seen], label_encoder.transform(y_val[seen]))],
+        verbose=False,
+    )
+    return model, label_encoder.classes_
+
+def predict_xgboost_cls(data, model, origin, stop):
+    model, classes = model
+    probabilities = model.predict_proba(data['features'].iloc[origin:stop])
+
+    # Regions never seen by the model cannot be predicted
+    scores = np.full((len(probabilities), len(REGIONS)), np.nan)
+    scores[:, [REGIONS.index(region) for region in classes]] = probabilities
+    return scores
+
+def prepare_sequences(df, model_type):
+    panel = lstm_training.prepare_data(df)
+    dataset = lstm_training.create_sequences(panel, lags=LSTM_LAGS, require_target=False)
+    return {
+        'dataset': dataset,
+        'known': ~np.isnan(dataset.labels()[:, 0]),
+        'model_type': model_type,
+        'config': load_config(lstm_training, 'model_config.json' if model_type == 'lstm' else f'{model_type}_config.json'),
+    }
+
+def fit_sequences(data, start, origin, threads):
+    torch.set_num_threads(threads)
+    torch.manual_seed(SEED)
+    np.random.seed(SEED)
+
+    # Scale a copy of the shared values, the sequences of the fold are views of it
+    dataset = data['dataset']
+    dataset = lstm_training.SequenceDataset(dataset.values.copy(), dataset.targets.copy(), dataset.positions, dataset.codes, dataset.lags)
+    indexes = np.flatnonzero((dataset.positions >= start) & (dataset.positions < origin - 1) & data['known'])
+    fit_indexes, val_indexes = train_test_split(indexes, test_size=VAL_SIZE, shuffle=False)
+    fit_data, val_data = dataset.subset(fit_indexes), dataset.subset(val_indexes)
+
+    x_scaler, y_scaler = SeriesScaler(), SeriesScaler()
+    x_scaler.fit(dataset.values[fit_data.positions, fit_data.codes])
+    y_scaler.fit(fit_data.labels())
+    dataset.scale(x_scaler)
+    y_scaler.transform(dataset.targets)
+
+    config = data['config']
+    model = lstm_training.build_model(data['model_type'], dataset.values.shape[2], config['hidden_layer_size'], 1, len(REGIONS))
+    lstm_training.train_model(
+        model,
+        lstm_training.BatchIterator(fit_data, shuffle=True),
+        learning_rate=config['learning_rate'],
+        epochs=config['epochs'],
+        val_loader=lstm_training.BatchIterator(val_data, batch_size=4096),
+        patience=LSTM_PATIENCE,
+        progress=False,
+    )
+    return model, dataset, y_scaler
+
+def predict_sequences(data, model, origin, stop):
+    model, dataset, y_scaler = model
+    test_data = dataset.subset(np.flatnonzero((dataset.positions >= origin) & (dataset.positions < stop)))
+    predictions = y_scaler.inverse_transform(lstm_training.predict(model, test_data))
+
+    forecasts = np.full((stop - origin, dataset.values.shape[1]), np.nan)
+    forecasts[test_data.positions - origin, test_data.codes] = predictions[:, 0]
+    return forecasts
+
+MODELS = {
+    'baseline': (prepare_baseline, fit_baseline, predict_baseline),
+    'xgboost': (lambda df: prepare_gbm(df, xgb_training, XGBOOST_LAGS), fit_xgboost, predict_xgboost),
+    'lightgbm': (lambda df: prepare_gbm(df, lgb_training, LIGHTGBM_LAGS), fit_lightgbm, predict_lightgbm),
+    'xgboost_cls': (prepare_xgboost_cls, fit_xgboost_cls, predict_xgboost_cls),
+    'lstm': (lambda df: prepare_sequences(df, 'lstm'), fit_sequences, predict_sequences),
+    'tcn': (lambda df: prepare_sequences(df, 'tcn'), fit_sequences, predict_sequences),
+}
+
+# Models whose scores are class probabilities instead of surplus forecasts
+CLASSIFIERS = ('xgboost_cls',)
+
+### BACKTEST ###
+
+def _init_backtest_worker(data):
+    _BACKTEST_DATA.update(data)
+
+def run_fold(model_name, fold, start, origin, stop, threads):
+    """
+    Fit a model at the origin of a fold and score it on the test window.
+
+    :param model_name: Name of the model in MODELS.
+    :param fold: Index of the fold.
+    :param start: First training timestamp index.
+    :param origin: First test timestamp index.
+    :param stop: End of the test window (excluded).
+    :param threads: Number of threads of the model.
+    :return: Dictionary with the fold metrics and timings.
+    """
+    _, fit, predict = MODELS[model_name]
+    data = _BACKTEST_DATA[model_name]
+
+    start_time = time.perf_counter()
+    model = fit(data, start, origin, threads)
+    fit_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    scores = predict(data, model, origin, stop)
+    predict_time = time.perf_counter() - start_time
+
+    # Only the hours with a known next hour and a prediction are scored, as src/metrics.py does
+    actual = _BACKTEST_DATA['actual'][origin:stop]
+    predicted = max_region(scores)
+    scored = pd.notna(actual) & pd.notna(predicted)
+    f1 = get_model_performance(list(actual[scored]), list(predicted[scored]))[0] if scored.any() else np.nan
+
+    mse = np.nan
+    if model_name not in CLASSIFIERS:
+        error = (scores - _BACKTEST_DATA['next_surplus'][origin:stop]) ** 2
+        mse = np.nanmean(error) if (~np.isnan(error)).any() else np.nan
+
+    return {
+        'model': model_name,
+        'fold': fold,
+        'train_start': _BACKTEST_DATA['timestamps'][start],
+        'origin': _BACKTEST_DATA['timestamps'][origin],
+        'test_hours': stop - origin,
+        'f1': f1,
+        'mse': mse,
+        'fit_seconds': fit_time,
+        'predict_seconds': predict_time,
+    }
+
+def backtest(df, model_names, origins, jobs=None, threads=1):
+    """
+    Run every fold of every model in a process pool.
+
+    :param df: Processed DataFrame with the data.
+    :param model_names: Names of the models in MODELS.
+    :param origins: List of (train start, origin, test end) folds from get_origins.
+    :param jobs: Number of worker processes, None for cores / threads.
+    :param threads: Number of threads of every fold.
+    :return: DataFrame with one row of metrics and timings per model and fold.
+    """
+    # Shared arrays, built once before the workers fork
+    panel = get_panel(get_surplus(df.copy()), features=['surplus'])
+    next_surplus = get_panel_horizon_targets(panel, [1])[:, :, 0]
+    data = {
+        'timestamps': panel.timestamps,
+        'next_surplus': next_surplus,
+        'actual': max_region(next_surplus),
+    }
+    for model_name in model_names:
+        start_time = time.perf_counter()
+        data[model_name] = MODELS[model_name][0](df.copy())
+        logger.info(f"Prepared the {model_name} features in {time.perf_counter() - start_time:.1f}s")
+
+    jobs = jobs or max(1, (os.cpu_count() or 1) // threads)
+    tasks = [(model_name, fold, *origin) for model_name in model_names for fold, origin in enumerate(origins)]
+    logger.info(f"Running {len(tasks)} folds over {jobs} processes with {threads} threads each")
+
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_backtest_worker, initargs=(data,)) as executor:
+        futures = [executor.submit(run_fold, *task, threads) for task in tasks]
+        for future in as_completed(futures):
+            result = future.result()
+            logger.info(
+                f"{result['model']} fold {result['fold']}: F1 {result['f1']:.4f}, MSE {result['mse']:.1f} "
+                f"(fit {result['fit_seconds']:.1f}s, predict {result['predict_seconds']:.2f}s)"
+            )
+            results.append(result)
+    return pd.DataFrame(results).sort_values(['model', 'fold'], ignore_index=True)
+
+def summarize(results):
+    """
+    Get the mean and standard deviation of the fold metrics and the total time of every model.
+    """
+    return results.groupby('model', sort=False).agg(
+        folds=('fold', 'count'),
+        f1_mean=('f1', 'mean'),
+        f1_std=('f1', 'std'),
+        mse_mean=('mse', 'mean'),
+        fit_seconds=('fit_seconds', 'sum'),
+        predict_seconds=('predict_seconds', 'sum'),
+    )
+
+### MAIN ###
+
+def main():
+    parser = argparse.ArgumentParser(description='Backtest the models with rolling-origin folds')
+    parser.add_argument('--models', type=str, nargs='+', default=list(MODELS), choices=list(MODELS), help='Models to backtest')
+    parser.add_argument('--scheme', type=str, default='expanding', choices=SCHEMES, help='Train on all the past hours or on a sliding window of them')
+    parser.add_argument('--window', type=int, default=2160, help='Training hours of the sliding scheme')
+    parser.add_argument('--step', type=int, default=168, help='Hours between two origins, i.e., test hours of every fold')
+    parser.add_argument('--folds', type=int, default=52, help='Maximum number of folds, the latest ones are kept')
+    parser.add_argument('--min-train', type=int, default=336, help='Minimum training hours of a fold')
+    parser.add_argument('--jobs', type=int, default=None, help='Number of parallel folds (default: cores / threads per fold)')
+    parser.add_argument('--threads-per-fold', type=int, default=1, help='Threads of every fold')
+    args = parser.parse_args()
+
+    train, _ = load_data()
+    n_timestamps = train['timestamp'].nunique()
+    origins = get_origins(n_timestamps, args.step, args.folds, args.scheme, args.window, args.min_train)
+    if not origins:
+        parser.error(f'No fold has {args.min_train} training hours in {n_timestamps} hours of data')
+    logger.info(f"Backtesting {len(origins)} {args.scheme} folds of {args.step} hours")
+
+    start_time = time.perf_counter()
+    results = backtest(train, args.models, origins, args.jobs, args.threads_per_fold)
+    wall_time = time.perf_counter() - start_time
+
+    results_path = os.path.join(REPORTS_DIR, f'backtest_{args.scheme}.csv')
+    os.makedirs(REPORTS_DIR, exist_ok=True)
+    results.to_csv(results_path, index=False)
+
+    summary = summarize(results)
+    fold_time = results['fit_seconds'].sum() + results['predict_seconds'].sum()
+    report = (
+        f"Backtest of {len(origins)} {args.scheme} folds of {args.step} hours\n\n"
+        f"{summary.to_string(float_format=lambda value: f'{value:.4f}')}\n\n"
+        f"Wall time: {wall_time:.1f}s for {fold_time:.1f}s of fold time\n"
+    )
+    print(report)
+    summary_path = os.path.join(REPORTS_DIR, f'backtest_{args.scheme}_summary.txt')
+    with open(summary_path, 'w') as f:
+        f.write(report)
+    logger.info(f"Fold results saved to {results_path} and summary to {summary_path}")
+
+if __name__ == '__main__':
+    main()
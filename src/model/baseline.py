@@ -16,6 +16,7 @@ from src.definitions import (
 
 from src.data.prepare_data import (
     get_surplus,
+    get_panel,
 )
 
 def naive_prediction(df):
@@ -24,13 +25,13 @@ def naive_prediction(df):
     """
     # Get the maximum surplus for each region
     df = get_surplus(df)
-    # Get the target
-    max_col = df.filter(regex='surplus').idxmax(axis=1)
-    country_code = max_col.str.split('_', expand=True)[0]
-    df['target'] = country_code
+    panel = get_panel(df, features=['surplus'])
+
+    # Get the target, the current surplus is the forecast
+    predictions = panel.to_predictions_frame(panel['surplus'])
 
     # Store the target to a .json file called baseline.json
-    df[['timestamp', 'target']].to_json(os.path.join(PREDICTIONS_DIR, 'baseline.json'), orient='records')
+    predictions.to_json(os.path.join(PREDICTIONS_DIR, 'baseline.json'), orient='records')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Compute baseline predictions')
@@ -19,7 +19,7 @@ from src.model.classification.xgboost.model_training import prepare_data
 ### GENERAL FUNCTIONS ###
 
 def load_xgb_model(model_path):
-    model = xgb.XGBClassifier()
+    model = xgb.XGBClassifier(enable_categorical=True)
     model.load_model(model_path)
     return model
 
@@ -37,7 +37,6 @@ def main():
     # Load and prepare prediction data
     _, validation = load_data()
     validation = prepare_data(validation)
-    validation.drop(['curr_max'], axis=1, inplace=True)
     x_predict = validation.drop(['timestamp'], axis=1)
 
     # Make predictions
@@ -10,17 +10,20 @@ warnings.filterwarnings('ignore', category=FutureWarning)
 
 # Data related imports
 import numpy as np
+import pandas as pd
+from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import LabelEncoder
 import xgboost as xgb
 
 # Local imports
-from src.definitions import MODELS_DIR
+from src.definitions import (
+    MODELS_DIR,
+    VAL_SIZE,
+)
 from src.data.prepare_data import (
     load_data,
-    add_is_weekend,
     get_surplus,
-    get_curr_max,
-    get_ohe_from_cat,
+    get_panel,
     get_cls_target,
 )
 from src.config import setup_logger
@@ -36,20 +39,21 @@ def prepare_data(df):
     :param df: DataFrame with the data.
     :return: DataFrame with the data prepared.
     """
-    # Add features
-    df = add_is_weekend(df)
+    # Only surplus will be used, the wide view of the panel has one surplus column per region
     df = get_surplus(df)
-    df = get_curr_max(df)
-    df = get_ohe_from_cat(df, cat='curr_max')
-    
-    # Remove all cols that have 'load' and 'gen' in its names. Only surplus will be used.
-    df = df.drop(df.filter(regex='load|gen').columns, axis=1)
-    return df
+    panel = get_panel(df, features=['surplus'])
+    data = panel.to_wide_frame()
+
+    # Add features
+    data['is_weekend'] = panel.timestamps.dayofweek.isin([5, 6])
+    data['curr_max'] = pd.Categorical(panel.max_region(panel['surplus']), categories=panel.regions)
+    return data
 
 ### MAIN ###
 
 def parser_add_arguments(parser):
     parser.add_argument('--debug', action='store_true', help='Debug mode')
+    parser.add_argument('--early-stopping-rounds', type=int, default=50, help='Rounds without validation improvement before stopping (0 to disable)')
     return parser
 
 def main():
@@ -73,7 +77,7 @@ def main():
     logger.info("Preparing data...")
     train = prepare_data(train)
     train = get_cls_target(train)
-    train = train.drop(['curr_max'], axis=1)
+    train = train.dropna(subset=['target'])  # The last timestamp has no next observation
 
     # Encode target labels
     label_encoder = LabelEncoder()
@@ -87,10 +91,16 @@ def main():
     x_train = train.drop(['timestamp', 'target'], axis=1)
     y_train = train['target']
 
-    # Model Training
+    # The latest rows are held out as the eval set of early stopping
+    x_fit, x_val, y_fit, y_val = train_test_split(x_train, y_train, test_size=VAL_SIZE, shuffle=False)
+
+    # Model Training, n_estimators is the maximum number of rounds. The saved model keeps its best
+    # iteration, which XGBClassifier.predict truncates the trees to
     logger.info("Training model...")
-    model = xgb.XGBClassifier(**model_config)
-    model.fit(x_train, y_train)  # Add early stopping
+    model = xgb.XGBClassifier(**model_config, early_stopping_rounds=args.early_stopping_rounds or None)
+    model.fit(x_fit, y_fit, eval_set=[(x_val, y_val)], verbose=False)
+    if args.early_stopping_rounds:
+        logger.info(f"Best iteration {model.best_iteration + 1} of {model.get_booster().num_boosted_rounds()} rounds")
 
     # Feature Importance
     # logger.info("Displaying feature importance...")
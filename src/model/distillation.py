@@ -0,0 +1,238 @@
+"""
+Script to distill the ensemble into an ultra-light linear student.
+
+The student is a linear model per region, fitted by ridge regression to reproduce the next hour
+surplus forecasts of the ensemble (the teacher) on the training data. Its inputs are the features
+the boosting forecasters already read (surplus, surplus lags and calendar features). It is stored
+as a few numpy arrays:
+
+    coef[region, feature], intercept[region], features, regions
+
+and predicts the forecast of every region with a single product, without any model library:
+
+    forecast[..., region] = sum_f x[..., region, f] * coef[region, f] + intercept[region]
+
+It is meant as the fallback of the hot serving path, when the full models are cold or overloaded.
+The report compares the agreement of its maximum surplus region with the teachers, the F1 scores
+on val_predictions.json and the latencies.
+"""
+# General imports
+import argparse
+import io
+import os
+import time
+
+# Data related imports
+import numpy as np
+import pandas as pd
+
+# Local imports
+from src.definitions import (
+    MODELS_DIR,
+    PREDICTIONS_DIR,
+    REPORTS_DIR,
+)
+
+STUDENT_PATH = os.path.join(MODELS_DIR, 'forecasting', 'student', 'model.npz')
+
+### STUDENT ###
+
+class LinearStudent:
+    """
+    Linear model per region.
+
+    :param coef: Array (region x feature) with the coefficients.
+    :param intercept: Array (region) with the intercepts, NaN for the regions without training rows.
+    :param features: Name of every feature.
+    :param regions: Region of every row of the coefficients.
+    """
+    def __init__(self, coef, intercept, features, regions):
+        self.coef = coef
+        self.intercept = intercept
+        self.features = list(features)
+        self.regions = list(regions)
+
+    @classmethod
+    def fit(cls, x, y, features, regions, alpha=1.0):
+        """
+        Fit the model of every region by ridge regression on the standardized features. The rows
+        with missing features or target are skipped.
+
+        :param x: Array (timestamp x region x feature) with the features.
+        :param y: Array (timestamp x region) with the target.
+        :param features: Name of every feature.
+        :param regions: Region of every column.
+        :param alpha: L2 penalty of the coefficients, the intercepts are not penalized.
+        """
+        n_regions, n_features = x.shape[1:]
+        coef = np.zeros((n_regions, n_features))
+        intercept = np.full(n_regions, np.nan)
+        for r in range(n_regions):
+            rows = ~np.isnan(x[:, r]).any(axis=1) & ~np.isnan(y[:, r])
+            if not rows.any():
+                continue
+            xr, yr = x[rows, r].astype(np.float64), y[rows, r].astype(np.float64)
+            mean, std = xr.mean(axis=0), xr.std(axis=0)
+            std[std == 0] = 1
+            z = (xr - mean) / std
+            weights = np.linalg.solve(z.T @ z + alpha * np.eye(n_features), z.T @ (yr - yr.mean()))
+            coef[r] = weights / std
+            intercept[r] = yr.mean() - mean @ coef[r]
+        return cls(coef, intercept, features, regions)
+
+    def predict(self, x):
+        """
+        Forecast the surplus of every region.
+
+        :param x: Array (..., region x feature), e.g. (region x feature) for a single hour.
+        :return: Array (..., region) with the forecasts, NaN where a feature is missing.
+        """
+        return np.einsum('...rf,rf->...r', x, self.coef) + self.intercept
+
+    def save(self, path=STUDENT_PATH):
+        """
+        Save the arrays to a .npz file.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(path, coef=self.coef, intercept=self.intercept, features=np.array(self.features), regions=np.array(self.regions))
+
+    @classmethod
+    def load(cls, path=STUDENT_PATH):
+        """
+        Load a student saved with save.
+        """
+        with np.load(path) as state:
+            return cls(state['coef'], state['intercept'], state['features'].tolist(), state['regions'].tolist())
+
+### REPORT ###
+
+def get_agreement(panel, forecasts, teacher):
+    """
+    Get the fraction of timestamps where two (timestamp x region) forecasts have the same maximum
+    surplus region, over the timestamps where both are available.
+    """
+    predicted, expected = panel.max_region(forecasts), panel.max_region(teacher)
+    scored = pd.notna(predicted) & pd.notna(expected)
+    return float((predicted[scored] == expected[scored]).mean()) if scored.any() else np.nan
+
+def get_f1(panel, forecasts, actual):
+    """
+    Get the F1 score of the maximum surplus region of (timestamp x region) forecasts against the actual values.
+    """
+    from src.metrics import get_predictions_performance
+
+    # Same round trip as the predictions files read by src/metrics.py
+    predictions = pd.read_json(io.StringIO(panel.to_predictions_frame(forecasts).to_json(orient='records')))
+    return get_predictions_performance(actual, predictions)[0]
+
+def write_report(path, student, results, hour_latency):
+    """
+    Write the agreement, F1 and latency of the student against its teachers.
+
+    :param path: Path of the report.
+    :param student: LinearStudent.
+    :param results: Dictionary of model -> dictionary with the F1 on val_predictions.json ('f1'), the
+        agreement of the student with the model ('agreement') and the validation latency ('predict').
+    :param hour_latency: Seconds of a single hour prediction of the student.
+    :return: Report text.
+    """
+    lines = [
+        'Distilled linear student',
+        '',
+        f"Features: {', '.join(student.features)}",
+        f"Size: {student.coef.nbytes + student.intercept.nbytes} bytes of coefficients",
+        f"Single hour latency: {hour_latency * 1e6:.1f} us",
+        '',
+        f"{'model':<14} {'F1':>7} {'agreement':>10} {'predict (ms)':>13}",
+    ]
+    for name, result in results.items():
+        lines.append(f"{name:<14} {result['f1']:>7.4f} {result['agreement']:>10.4f} {result['predict'] * 1e3:>13.2f}")
+    report = '\n'.join(lines)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(report + '\n')
+    return report
+
+### MAIN ###
+
+def main():
+    parser = argparse.ArgumentParser(description='Distill the ensemble into a linear student')
+    parser.add_argument('--weights', type=str, nargs='+', default=['xgboost_reg=1', 'lightgbm_reg=1', 'lstm=1'], help='Teacher members and their weights as name=weight')
+    parser.add_argument('--alpha', type=float, default=1.0, help='L2 penalty of the student coefficients')
+    parser.add_argument('--repeats', type=int, default=1000, help='Number of timed single hour predictions')
+    args = parser.parse_args()
+
+    # The teachers are only imported to distill them, the student only needs numpy
+    from src.data.prepare_data import load_data
+    from src.definitions import (
+        XGBOOST_LAGS,
+        LIGHTGBM_LAGS,
+    )
+    from src.model.ensemble import (
+        EnsemblePredictor,
+        parse_weights,
+    )
+    from src.model.forecasting.xgboost.model_training import prepare_data
+    from src.model.predict import (
+        MODELS,
+        SharedFeatures,
+        predict_student,
+    )
+
+    try:
+        weights = parse_weights(args.weights)
+    except ValueError as e:
+        parser.error(str(e))
+
+    train, validation = load_data()
+    lags = sorted(set(XGBOOST_LAGS) | set(LIGHTGBM_LAGS))
+    train_features = SharedFeatures(prepare_data(train, lags=lags))
+    validation_features = SharedFeatures(prepare_data(validation, lags=lags))
+    panel = validation_features.panel
+
+    # Fit the student on the forecasts of the ensemble of the training data
+    ensemble = EnsemblePredictor(weights)
+    teacher, _ = ensemble.predict(train_features)
+    train_panel = train_features.panel
+    student = LinearStudent.fit(train_panel.values, teacher, train_panel.features, train_panel.regions, args.alpha)
+    student.save()
+    print(f"Student saved to {STUDENT_PATH}")
+
+    # Forecasts and latency of the teachers and the student on the validation data
+    def timed(predict):
+        start = time.perf_counter()
+        forecasts = predict()
+        return forecasts, time.perf_counter() - start
+
+    outputs = {'ensemble': timed(lambda: ensemble.predict(validation_features)[0])}
+    for name in weights:
+        outputs[name] = timed(lambda: MODELS[name][2](ensemble.members[name], validation_features)[:, :, 0])
+    outputs['student'] = timed(lambda: predict_student(student, validation_features)[:, :, 0])
+    ensemble.close()
+
+    hour = panel.values[-1]
+    student.predict(hour)
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        student.predict(hour)
+    hour_latency = (time.perf_counter() - start) / args.repeats
+
+    actual = pd.read_json(os.path.join(PREDICTIONS_DIR, 'val_predictions.json'))
+    student_forecasts = outputs['student'][0]
+    results = {
+        name: {
+            'f1': get_f1(panel, forecasts, actual),
+            'agreement': get_agreement(panel, student_forecasts, forecasts),
+            'predict': latency,
+        }
+        for name, (forecasts, latency) in outputs.items()
+    }
+    print(write_report(os.path.join(REPORTS_DIR, 'distillation_report.txt'), student, results, hour_latency))
+
+    predictions_path = os.path.join(PREDICTIONS_DIR, 'student_predictions.json')
+    os.makedirs(PREDICTIONS_DIR, exist_ok=True)
+    panel.to_predictions_frame(student_forecasts).to_json(predictions_path, orient='records')
+    print(f"Predictions saved to {predictions_path}")
+
+if __name__ == '__main__':
+    main()
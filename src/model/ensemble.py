@@ -0,0 +1,269 @@
+"""
+Script to predict with a weighted ensemble of the surplus forecasters.
+
+The member forecasts of the next hour are blended cell by cell, (timestamp x region), before the
+maximum surplus region is taken. The members run concurrently, so the ensemble takes about as long
+as its slowest member instead of the sum of them:
+
+- The boosting members run in a thread pool. XGBoost and LightGBM release the GIL in their C++
+  cores, so their predictions overlap.
+- The torch members (LSTM, TCN) run in their own single-thread worker, so they do not compete with
+  the boosters for the pool and torch keeps its intra-op threads.
+
+Every member has the same deadline. Members that miss it or fail are left out and the weights of the
+others are renormalized. If no member is ready by then, the ensemble waits for the first member to
+forecast and uses its forecasts alone. A member that timed out is cancelled if it has not started.
+Otherwise it keeps running in the background, because Python threads cannot be interrupted, and it
+is left out of the next predictions until it finishes, so late calls do not pile up in the workers.
+"""
+# General imports
+import argparse
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    TimeoutError,
+    wait,
+)
+import os
+import threading
+import time
+
+# Data related imports
+import numpy as np
+import pandas as pd
+import torch
+
+# Local imports
+from src.definitions import (
+    PREDICTIONS_DIR,
+    PROCESSED_DATA_DIR,
+    XGBOOST_LAGS,
+    LIGHTGBM_LAGS,
+)
+from src.model.forecasting.xgboost.model_training import prepare_data
+from src.model.predict import (
+    MODELS,
+    SharedFeatures,
+)
+from src.config import setup_logger
+
+# Setup logger
+logger = setup_logger()
+
+TORCH_MODELS = ('lstm', 'tcn')
+MEMBERS = tuple(name for name in MODELS if name != 'xgboost_cls')  # Every surplus forecaster
+
+### GENERAL FUNCTIONS ###
+
+def parse_weights(values):
+    """
+    Parse member weights given as name=weight strings.
+
+    :param values: List of 'name=weight' strings.
+    :return: Dictionary of member name -> weight.
+    """
+    weights = {}
+    for value in values:
+        name, _, weight = value.partition('=')
+        if name not in MEMBERS:
+            raise ValueError(f"Invalid ensemble member {name}, expected one of {MEMBERS}")
+        weights[name] = float(weight) if weight else 1.0
+    return weights
+
+def combine(forecasts, weights):
+    """
+    Get the weighted mean of the member forecasts. Every cell is averaged over the members that
+    forecast it, with their weights renormalized.
+
+    :param forecasts: Dictionary of member name -> (timestamp x region) forecasts, NaN where missing.
+    :param weights: Dictionary of member name -> weight.
+    :return: Array (timestamp x region) with the ensemble forecasts, NaN where no member forecasts.
+    """
+    stacked = np.stack(list(forecasts.values()))
+    cell_weights = np.array([weights[name] for name in forecasts])[:, None, None] * ~np.isnan(stacked)
+    total = cell_weights.sum(axis=0)
+    blended = np.nansum(stacked * cell_weights, axis=0) / np.where(total > 0, total, 1)
+    return np.where(total > 0, blended, np.nan)
+
+### ENSEMBLE ###
+
+class EnsemblePredictor:
+    """
+    Weighted ensemble of surplus forecasters predicting concurrently.
+
+    :param weights: Dictionary of member name (in MODELS) -> weight.
+    :param timeout: Seconds every member has to forecast, None to wait for all of them.
+    :param paths: Dictionary of member name -> artifact path, the default artifacts otherwise.
+    :param models: Registry of member name -> (path, load, predict), as MODELS.
+    """
+    def __init__(self, weights, timeout=None, paths=None, models=MODELS):
+        paths = paths or {}
+        self.weights = weights
+        self.timeout = timeout
+        self.models = models
+        self.members = {name: models[name][1](paths.get(name, models[name][0])) for name in weights}
+        self.running = {}  # Member name -> future of a previous call still running after its deadline
+
+        boosters = [name for name in weights if name not in TORCH_MODELS]
+        self.booster_executor = ThreadPoolExecutor(max_workers=max(1, len(boosters)), thread_name_prefix='ensemble-gbm')
+        self.torch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ensemble-torch')
+
+    def _forecast(self, name, features):
+        return self.models[name][2](self.members[name], features)[:, :, 0]
+
+    def _fallback(self, futures):
+        """
+        Wait for the first member to forecast, skipping those that fail.
+        """
+        pending = set(futures.values())
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for name, future in futures.items():
+                if future not in done:
+                    continue
+                if future.exception() is None:
+                    logger.warning(f"No ensemble member met the deadline, falling back to {name}")
+                    return {name: future.result()}
+                logger.error(f"Ensemble member {name} failed: {future.exception()!r}")
+        raise RuntimeError("No ensemble member could forecast")
+
+    def predict(self, features):
+        """
+        Forecast the next hour surplus of every region with the members ready before the deadline.
+
+        :param features: SharedFeatures of the prediction data.
+        :return: Array (timestamp x region) with the ensemble forecasts, and the names of the members used.
+        """
+        start = time.perf_counter()
+        futures = {}
+        for name in self.members:
+            if name in self.running and not self.running[name].done():
+                logger.warning(f"Ensemble member {name} is still running a previous forecast, left out")
+                continue
+            executor = self.torch_executor if name in TORCH_MODELS else self.booster_executor
+            futures[name] = executor.submit(self._forecast, name, features)
+
+        forecasts, failed = {}, set()
+        for name, future in futures.items():
+            remaining = None if self.timeout is None else max(0.0, start + self.timeout - time.perf_counter())
+            try:
+                forecasts[name] = future.result(timeout=remaining)
+            except TimeoutError:
+                logger.warning(f"Ensemble member {name} missed the {self.timeout}s deadline")
+            except Exception:
+                logger.exception(f"Ensemble member {name} failed")
+                failed.add(name)
+
+        if not forecasts:
+            forecasts = self._fallback({name: future for name, future in futures.items() if name not in failed})
+
+        # Late members that have not started are cancelled, the running ones are not called again until they finish
+        for name, future in futures.items():
+            if name not in forecasts:
+                future.cancel()
+        # Merged with the members left out of this call, which are still running their previous one
+        self.running = {name: future for name, future in {**self.running, **futures}.items() if not future.done()}
+        return combine(forecasts, self.weights), list(forecasts)
+
+    def close(self):
+        self.booster_executor.shutdown(wait=True)
+        self.torch_executor.shutdown(wait=True)
+
+### CHECK ###
+
+def check_running(calls=4, timeout=0.05, delay=1.0):
+    """
+    Check that a member slower than the deadline has a single call in flight over consecutive
+    predictions, so that it does not crowd the fast members out of the booster pool.
+
+    :param calls: Number of consecutive predictions, all made while the first slow call runs.
+    :param timeout: Deadline of the ensemble in seconds.
+    :param delay: Seconds every call of the slow member takes.
+    :return: Maximum number of calls of the slow member running at once.
+    :raises AssertionError: If the slow member runs more than once at a time or the fast one misses a deadline.
+    """
+    lock = threading.Lock()
+    in_flight = {'current': 0, 'max': 0}
+
+    def predict_slow(model, features):
+        with lock:
+            in_flight['current'] += 1
+            in_flight['max'] = max(in_flight['max'], in_flight['current'])
+        time.sleep(delay)
+        with lock:
+            in_flight['current'] -= 1
+        return np.zeros((1, 1, 1))
+
+    models = {
+        'slow': (None, lambda path: None, predict_slow),
+        'fast': (None, lambda path: None, lambda model, features: np.ones((1, 1, 1))),
+    }
+    ensemble = EnsemblePredictor({'slow': 1, 'fast': 1}, timeout, models=models)
+    try:
+        for call in range(calls):
+            _, used = ensemble.predict(None)
+            assert used == ['fast'], f"Call {call} used {used}, expected only the fast member"
+    finally:
+        ensemble.close()
+    assert in_flight['max'] == 1, f"The slow member had {in_flight['max']} calls running at once"
+    return in_flight['max']
+
+### MAIN ###
+
+def main():
+    parser = argparse.ArgumentParser(description='Predict with a weighted ensemble of the surplus forecasters')
+    parser.add_argument('--weights', type=str, nargs='+', default=['xgboost_reg=1', 'lightgbm_reg=1', 'lstm=1'], help='Members and their weights as name=weight')
+    parser.add_argument('--timeout', type=float, default=None, help='Seconds every member has to forecast (default: wait for all)')
+    parser.add_argument('--data', type=str, default=os.path.join(PROCESSED_DATA_DIR, 'validation.csv'), help='Path to prediction data')
+    parser.add_argument('--threads', type=int, default=None, help='Number of intra-op threads of the torch members')
+    parser.add_argument('--repeats', type=int, default=10, help='Number of timed predictions, after a warm-up one')
+    parser.add_argument('--check', action='store_true', help='Check that a member slower than the deadline is not called again while it runs, then exit')
+    args = parser.parse_args()
+
+    if args.check:
+        check_running()
+        print("A slow member kept a single call in flight over consecutive predictions")
+        return
+
+    try:
+        weights = parse_weights(args.weights)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    df = pd.read_csv(args.data, parse_dates=['timestamp'])
+    panel = prepare_data(df, lags=sorted(set(XGBOOST_LAGS) | set(LIGHTGBM_LAGS)))
+    features = SharedFeatures(panel)
+    ensemble = EnsemblePredictor(weights, args.timeout)
+
+    # The warm-up builds the shared matrices and measures the member latencies
+    forecasts, used = ensemble.predict(features)
+    timings = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        forecasts, used = ensemble.predict(features)
+        timings.append(time.perf_counter() - start)
+    ensemble.close()
+
+    member_timings = {name: [] for name in weights}
+    for _ in range(args.repeats):
+        for name in weights:
+            start = time.perf_counter()
+            MODELS[name][2](ensemble.members[name], features)
+            member_timings[name].append(time.perf_counter() - start)
+
+    lines = [f"{'model':<14} {'latency (ms)':>13}"]
+    for name, member_timing in member_timings.items():
+        lines.append(f"{name:<14} {np.median(member_timing) * 1e3:>13.1f}")
+    lines.append(f"{'sequential':<14} {sum(np.median(timing) for timing in member_timings.values()) * 1e3:>13.1f}")
+    lines.append(f"{'ensemble':<14} {np.median(timings) * 1e3:>13.1f}")
+    print('\n'.join(lines))
+
+    predictions_path = os.path.join(PREDICTIONS_DIR, 'ensemble_predictions.json')
+    os.makedirs(PREDICTIONS_DIR, exist_ok=True)
+    panel.to_predictions_frame(forecasts).to_json(predictions_path, orient='records')
+    print(f"Predictions of {', '.join(used)} saved to {predictions_path}")
+
+if __name__ == '__main__':
+    main()
@@ -3,9 +3,11 @@ Script to make predictions using an XGBoost trained model for regression.
 """
 # General imports
 import argparse
+import json
 import os
 
 # Data related imports
+import numpy as np
 import lightgbm as lgb
 
 # Local imports
@@ -13,20 +15,47 @@ from src.definitions import (
     PREDICTIONS_DIR,
     LIGHTGBM_LAGS,
 )
-from src.data.prepare_data import load_data
-from src.model.forecasting.lightgbm.model_training import prepare_data
+from src.data.prepare_data import (
+    load_data,
+    get_panel_features,
+)
+from src.model.forecasting.lightgbm.model_training import (
+    get_horizons_path,
+    prepare_data,
+    stack_horizons,
+)
+from src.model.partitioning import PartitionedModel
 
 ### GENERAL FUNCTIONS ###
 
 def load_lgb_model(model_path):
+    if os.path.isdir(model_path):
+        # Partitioned model, which routes every region to its own booster
+        return PartitionedModel.load(model_path)
     model = lgb.Booster(model_file=model_path)
     return model
 
+def load_horizons(model_path, feature_names):
+    """
+    Load the forecast horizons saved with a model by the training.
+
+    :param model_path: Path of the model file or partitioned model directory.
+    :param feature_names: Features of the model. Multi-horizon models have a 'horizon' feature.
+    :return: List of horizons.
+    """
+    path = get_horizons_path(model_path)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    if 'horizon' in feature_names:
+        raise ValueError(f"Multi-horizon model {model_path} has no horizons file {path}, retrain it")
+    return [1]
+
 ### MAIN ###
 
 def main():
     parser = argparse.ArgumentParser(description='Make predictions using LightGBM')
-    parser.add_argument('--model', type=str, help='Path to model')
+    parser.add_argument('--model', type=str, help='Path to model, or to the directory of a partitioned model')
     args = parser.parse_args()
 
     model_path = args.model
@@ -35,21 +64,28 @@ def main():
     # Load and prepare prediction data
     _, validation = load_data()
     validation = prepare_data(validation, lags=LIGHTGBM_LAGS)
-    x_predict = validation.drop(['timestamp', 'series_id'], axis=1)  # Drop non-feature columns
+    x_predict, mask = get_panel_features(validation)
+    horizons = load_horizons(model_path, (next(iter(model.models.values())) if isinstance(model, PartitionedModel) else model).feature_name())
+    if len(horizons) > 1:
+        x_predict = stack_horizons(x_predict, horizons)
 
-    # Make predictions
-    predictions = model.predict(x_predict)
+    # Make predictions, rows with zero or missing surplus are not forecasted
+    predictions = model.predict(x_predict).reshape(len(horizons), -1).T
+    predictions[~mask] = np.nan
 
-    # Convert predictions back to original format
-    validation['predicted_surplus'] = predictions
-    pivoted_df = validation.pivot(index='timestamp', columns='series_id', values='predicted_surplus')
+    # Multi-horizon models forecast 1..horizons hours ahead, the next hour is the first horizon
+    forecasts = validation.unstack(predictions)
+    if len(horizons) > 1:
+        horizon_df = validation.to_horizon_predictions_frame(forecasts, horizons)
+        horizon_path = os.path.join(PREDICTIONS_DIR, 'lightgbm_reg_horizon_predictions.json')
+        horizon_df.to_json(horizon_path, orient='records')
+        print(f"Multi-horizon predictions saved to {horizon_path}")
 
-    # Get the maximum country code for each row (timestamp)
-    max_col = pivoted_df.idxmax(axis=1)
-    pivoted_df['target'] = max_col
+    # Get the maximum country code for each timestamp from the (timestamp x region) forecasts
+    predictions_df = validation.to_predictions_frame(forecasts[:, :, 0])
 
     predictions_path = os.path.join(PREDICTIONS_DIR, 'lightgbm_reg_predictions.json')
-    pivoted_df.reset_index()[['timestamp', 'target']].to_json(predictions_path, orient='records')
+    predictions_df.to_json(predictions_path, orient='records')
 
     print(f"Predictions saved to {predictions_path}")
 
@@ -5,35 +5,54 @@ Script to train a regression model using LightGBM.
 import argparse
 import json
 import os
+import time
 import warnings
 warnings.filterwarnings('ignore', category=FutureWarning)
 
 # Data related imports
 import numpy as np
+import pandas as pd
 import lightgbm as lgb
 from sklearn.metrics import mean_squared_error
-from sklearn.model_selection import (
-    train_test_split, 
-    GridSearchCV,
-)
+from sklearn.model_selection import train_test_split
 
 # Local imports
 from src.data.prepare_data import (
     load_data,
-    add_is_weekend,
     get_surplus,
-    get_forecast_target,
-    convert_to_timeseries,
-    get_lags,
-    add_is_holiday,
-    get_ohe_from_cat,
+    get_panel,
+    get_panel_features,
+    get_panel_lags,
+    get_panel_horizon_targets,
+    add_panel_calendar,
 )
+from src.data.calendar_features import CALENDAR_FEATURES
 from src.definitions import (
     MODELS_DIR, 
-    SEED, 
+    REPORTS_DIR,
     VAL_SIZE,
     LIGHTGBM_LAGS,
 )
+from src.model.tuning import (
+    TUNERS,
+    get_configs,
+    tune,
+)
+from src.model.artifacts import save_artifact
+from src.model.partitioning import (
+    PartitionedModel,
+    get_partitions,
+    get_partition_rows,
+    fit_partitions,
+    evaluate,
+    write_report,
+)
+from src.model.gbm_datasets import (
+    get_folds,
+    get_lgb_dataset,
+    get_lgb_params,
+    take,
+)
 from src.config import setup_logger
 
 # Setup logger
@@ -47,28 +66,130 @@ def prepare_data(df, lags):
     
     :param df: DataFrame containing the data.
     :param lags: List of lags to use for the model.
+    :return: Panel with the features of every region.
     """
-    df = add_is_weekend(df)
     df = get_surplus(df)
-    df = convert_to_timeseries(df, metadata_columns=['is_weekend'])
-    df = get_lags(df, lags=lags)
-    df = add_is_holiday(df)
-    df = get_ohe_from_cat(df, cat='series_id')
 
-    df = df.replace(0, np.nan)  # Replace 0s with NaNs
-    df.dropna(inplace=True)  # Drop rows with NaNs created by lagging and shifting
-    return df
+    lag_features = [f'surplus_lag_{lag}' for lag in lags]
+    panel = get_panel(df, features=['surplus'] + lag_features + CALENDAR_FEATURES)
+    panel = get_panel_lags(panel, lags=lags)
+    panel = add_panel_calendar(panel)
+    return panel
+
+def get_horizons_path(model_path):
+    """
+    Get the path of the file with the horizons of a model file or partitioned model directory,
+    saved next to it (model.txt -> model_horizons.json).
+    """
+    return os.path.splitext(model_path.rstrip(os.sep))[0] + '_horizons.json'
+
+def save_horizons(model_path, horizons):
+    """
+    Save the horizons of a model next to it, as a versioned artifact.
+
+    :param model_path: Path of the model file or partitioned model directory.
+    :param horizons: List of horizons.
+    :return: Path of the saved version.
+    """
+    def save(path):
+        with open(path, 'w') as f:
+            json.dump(horizons, f)
+    return save_artifact(get_horizons_path(model_path), save)
+
+def stack_horizons(features, horizons):
+    """
+    Stack the feature matrix once per horizon, adding the horizon as a feature.
+
+    LightGBM has no multi-output objective, so the direct multi-horizon forecast is learnt by a single
+    model conditioned on the horizon. Row k * n + i of the output holds row i for horizons[k].
+
+    :param features: Feature DataFrame with n rows.
+    :param horizons: List of horizons.
+    :return: Stacked feature DataFrame.
+    """
+    stacked = pd.concat([features] * len(horizons), ignore_index=True)
+    stacked['horizon'] = np.repeat(horizons, len(features))
+    return stacked
+
+def get_train_fn(fit_set, x_tune, y_tune):
+    """
+    Get the training function of the tuner, which continues boosting a model up to a number of rounds.
+
+    :param fit_set: lgb.Dataset to fit the models.
+    :param x_tune: Features to score the models.
+    :param y_tune: Target to score the models.
+    :return: Function (config, budget, state) -> (validation MSE, booster).
+    """
+    def train_fn(config, budget, state):
+        if state is None:
+            params, _ = get_lgb_params(config)
+            state = lgb.train(params, fit_set, num_boost_round=budget, keep_training_booster=True)
+        else:
+            # The booster keeps its training data, so it continues boosting where it stopped
+            for _ in range(budget - state.current_iteration()):
+                state.update()
+        return mean_squared_error(y_tune, state.predict(x_tune)), state
+    return train_fn
+
+def grid_search(x_train, y_train, train_set, param_grid, n_splits=2):
+    """
+    Score every configuration of a grid with the mean MSE of a k-fold cross-validation, as
+    GridSearchCV does, on fold subsets of the binned training dataset.
+
+    Each configuration is boosted once per fold up to the largest n_estimators of the grid, the
+    smaller ones are scored on the first rounds of the same model.
+
+    :param x_train: Training features.
+    :param y_train: Training target.
+    :param train_set: lgb.Dataset of the training data.
+    :param param_grid: Dictionary of LGBMRegressor parameter names to lists of values, with n_estimators.
+    :param n_splits: Number of folds.
+    :return: Best configuration and its mean MSE.
+    """
+    folds = [
+        (train_set.subset(fit), take(x_train, score), take(y_train, score))
+        for fit, score in get_folds(len(y_train), n_splits)
+    ]
+    n_estimators = sorted(param_grid['n_estimators'])
+    results = []
+    for config in get_configs({key: values for key, values in param_grid.items() if key != 'n_estimators'}):
+        params, _ = get_lgb_params(config)
+        scores = np.zeros((len(folds), len(n_estimators)))
+        for i, (fit_set, x_score, y_score) in enumerate(folds):
+            booster = lgb.train(params, fit_set, num_boost_round=n_estimators[-1])
+            for j, rounds in enumerate(n_estimators):
+                scores[i, j] = mean_squared_error(y_score, booster.predict(x_score, num_iteration=rounds))
+        for j, rounds in enumerate(n_estimators):
+            results.append(({**config, 'n_estimators': rounds}, scores[:, j].mean()))
+            logger.info(f"Grid search {results[-1][0]}: mean MSE {results[-1][1]}")
+    return min(results, key=lambda result: result[1])
 
 ### MAIN ###
 
 def parser_add_arguments(parser):
     parser.add_argument('--use-grid', action='store_true', help='Use grid search for model tuning')
+    parser.add_argument('--tuner', type=str, default='grid', choices=TUNERS, help='Search used with --use-grid')
+    parser.add_argument('--horizons', type=int, default=1, help='Forecast 1..horizons hours ahead with a single model')
+    parser.add_argument('--early-stopping-rounds', type=int, default=50, help='Rounds without validation improvement before stopping (0 to disable)')
+    parser.add_argument('--cache', action='store_true', help='Load the binned training dataset from disk if the data is unchanged, save it otherwise')
+    parser.add_argument('--refresh', action='store_true', help='Append boosting rounds on the recent data to the current model instead of a full fit')
+    parser.add_argument('--refresh-hours', type=int, default=168, help='Latest hours of the training data boosted on with --refresh')
+    parser.add_argument('--refresh-rounds', type=int, default=50, help='Maximum number of rounds appended with --refresh')
+    parser.add_argument('--partition', action='store_true', help='Also fit one model per region (or cluster) and report it against the global one')
+    parser.add_argument('--clusters', type=int, default=None, help='Number of clusters of correlated regions with --partition (default: one model per region)')
+    parser.add_argument('--cpu-budget', type=int, default=None, help='Threads shared by the partition fits (default: number of cores)')
+    parser.add_argument('--partition-jobs', type=int, default=None, help='Number of concurrent partition fits (default: as many as the budget allows)')
     return parser
 
 def main():
     parser = argparse.ArgumentParser(description='Train LightGBM model')
     parser_add_arguments(parser)
     args = parser.parse_args()
+    if args.refresh and (args.use_grid or args.partition):
+        parser.error('--refresh continues the current model, it cannot be combined with --use-grid or --partition')
+    if args.refresh and args.cache:
+        # Datasets loaded from binary files have no raw data to compute the scores of the current model
+        parser.error('--refresh cannot be combined with --cache')
 
     # Load data
     train, _, = load_data()
@@ -76,58 +197,145 @@ def main():
     # Data Preparation
     logger.info("Preparing data...")
     train = prepare_data(train, lags=LIGHTGBM_LAGS)
-    train = get_forecast_target(train, prediction_horizon=1)
-    train.dropna(subset=['target'], inplace=True)
+    features, mask = get_panel_features(train)  # Rows with zero or missing surplus are masked out
+    horizons = list(range(1, args.horizons + 1))
+    target = get_panel_horizon_targets(train, horizons).reshape(-1, len(horizons))
+    mask &= ~np.isnan(target).any(axis=1)
 
+    # The latest rows are held out, so that early stopping is scored on the future of the training data
     x_train, x_val, y_train, y_val = train_test_split(
-        train.drop(['timestamp', 'target', 'series_id'], axis=1),
-        train['target'],
+        features[mask],
+        target[mask],
         test_size=VAL_SIZE,
-        random_state=SEED
+        shuffle=False,
     )
+    if args.refresh:
+        # The older rows are already learnt by the current model, long row t * regions + r is at timestamp t.
+        # The window ends at the last hour of the training rows, the validation hours are held out after it
+        hours = x_train.index // len(train.regions)
+        recent = hours > hours.max() - args.refresh_hours
+        if not recent.any():
+            parser.error(f"No training rows in the latest {args.refresh_hours} hours to refresh on")
+        x_train, y_train = x_train[recent], y_train[recent]
+        logger.info(f"Refreshing on the latest {args.refresh_hours} hours of the training rows ({len(x_train)} rows)")
+    val_rows = x_val.index.to_numpy()  # Long rows of the panel, lost by the stacking
+    if len(horizons) > 1:
+        x_train, x_val = stack_horizons(x_train, horizons), stack_horizons(x_val, horizons)
+    y_train, y_val = y_train.T.reshape(-1), y_val.T.reshape(-1)  # Horizon-major, aligned with the stacked features
 
+    # Bin the training data once, every fit below reuses its bins
     CONFIG_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'model_config.json')
+    with open(CONFIG_PATH, 'r') as f:
+        model_config = json.load(f)
+    train_set = get_lgb_dataset(x_train, y_train, get_lgb_params(model_config)[0], cache=args.cache)
+    val_set = lgb.Dataset(x_val, y_val, reference=train_set)
+
     if args.use_grid:
-        # Grid Search
-        param_grid = {
-            'n_estimators': [100, 500, 1000],
-            'num_leaves': [31, 50, 100],
-            'learning_rate': [0.01, 0.05, 0.1],
-        }
-        grid_search = GridSearchCV(
-            estimator=lgb.LGBMRegressor(),
-            param_grid=param_grid,
-            scoring='neg_mean_squared_error',
-            cv=2,
-            verbose=2
-        )
-        grid_search.fit(x_train, y_train)
-        best_model = grid_search.best_estimator_
+        if args.tuner != 'grid':
+            # Adaptive search over the boosting rounds, scored on the latest rows of the training data. The
+            # rows are stacked horizon-major, so the latest rows of every horizon are held out
+            n_rows = len(y_train) // len(horizons)
+            fit_rows, tune_rows = train_test_split(np.arange(n_rows), test_size=VAL_SIZE, shuffle=False)
+            offsets = np.arange(len(horizons))[:, None] * n_rows
+            fit_indexes, tune_indexes = (offsets + fit_rows).ravel(), (offsets + tune_rows).ravel()
+            configs = get_configs({
+                'num_leaves': [31, 50, 100],
+                'learning_rate': [0.01, 0.05, 0.1],
+            })
+            train_fn = get_train_fn(train_set.subset(fit_indexes), take(x_train, tune_indexes), take(y_train, tune_indexes))
+            best, _ = tune(args.tuner, configs, train_fn, min_budget=100, max_budget=1000)
+            best_config = {**best['config'], 'n_estimators': best['budget']}
+        else:
+            # Grid Search
+            param_grid = {
+                'n_estimators': [100, 500, 1000],
+                'num_leaves': [31, 50, 100],
+                'learning_rate': [0.01, 0.05, 0.1],
+            }
+            best_config, _ = grid_search(x_train, y_train, train_set, param_grid)
 
-        # Save grid search best parameters to config
+        # Save the best parameters to config, the model is refit on the whole training data below
+        model_config = lgb.LGBMRegressor(**best_config).get_params()
         with open(CONFIG_PATH, 'w') as f:
-            json.dump(best_model.get_params(), f)
-    else:
-        # Load model configuration
-        with open(CONFIG_PATH, 'r') as f:
-            model_config = json.load(f)
-
-        best_model = lgb.LGBMRegressor(**model_config)
-        
-        # Train model
-        print("Training model...")
-        best_model.fit(x_train, y_train)
+            json.dump(model_config, f)
+
+    # Train model, n_estimators is the maximum number of rounds with early stopping. The booster
+    # returned (and saved) only keeps the rounds up to the best iteration
+    logger.info("Training model...")
+    model_path = os.path.join(MODELS_DIR, 'forecasting', 'lightgbm', 'model.txt')
+    params, num_boost_round = get_lgb_params(model_config)
+    current_model, current_rounds = None, 0
+    if args.refresh:
+        # The saved model only has the rounds up to its best iteration, new rounds are appended to them
+        current_model = lgb.Booster(model_file=model_path)
+        current_rounds = current_model.current_iteration()
+        current_mse = mean_squared_error(y_val, current_model.predict(x_val))
+        logger.info(f"Validation MSE of the current model: {current_mse}")
+        num_boost_round = args.refresh_rounds
+    start = time.perf_counter()
+    best_model = lgb.train(
+        params, 
+        train_set, 
+        num_boost_round=num_boost_round, 
+        valid_sets=[val_set], 
+        valid_names=['validation'],
+        init_model=current_model,
+        callbacks=[lgb.early_stopping(args.early_stopping_rounds, verbose=False)] if args.early_stopping_rounds else None,
+    )
+    fit_time = time.perf_counter() - start
+    logger.info(f"Best iteration {best_model.current_iteration()} of {current_rounds + num_boost_round} rounds")
 
     # Validate model
     predictions = best_model.predict(x_val)
     val_mse = mean_squared_error(y_val, predictions)
     logger.info(f"Validation MSE: {val_mse}")
+    if args.refresh and val_mse >= current_mse:
+        # Even the first new round is worse, none is kept and no new version is saved
+        logger.info(f"The refresh does not improve the validation MSE ({current_mse}), the current model is kept")
+        return
 
     # Save Model
-    model_path = os.path.join(MODELS_DIR, 'forecasting', 'lightgbm', 'model.txt')
-    os.makedirs(os.path.dirname(model_path), exist_ok=True)
-    best_model.booster_.save_model(model_path)
-    logger.info(f"Model trained and saved at {model_path}")
+    version_path = save_artifact(model_path, best_model.save_model)
+    save_horizons(model_path, horizons)
+    logger.info(f"Model trained and saved at {model_path} (version {version_path})")
+
+    if args.partition:
+        # One model per partition with the same configuration, each early stopped on its own validation
+        # rows. The fit rows are subsets of the binned training dataset, which share its bins
+        partitions = get_partitions(train, args.clusters)
+
+        def fit_partition(name, regions, threads):
+            fit_set = train_set.subset(get_partition_rows(x_train, regions))
+            val_rows = get_partition_rows(x_val, regions)
+            return lgb.train(
+                {**params, 'num_threads': threads},
+                fit_set,
+                num_boost_round=num_boost_round,
+                valid_sets=[lgb.Dataset(take(x_val, val_rows), take(y_val, val_rows), reference=fit_set)],
+                callbacks=[lgb.early_stopping(args.early_stopping_rounds, verbose=False)] if args.early_stopping_rounds else None,
+            )
+
+        start = time.perf_counter()
+        models, fit_times = fit_partitions(fit_partition, partitions, args.cpu_budget, args.partition_jobs)
+        partitioned_model = PartitionedModel(models, partitions)
+        results = {
+            'global': {'fit': fit_time, **evaluate(best_model, x_val, y_val, train, val_rows)},
+            'partitioned': {'fit': time.perf_counter() - start, **evaluate(partitioned_model, x_val, y_val, train, val_rows)},
+        }
+        report = write_report(
+            os.path.join(REPORTS_DIR, 'lightgbm_partitioned_report.txt'),
+            f"LightGBM partitioned ({len(partitions)} partitions) vs global model",
+            partitions,
+            fit_times,
+            {name: len(get_partition_rows(x_train, regions)) for name, regions in partitions.items()},
+            results,
+        )
+        print(report)
+
+        partitioned_path = os.path.join(MODELS_DIR, 'forecasting', 'lightgbm', 'partitioned')
+        partitioned_model.save(partitioned_path)
+        save_horizons(partitioned_path, horizons)
+        logger.info(f"Partitioned model saved at {partitioned_path}")
 
 if __name__ == "__main__":
     main()
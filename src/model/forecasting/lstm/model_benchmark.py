@@ -0,0 +1,92 @@
+"""
+Script to benchmark the inference runtimes of a trained LSTM model.
+"""
+# General imports
+import argparse
+import os
+import time
+
+# Data related imports
+import numpy as np
+import torch
+
+# Local imports
+from src.definitions import (
+    MODELS_DIR,
+    LSTM_LAGS,
+    REGIONS,
+    SEED,
+)
+from src.model.forecasting.lstm.model_prediction import (
+    RUNTIMES,
+    load_runtime,
+)
+
+### GENERAL FUNCTIONS ###
+
+def benchmark(runtime, sequences, categories, repeats):
+    """
+    Time the forward pass of a runtime over one batch.
+
+    :param runtime: Callable (sequences, categories) -> forecasts.
+    :param sequences: Tensor (batch x lags x feature).
+    :param categories: Tensor (batch) with the region codes.
+    :param repeats: Number of timed forward passes, after a warm-up one.
+    :return: Median latency (seconds) and the forecasts.
+    """
+    with torch.no_grad():
+        output = runtime(sequences, categories)
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            runtime(sequences, categories)
+            timings.append(time.perf_counter() - start)
+    output = output.numpy() if isinstance(output, torch.Tensor) else output
+    return float(np.median(timings)), output
+
+### MAIN ###
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the LSTM inference runtimes')
+    parser.add_argument('--model', type=str, default=os.path.join(MODELS_DIR, 'forecasting', 'lstm', 'model.pth'), help='Path to model')
+    parser.add_argument('--runtimes', type=str, nargs='+', default=list(RUNTIMES), choices=RUNTIMES, help='Runtimes to compare')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 64, 10000], help='Batch sizes to time')
+    parser.add_argument('--threads', type=int, default=None, help='Number of intra-op threads of the runtimes')
+    parser.add_argument('--repeats', type=int, default=20, help='Number of timed forward passes per batch size')
+    args = parser.parse_args()
+
+    runtimes = {}
+    input_size = None
+    for name in args.runtimes:
+        try:
+            model, runtime = load_runtime(name, args.model, args.threads)
+        except (ImportError, FileNotFoundError, ValueError, RuntimeError) as e:
+            print(f"Skipping {name} runtime: {e}")
+            continue
+        runtimes[name] = runtime
+        input_size = runtime.input_size if model is None else model.input_size
+    if not runtimes:
+        parser.error('No runtime could be loaded')
+
+    # Random scaled inputs with the sizes of the model
+    rng = np.random.default_rng(SEED)
+
+    lines = [f"{'runtime':<12} {'batch':>6} {'latency (ms)':>13} {'sequences/s':>12} {'max abs diff':>13}"]
+    for batch_size in args.batch_sizes:
+        sequences = torch.from_numpy(rng.standard_normal((batch_size, LSTM_LAGS, input_size), dtype=np.float32))
+        categories = torch.from_numpy(rng.integers(len(REGIONS), size=batch_size))
+        repeats = max(3, args.repeats // max(1, batch_size // 1000))
+
+        reference = None
+        for name, runtime in runtimes.items():
+            latency, output = benchmark(runtime, sequences, categories, repeats)
+            if reference is None:
+                reference = output
+            lines.append(
+                f"{name:<12} {batch_size:>6} {latency * 1e3:>13.3f} {batch_size / latency:>12.0f} "
+                f"{np.abs(output - reference).max():>13.2e}"
+            )
+    print('\n'.join(lines))
+
+if __name__ == '__main__':
+    main()
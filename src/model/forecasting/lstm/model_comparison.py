@@ -0,0 +1,122 @@
+"""
+Script to compare the LSTM and the TCN forecasters on training time, inference latency and F1.
+
+Both are trained on the same sequences and scalers with the same hyperparameters, so the only
+difference between them is the architecture.
+"""
+# General imports
+import argparse
+import os
+import time
+
+# Data related imports
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import train_test_split
+import torch
+
+# Local imports
+from src.definitions import (
+    PREDICTIONS_DIR,
+    REPORTS_DIR,
+    VAL_SIZE,
+    SEED,
+    LSTM_LAGS,
+    REGIONS,
+)
+from src.data.prepare_data import load_data
+from src.data.scaling import SeriesScaler
+from src.model.forecasting.lstm.model_benchmark import benchmark
+from src.model.forecasting.lstm.model_quantization import get_f1
+from src.model.forecasting.lstm.model_training import (
+    prepare_data,
+    create_sequences,
+    build_model,
+    train_model,
+    BatchIterator,
+    MODEL_TYPES,
+)
+
+REPORT_PATH = os.path.join(REPORTS_DIR, 'lstm_tcn_comparison.txt')
+
+### MAIN ###
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the LSTM and TCN forecasters')
+    parser.add_argument('--model-types', type=str, nargs='+', default=list(MODEL_TYPES), choices=list(MODEL_TYPES), help='Forecasters to compare')
+    parser.add_argument('--hidden-size', type=int, default=50, help='Hidden layer size (LSTM units or TCN channels)')
+    parser.add_argument('--learning-rate', type=float, default=0.001, help='Learning rate of both forecasters')
+    parser.add_argument('--epochs', type=int, default=10, help='Number of training epochs')
+    parser.add_argument('--batch-size', type=int, default=64, help='Number of sequences per training batch')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 64, 10000], help='Batch sizes to time')
+    parser.add_argument('--threads', type=int, default=None, help='Number of intra-op threads')
+    parser.add_argument('--repeats', type=int, default=20, help='Number of timed forward passes per batch size')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    # Same sequences, split and scalers as model_training.py
+    train, validation = load_data()
+    train, validation = prepare_data(train), prepare_data(validation)
+    dataset = create_sequences(train, lags=LSTM_LAGS)
+    train_indexes, val_indexes = train_test_split(np.arange(len(dataset)), test_size=VAL_SIZE, shuffle=False)
+    train_data, val_data = dataset.subset(train_indexes), dataset.subset(val_indexes)
+
+    x_scaler, y_scaler = SeriesScaler(), SeriesScaler()
+    x_scaler.fit(dataset.values[train_data.positions, train_data.codes])
+    y_scaler.fit(train_data.labels())
+    dataset.scale(x_scaler)
+    y_scaler.transform(dataset.targets)
+
+    train_loader = BatchIterator(train_data, batch_size=args.batch_size, shuffle=True)
+    val_loader = BatchIterator(val_data, batch_size=max(args.batch_size, 4096))
+    actual = pd.read_json(os.path.join(PREDICTIONS_DIR, 'val_predictions.json'))
+
+    rng = np.random.default_rng(SEED)
+    inputs = {
+        batch_size: (
+            torch.from_numpy(rng.standard_normal((batch_size, LSTM_LAGS, dataset.values.shape[2]), dtype=np.float32)),
+            torch.from_numpy(rng.integers(len(REGIONS), size=batch_size)),
+        )
+        for batch_size in args.batch_sizes
+    }
+
+    results = {}
+    for model_type in args.model_types:
+        # Same initialization seed and batch order for every forecaster
+        torch.manual_seed(SEED)
+        np.random.seed(SEED)
+        model = build_model(model_type, dataset.values.shape[2], args.hidden_size, dataset.targets.shape[2], len(REGIONS))
+        start = time.perf_counter()
+        val_loss = train_model(model, train_loader, args.learning_rate, args.epochs, val_loader=val_loader, progress=False)
+        training_time = time.perf_counter() - start
+
+        model.eval()
+        f1 = get_f1(model, validation, x_scaler, y_scaler, 'per-region', actual)
+        latencies = [
+            benchmark(model, sequences, categories, max(3, args.repeats // max(1, batch_size // 1000)))[0]
+            for batch_size, (sequences, categories) in inputs.items()
+        ]
+        results[model_type] = (training_time, val_loss, f1, latencies)
+        print(f"{model_type}: trained in {training_time:.1f}s, validation loss {val_loss:.4f}, F1 {f1:.4f}")
+
+    lines = [f"{'model':<6} {'train (s)':>10} {'val loss':>9} {'F1':>7} " + ' '.join(f"{f'batch {b} (ms)':>16}" for b in args.batch_sizes)]
+    for model_type, (training_time, val_loss, f1, latencies) in results.items():
+        lines.append(
+            f"{model_type:<6} {training_time:>10.1f} {val_loss:>9.4f} {f1:>7.4f} "
+            + ' '.join(f"{latency * 1e3:>16.3f}" for latency in latencies)
+        )
+
+    report = '\n'.join(lines)
+    print(report)
+    os.makedirs(os.path.dirname(REPORT_PATH), exist_ok=True)
+    with open(REPORT_PATH, 'w') as f:
+        f.write(
+            f"LSTM vs TCN comparison ({args.epochs} epochs, hidden size {args.hidden_size}, "
+            f"learning rate {args.learning_rate})\n\n" + report + "\n"
+        )
+    print(f"Report saved to {REPORT_PATH}")
+
+if __name__ == '__main__':
+    main()
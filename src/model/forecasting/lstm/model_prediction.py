@@ -1,91 +1,255 @@
 """
 Script to make predictions using an LSTM trained model for forecasting.
+
+torch is only imported by the eager and torchscript runtimes, the onnx one only needs numpy and
+onnxruntime.
 """
 # General imports
 import argparse
-import joblib
-import json
 import os
 
 # Data related imports
 import numpy as np
-import torch
 
 # Local imports
 from src.definitions import (
     PREDICTIONS_DIR,
-    MODELS_DIR,
     LSTM_LAGS,
 )
 from src.data.prepare_data import load_data
-from src.model.forecasting.lstm.model_training import (
+from src.data.scaling import SeriesScaler
+from src.model.forecasting.lstm.sequences import (
     prepare_data, 
     create_sequences, 
-    LSTMModel,
+    get_window_mask,
+    predict_arrays,
+    get_artifact_path,
 )
 
+MODEL_TYPES = ('lstm', 'tcn')
+
 ### GENERAL FUNCTIONS ###
 
-def load_model(model_path, input_size):
-    # Model configuration
-    CONFIG_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'model_config.json')
-    with open(CONFIG_PATH, 'r') as f:
-        model_config = json.load(f)  # LSTM configuration
+def load_model(model_path):
+    import torch
+    from src.model.forecasting.lstm.model_training import (
+        LSTMModel,
+        TCNModel,
+    )
 
-    model = LSTMModel(input_size, model_config['hidden_layer_size'])
-    model.load_state_dict(torch.load(model_path))
+    # Sizes of the saved model: multi-output models forecast one value per horizon (and region for the
+    # joint architecture), which has no region embedding
+    state_dict = torch.load(model_path)
+    output_size = state_dict['linear.weight'].shape[0]
+    if 'blocks.0.conv1.weight' in state_dict:
+        # TCN: conv weights are (out channels x in channels x kernel size)
+        hidden_layer_size, input_size, kernel_size = state_dict['blocks.0.conv1.weight'].shape
+    else:
+        hidden_layer_size = state_dict['lstm1.weight_hh_l0'].shape[1]
+        input_size = state_dict['lstm1.weight_ih_l0'].shape[1]
+    num_categories = 0
+    if 'embedding.weight' in state_dict:
+        num_categories, embedding_dim = state_dict['embedding.weight'].shape
+        input_size -= embedding_dim
+
+    if 'blocks.0.conv1.weight' in state_dict:
+        model = TCNModel(input_size, hidden_layer_size, output_size=output_size, num_categories=num_categories, kernel_size=kernel_size)
+    else:
+        model = LSTMModel(input_size, hidden_layer_size, output_size=output_size, num_categories=num_categories)
+    model.load_state_dict(state_dict)
     model.eval()  # Set the model to evaluation mode
     return model
 
+def predict_panel(runtime, panel, x_scaler, y_scaler, architecture='per-region'):
+    """
+    Forecast every region of a panel. The panel values are scaled in place.
+
+    :param runtime: Model or runtime to use.
+    :param panel: Panel prepared with prepare_data.
+    :param x_scaler: Fitted SeriesScaler of the features.
+    :param y_scaler: Fitted SeriesScaler of the targets.
+    :param architecture: 'per-region' or 'joint', as the model was trained.
+    :return: Array (timestamp x region x horizon) with the forecasts, NaN for timestamps without a full sequence.
+    """
+    dataset = create_sequences(panel, lags=LSTM_LAGS, require_target=False, architecture=architecture)
+    window_mask = get_window_mask(panel, LSTM_LAGS)  # Before the scaling, which changes the zero and missing values
+
+    # Normalize the panel in place, the sequences are views of it
+    dataset.scale(x_scaler)
+
+    # Make predictions
+    if isinstance(runtime, OnnxRuntime):
+        predictions = predict_arrays(runtime, dataset)
+    else:
+        from src.model.forecasting.lstm.model_training import predict
+        predictions = predict(runtime, dataset)
+    predictions = y_scaler.inverse_transform(predictions)
+
+    # Scatter the predictions into (timestamp x region x horizon) forecasts
+    if architecture == 'joint':
+        # A single forward pass forecasts every region of the timestamp
+        predictions = predictions.reshape(len(predictions), len(panel.regions), -1)
+        forecasts = np.full(panel.shape[:2] + predictions.shape[2:], np.nan)
+        forecasts[dataset.positions] = predictions
+        forecasts[~window_mask] = np.nan
+    else:
+        forecasts = np.full(panel.shape[:2] + predictions.shape[1:], np.nan)
+        forecasts[dataset.positions, dataset.codes] = predictions
+    return forecasts
+
+### RUNTIMES ###
+
+RUNTIMES = ('eager', 'torchscript', 'onnx')
+
+class TorchScriptRuntime:
+    """
+    Runs the frozen TorchScript graph exported by model_training.py.
+
+    :param path: Path to the .pt graph.
+    :param output_size: Number of outputs of the model.
+    """
+    def __init__(self, path, output_size):
+        import torch
+        self.module = torch.jit.load(path)
+        self.output_size = output_size
+        self.joint = 'categories' not in [argument.name for argument in self.module.forward.schema.arguments]
+
+    def __call__(self, sequences, categories=None):
+        import torch
+        with torch.no_grad():
+            return self.module(sequences) if self.joint else self.module(sequences, categories)
+
+class OnnxRuntime:
+    """
+    Runs the ONNX graph exported by model_training.py with onnxruntime, which fuses the LSTM kernels
+    and does not need autograd nor torch. The sizes of the model are read from the graph.
+
+    :param path: Path to the .onnx graph.
+    :param threads: Number of intra-op threads, None for the onnxruntime default.
+    """
+    def __init__(self, path, threads=None):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("The onnx runtime requires the onnxruntime package (pip install onnxruntime)")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+        self.joint = 'categories' not in self.input_names
+        self.input_size = self.session.get_inputs()[0].shape[2]
+        self.output_size = self.session.get_outputs()[0].shape[1]
+
+    def __call__(self, sequences, categories=None):
+        inputs = {'sequences': np.asarray(sequences, dtype=np.float32)}
+        if 'categories' in self.input_names:
+            inputs['categories'] = np.asarray(categories, dtype=np.int64)
+        return self.session.run(None, inputs)[0]
+
+def load_runtime(runtime, model_path, threads=None, quantize=False):
+    """
+    Load the model to run with a runtime.
+
+    :param runtime: 'eager' for the PyTorch module, 'torchscript' or 'onnx' for the graphs exported next to it.
+    :param model_path: Path to the model weights (.pth).
+    :param threads: Number of intra-op threads, None for the default.
+    :param quantize: Whether to use the dynamic int8 quantized model (eager and torchscript runtimes).
+    :return: Eager model (None for the onnx runtime, which does not load torch) and the callable
+        (sequences, categories) -> forecasts of the runtime.
+    """
+    graph_path = os.path.splitext(model_path)[0]
+    if runtime == 'onnx':
+        if quantize:
+            raise ValueError("Quantized models are only available for the eager and torchscript runtimes")
+        return None, OnnxRuntime(f'{graph_path}.onnx', threads)
+    if runtime not in RUNTIMES:
+        raise ValueError("Invalid runtime")
+
+    import torch
+    from src.model.forecasting.lstm.model_training import quantize_model
+    if threads:
+        torch.set_num_threads(threads)
+
+    model = load_model(model_path)
+    if quantize:
+        model = quantize_model(model)
+        graph_path += '_int8'
+    if runtime == 'eager':
+        return model, model
+    return model, TorchScriptRuntime(f'{graph_path}.pt', model.output_size)
+
 ### MAIN ###
 
 def main():
     parser = argparse.ArgumentParser(description='Make predictions using LSTM')
-    parser.add_argument('--model', type=str, help='Path to model')
+    parser.add_argument('--model-type', type=str, default='lstm', choices=list(MODEL_TYPES), help='Type of the trained forecaster')
+    parser.add_argument('--model', type=str, help='Path to model, the one trained for --model-type by default')
     parser.add_argument('--data', type=str, help='Path to prediction data')
+    parser.add_argument('--runtime', type=str, default='eager', choices=RUNTIMES, help='Runtime of the model, torchscript and onnx use the graphs exported at training')
+    parser.add_argument('--threads', type=int, default=None, help='Number of intra-op threads of the runtime')
+    parser.add_argument('--quantize', action='store_true', help='Use the dynamic int8 quantized model')
+    parser.add_argument('--stream', action='store_true', help='Feed the data hour by hour to a streaming model')
+    parser.add_argument('--stateful', action='store_true', help='Use the stateful LSTM trained with --stateful')
     args = parser.parse_args()
+    if args.stateful and (args.model_type != 'lstm' or args.runtime != 'eager' or args.quantize):
+        parser.error('--stateful is only available for the eager LSTM runtime without --quantize')
 
     # Load and prepare prediction data
     _, validation = load_data()
     validation = prepare_data(validation)
-    x_predict, _ = create_sequences(validation.drop(['timestamp', 'series_id'], axis=1), lags=LSTM_LAGS)
     
     # Load the saved scalers
-    x_scaler_path = os.path.join(MODELS_DIR, 'forecasting/lstm', 'x_scaler.pkl')
-    x_scaler = joblib.load(x_scaler_path)
-
-    # Normalize x_predict using the loaded scaler
-    x_predict_scaled = x_scaler.transform(x_predict.reshape(-1, x_predict.shape[2]))
-    x_predict_scaled = x_predict_scaled.reshape(-1, LSTM_LAGS, x_predict.shape[2])
+    prefix = 'stateful_' if args.stateful else ''
+    x_scaler_path = get_artifact_path(args.model_type, prefix + 'x_scaler.npz')
+    x_scaler = SeriesScaler.load(x_scaler_path)
+    y_scaler_path = get_artifact_path(args.model_type, prefix + 'y_scaler.npz')
+    y_scaler = SeriesScaler.load(y_scaler_path)
 
-    # Convert to PyTorch tensor
-    x_predict_tensor = torch.tensor(x_predict_scaled, dtype=torch.float32)
+    model_path = args.model or get_artifact_path(args.model_type, prefix + 'model.pth')
+    model, runtime = load_runtime(args.runtime, model_path, args.threads, args.quantize)
+    joint = runtime.joint if model is None else model.embedding is None
+    architecture = 'joint' if joint else 'per-region'
 
-    model_path = args.model
-    input_size = x_predict.shape[2]
-    model = load_model(model_path, input_size)
+    if args.stateful or args.stream:
+        from src.model.forecasting.lstm.model_training import LSTMModel
+        from src.model.forecasting.lstm.streaming import (
+            StreamingLSTM,
+            predict_stream,
+        )
 
-    # Make predictions
-    with torch.no_grad():
-        predictions = model(x_predict_tensor).numpy()
-
-    y_scaler_path = os.path.join(MODELS_DIR, 'forecasting/lstm', 'y_scaler.pkl')
-    y_scaler = joblib.load(y_scaler_path)
-    predictions = y_scaler.inverse_transform(predictions)
+    if args.stateful:
+        if args.stream:
+            # Forecasts issued as each hour arrives, one step of the carried states per hour
+            streamer = StreamingLSTM(model, x_scaler, y_scaler, n_regions=len(validation.regions), stateful=True)
+            forecasts = np.stack([streamer.step(rows) for rows in validation.values])
+        else:
+            forecasts = predict_stream(model, validation, x_scaler, y_scaler)
+    elif args.stream:
+        if architecture == 'joint' or not isinstance(model, LSTMModel):
+            parser.error('--stream is only available for the per-region LSTM of the eager and torchscript runtimes')
 
-    # Ignore first LSTM_LAGS rows of validation by adding LSTM_LAGS nan predictions with (n, 1) shape
-    predictions = np.concatenate([np.full((LSTM_LAGS, 1), np.nan), predictions])
+        # Forecasts issued as each hour arrives, as in production
+        streamer = StreamingLSTM(model, x_scaler, y_scaler, n_regions=len(validation.regions))
+        forecasts = np.stack([streamer.step(rows) for rows in validation.values])
+    else:
+        forecasts = predict_panel(runtime, validation, x_scaler, y_scaler, architecture)
 
-    # Convert predictions back to original format
-    validation['predicted_surplus'] = predictions
-    pivoted_df = validation.pivot(index='timestamp', columns='series_id', values='predicted_surplus')
+    # Multi-output models forecast 1..horizons hours ahead, the next hour is the first horizon
+    if forecasts.shape[2] > 1:
+        horizons = list(range(1, forecasts.shape[2] + 1))
+        horizon_df = validation.to_horizon_predictions_frame(forecasts, horizons)
+        horizon_path = os.path.join(PREDICTIONS_DIR, f'{args.model_type}_horizon_predictions.json')
+        horizon_df.to_json(horizon_path, orient='records')
+        print(f"Multi-horizon predictions saved to {horizon_path}")
 
-    # Get the maximum country code for each row (timestamp)
-    max_col = pivoted_df.idxmax(axis=1)
-    pivoted_df['target'] = max_col
+    # Get the maximum country code for each timestamp
+    predictions_df = validation.to_predictions_frame(forecasts[:, :, 0])
 
-    predictions_path = os.path.join(PREDICTIONS_DIR, 'lstm_predictions.json')
-    pivoted_df.reset_index()[['timestamp', 'target']].to_json(predictions_path, orient='records')
+    predictions_path = os.path.join(PREDICTIONS_DIR, f'{args.model_type}_predictions.json')
+    predictions_df.to_json(predictions_path, orient='records')
 
     print(f"Predictions saved to {predictions_path}")
 
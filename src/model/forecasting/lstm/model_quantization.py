@@ -0,0 +1,113 @@
+"""
+Script to report the accuracy, latency and size of the dynamic int8 quantized LSTM against the float one.
+"""
+# General imports
+import argparse
+import copy
+import io
+import os
+
+# Data related imports
+import numpy as np
+import pandas as pd
+import torch
+
+# Local imports
+from src.definitions import (
+    PREDICTIONS_DIR,
+    MODELS_DIR,
+    REPORTS_DIR,
+    LSTM_LAGS,
+    REGIONS,
+    SEED,
+)
+from src.data.prepare_data import load_data
+from src.data.scaling import SeriesScaler
+from src.metrics import get_predictions_performance
+from src.model.forecasting.lstm.model_benchmark import benchmark
+from src.model.forecasting.lstm.model_prediction import (
+    load_runtime,
+    predict_panel,
+)
+from src.model.forecasting.lstm.model_training import prepare_data
+
+REPORT_PATH = os.path.join(REPORTS_DIR, 'lstm_quantization_report.txt')
+
+### GENERAL FUNCTIONS ###
+
+def get_size(model):
+    """
+    Get the serialized size in bytes of the weights of a model.
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+def get_f1(runtime, panel, x_scaler, y_scaler, architecture, actual):
+    """
+    Get the F1 score of the next hour predictions of a runtime against the actual values.
+    """
+    forecasts = predict_panel(runtime, copy.deepcopy(panel), x_scaler, y_scaler, architecture)
+    predictions = panel.to_predictions_frame(forecasts[:, :, 0])
+
+    # Same round trip as the predictions files read by src/metrics.py
+    predictions = pd.read_json(io.StringIO(predictions.to_json(orient='records')))
+    return get_predictions_performance(actual, predictions)[0]
+
+### MAIN ###
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the gains of the dynamic int8 quantized LSTM')
+    parser.add_argument('--model', type=str, default=os.path.join(MODELS_DIR, 'forecasting', 'lstm', 'model.pth'), help='Path to model')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 64, 10000], help='Batch sizes to time')
+    parser.add_argument('--threads', type=int, default=None, help='Number of intra-op threads')
+    parser.add_argument('--repeats', type=int, default=20, help='Number of timed forward passes per batch size')
+    args = parser.parse_args()
+
+    _, validation = load_data()
+    validation = prepare_data(validation)
+    x_scaler = SeriesScaler.load(os.path.join(MODELS_DIR, 'forecasting/lstm', 'x_scaler.npz'))
+    y_scaler = SeriesScaler.load(os.path.join(MODELS_DIR, 'forecasting/lstm', 'y_scaler.npz'))
+    actual = pd.read_json(os.path.join(PREDICTIONS_DIR, 'val_predictions.json'))
+
+    models = {
+        'float32': load_runtime('eager', args.model, args.threads)[1],
+        'int8': load_runtime('eager', args.model, args.threads, quantize=True)[1],
+    }
+    architecture = 'per-region' if models['float32'].embedding is not None else 'joint'
+
+    scores = {
+        name: (get_f1(model, validation, x_scaler, y_scaler, architecture, actual), get_size(model))
+        for name, model in models.items()
+    }
+    lines = [f"{'model':<8} {'F1':>8} {'size (KB)':>10}"]
+    for name, (f1, size) in scores.items():
+        lines.append(f"{name:<8} {f1:>8.4f} {size / 1024:>10.1f}")
+    lines.append(
+        f"F1 change: {scores['int8'][0] - scores['float32'][0]:+.4f}, "
+        f"size reduction: {scores['float32'][1] / scores['int8'][1]:.2f}x"
+    )
+
+    # Latency on random scaled inputs with the sizes of the model
+    model = models['float32']
+    rng = np.random.default_rng(SEED)
+    lines.append('')
+    lines.append(f"{'batch':>6} {'float32 (ms)':>13} {'int8 (ms)':>10} {'speedup':>8}")
+    for batch_size in args.batch_sizes:
+        sequences = torch.from_numpy(rng.standard_normal((batch_size, LSTM_LAGS, model.input_size), dtype=np.float32))
+        categories = torch.from_numpy(rng.integers(len(REGIONS), size=batch_size))
+        repeats = max(3, args.repeats // max(1, batch_size // 1000))
+        latencies = [benchmark(runtime, sequences, categories, repeats)[0] for runtime in models.values()]
+        lines.append(
+            f"{batch_size:>6} {latencies[0] * 1e3:>13.3f} {latencies[1] * 1e3:>10.3f} {latencies[0] / latencies[1]:>7.2f}x"
+        )
+
+    report = '\n'.join(lines)
+    print(report)
+    os.makedirs(os.path.dirname(REPORT_PATH), exist_ok=True)
+    with open(REPORT_PATH, 'w') as f:
+        f.write("LSTM dynamic int8 quantization report\n\n" + report + "\n")
+    print(f"Report saved to {REPORT_PATH}")
+
+if __name__ == '__main__':
+    main()
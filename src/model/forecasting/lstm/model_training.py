@@ -3,10 +3,17 @@ Enhanced script to train an LSTM model.
 """
 # General imports
 import argparse
+import importlib.util
+import inspect
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    as_completed,
+)
 from itertools import product
 import json
-import joblib
 import os
+import tempfile
+import time
 from tqdm import tqdm
 import warnings
 warnings.filterwarnings('ignore', category=FutureWarning)
@@ -14,29 +21,35 @@ warnings.filterwarnings('ignore', category=FutureWarning)
 # Data related imports
 import pandas as pd
 import numpy as np
-from sklearn.preprocessing import StandardScaler, MinMaxScaler
 from sklearn.model_selection import train_test_split
 import torch
 import torch.nn as nn
-from torch.utils.data import (
-    DataLoader, 
-    TensorDataset,
-)
 
 # Local imports
 from src.data.prepare_data import (
     load_data,
-    add_is_weekend,
-    get_surplus,
-    convert_to_timeseries,
-    add_is_holiday,
-    get_ohe_from_cat,
+    get_panel_horizon_targets,
 )
+from src.data.scaling import SeriesScaler
 from src.definitions import (
-    MODELS_DIR, 
     VAL_SIZE, 
     SEED,
     LSTM_LAGS,
+    REGIONS,
+)
+from src.model.artifacts import save_artifact
+from src.model.forecasting.lstm.sequences import (
+    get_artifact_path,
+    prepare_data,
+    SequenceDataset,
+    BatchIterator,
+    get_stream_inputs,
+    create_sequences,
+)
+from src.model.tuning import (
+    TUNERS,
+    get_configs,
+    tune,
 )
 from src.config import setup_logger
 
@@ -52,9 +65,16 @@ if torch.cuda.is_available():
 ### ARCHITECTURE ###
 
 class LSTMModel(nn.Module):
-    def __init__(self, input_size, hidden_layer_size=50, output_size=1):
+    def __init__(self, input_size, hidden_layer_size=50, output_size=1, num_categories=0, embedding_dim=4):
         super(LSTMModel, self).__init__()
+        self.input_size = input_size
         self.hidden_layer_size = hidden_layer_size
+        self.output_size = output_size
+
+        # Integer-coded region fed through an embedding instead of a one-hot block
+        self.embedding = nn.Embedding(num_categories, embedding_dim) if num_categories > 0 else None
+        if self.embedding is not None:
+            input_size += embedding_dim
 
         # Adding an additional LSTM layer and introducing dropout
         self.lstm1 = nn.LSTM(input_size, hidden_layer_size, batch_first=True)
@@ -63,7 +83,12 @@ class LSTMModel(nn.Module):
         self.dropout2 = nn.Dropout(0.2)
         self.linear = nn.Linear(hidden_layer_size, output_size)
 
-    def forward(self, input_seq):
+    def forward(self, input_seq, categories=None):
+        if self.embedding is not None:
+            # Repeat the sequence category embedding at every time step
+            embedded = self.embedding(categories).unsqueeze(1).expand(-1, input_seq.shape[1], -1)
+            input_seq = torch.cat([input_seq, embedded], dim=2)
+
         lstm_out1, _ = self.lstm1(input_seq)
         dropout_out1 = self.dropout1(lstm_out1)
         lstm_out2, _ = self.lstm2(dropout_out1)
@@ -73,61 +98,197 @@ class LSTMModel(nn.Module):
         predictions = self.linear(dropout_out2[:, -1, :])
         return predictions
 
-### GENERAL FUNCTIONS ###
+    def forward_steps(self, input_seq, categories=None, states=None):
+        """
+        Forecast at every step of the sequences, continuing from the (h, c) states of the two LSTM
+        layers, as the stateful model is trained and streamed.
+
+        :param input_seq: Tensor (batch x steps x feature).
+        :param categories: Tensor (batch) with the region codes.
+        :param states: States of lstm1 and lstm2 after the previous steps, None to start from zero.
+        :return: Tensor (batch x steps x output) with the forecasts, and the states after the last step.
+        """
+        if self.embedding is not None:
+            embedded = self.embedding(categories).unsqueeze(1).expand(-1, input_seq.shape[1], -1)
+            input_seq = torch.cat([input_seq, embedded], dim=2)
+
+        states = states or (None, None)
+        lstm_out1, states1 = self.lstm1(input_seq, states[0])
+        lstm_out2, states2 = self.lstm2(self.dropout1(lstm_out1), states[1])
+        return self.linear(self.dropout2(lstm_out2)), (states1, states2)
+
+class CausalConvBlock(nn.Module):
+    """
+    Residual block of two dilated causal convolutions: the output at step t only sees steps <= t.
+    """
+    def __init__(self, in_channels, out_channels, kernel_size, dilation, dropout=0.2):
+        super(CausalConvBlock, self).__init__()
+        self.padding = (kernel_size - 1) * dilation
+        self.conv1 = nn.Conv1d(in_channels, out_channels, kernel_size, dilation=dilation)
+        self.conv2 = nn.Conv1d(out_channels, out_channels, kernel_size, dilation=dilation)
+        self.dropout = nn.Dropout(dropout)
+        self.downsample = nn.Conv1d(in_channels, out_channels, 1) if in_channels != out_channels else None
+
+    def forward(self, x):
+        # Left padding only, so no future step leaks into the output
+        out = self.dropout(torch.relu(self.conv1(nn.functional.pad(x, (self.padding, 0)))))
+        out = self.dropout(torch.relu(self.conv2(nn.functional.pad(out, (self.padding, 0)))))
+        residual = x if self.downsample is None else self.downsample(x)
+        return torch.relu(out + residual)
+
+class TCNModel(nn.Module):
+    """
+    Temporal convolutional network: a stack of dilated causal convolutions over the sequence, whose
+    steps are all computed in parallel instead of sequentially as in the LSTM. Dilations double at
+    every level until the receptive field covers the whole sequence.
 
-def prepare_data(df):
+    Same inputs and outputs as LSTMModel.
     """
-    Prepare the data for training a regression (forecasting-like) model.
+    def __init__(self, input_size, hidden_layer_size=50, output_size=1, num_categories=0, embedding_dim=4, kernel_size=2, lags=LSTM_LAGS):
+        super(TCNModel, self).__init__()
+        self.input_size = input_size
+        self.hidden_layer_size = hidden_layer_size
+        self.output_size = output_size
+
+        self.embedding = nn.Embedding(num_categories, embedding_dim) if num_categories > 0 else None
+        if self.embedding is not None:
+            input_size += embedding_dim
+
+        # Receptive field of 1 + 2 * (kernel_size - 1) * (2^levels - 1) steps
+        num_levels = 1
+        while 1 + 2 * (kernel_size - 1) * (2 ** num_levels - 1) < lags:
+            num_levels += 1
+        self.blocks = nn.Sequential(*[
+            CausalConvBlock(input_size if level == 0 else hidden_layer_size, hidden_layer_size, kernel_size, 2 ** level)
+            for level in range(num_levels)
+        ])
+        self.linear = nn.Linear(hidden_layer_size, output_size)
+
+    def forward(self, input_seq, categories=None):
+        if self.embedding is not None:
+            embedded = self.embedding(categories).unsqueeze(1).expand(-1, input_seq.shape[1], -1)
+            input_seq = torch.cat([input_seq, embedded], dim=2)
+
+        # Convolutions run over (batch x channel x time)
+        out = self.blocks(input_seq.transpose(1, 2))
+        return self.linear(out[:, :, -1])
+
+MODEL_TYPES = {
+    'lstm': LSTMModel,
+    'tcn': TCNModel,
+}
 
-    :param df: DataFrame containing the data.
-    :return: Prepared DataFrame.
+def build_model(model_type, input_size, hidden_layer_size, output_size, num_categories):
     """
-    df = add_is_weekend(df)
-    df = get_surplus(df)
-    df = convert_to_timeseries(df, metadata_columns=['is_weekend'])
-    df = add_is_holiday(df)
-    df = get_ohe_from_cat(df, cat='series_id')
+    Build a forecaster of the given type ('lstm' or 'tcn').
+    """
+    return MODEL_TYPES[model_type](
+        input_size=input_size, 
+        hidden_layer_size=hidden_layer_size, 
+        output_size=output_size,
+        num_categories=num_categories,
+    )
 
-    # No need to add lags as separate columns
-    df = df.replace(0, np.nan)  # Replace 0s with NaNs if necessary
-    df.dropna(inplace=True)  # Drop rows with NaNs
-    return df
+### GENERAL FUNCTIONS ###
 
-def create_sequences(data, lags):
+def masked_mse_loss(predictions, labels):
     """
-    Create sequences to be fed into the LSTM.
+    Mean squared error over the known labels, missing ones (NaN) are ignored.
+    """
+    known = ~torch.isnan(labels)
+    return nn.functional.mse_loss(predictions[known], labels[known])
 
-    :param data: DataFrame containing the data.
-    :param lags: Number of lags to use.
-    :return: Tuple of numpy arrays containing the sequences and labels.
+def save_checkpoint(path, model, optimizer, epoch, history, scalers=None):
+    """
+    Save everything needed to resume the training after an epoch.
+
+    :param path: Path to the checkpoint file.
+    :param model: Model being trained.
+    :param optimizer: Optimizer of the model.
+    :param epoch: Number of epochs completed.
+    :param history: Early stopping state (best validation loss, best weights, epochs without improvement).
+    :param scalers: Dictionary of fitted SeriesScalers used to build the training data.
     """
-    xs, ys = [], []
-    for i in range(len(data) - lags):
-        x = data.iloc[i:(i + lags)].to_numpy()
-        y = data.iloc[i + lags]['surplus']
-        xs.append(x)
-        ys.append(y)
-    return np.array(xs), np.array(ys)
+    checkpoint = {
+        'model': model.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'epoch': epoch,
+        'history': history,
+        'scalers': {name: scaler.state_dict() for name, scaler in (scalers or {}).items()},
+        'torch_rng': torch.get_rng_state(),
+        'numpy_rng': np.random.get_state(),
+    }
+    # Write to a temporary file first so an interruption never leaves a truncated checkpoint
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    torch.save(checkpoint, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+def load_checkpoint(path):
+    """
+    Load a checkpoint saved with save_checkpoint.
 
-def train_model(model, train_loader, learning_rate=0.001, epochs=10):
+    :param path: Path to the checkpoint file.
+    """
+    # The checkpoint holds the numpy RNG state, which is not a plain tensor
+    return torch.load(path, weights_only=False)
+
+def train_model(
+    model,
+    train_loader,
+    learning_rate=0.001,
+    epochs=10,
+    val_loader=None,
+    patience=0,
+    checkpoint_path=None,
+    checkpoint_every=1,
+    checkpoint=None,
+    scalers=None,
+    progress=True,
+):
     """
     Train the model.
 
+    If a validation iterator is given, the model is evaluated after every epoch and the weights of
+    the best epoch are restored at the end. Training stops early after patience epochs without
+    improvement (0 to always train for all the epochs).
+
     :param model: Model to train.
-    :param train_loader: DataLoader containing the training data.
+    :param train_loader: BatchIterator over the training data.
     :param learning_rate: Learning rate for the optimizer.
-    :param epochs: Number of epochs to train for.
+    :param epochs: Maximum number of epochs to train for.
+    :param val_loader: BatchIterator over the validation data.
+    :param patience: Number of epochs without validation improvement before stopping.
+    :param checkpoint_path: Path where the training state is saved, None to not save it.
+    :param checkpoint_every: Number of epochs between checkpoints.
+    :param checkpoint: Checkpoint (from load_checkpoint) to resume the training from.
+    :param scalers: Dictionary of fitted SeriesScalers to store in the checkpoints.
+    :param progress: Whether to show a progress bar over the batches.
+    :return: Best validation loss, or None without validation iterator.
     """
-    loss_function = nn.MSELoss()
+    loss_function = masked_mse_loss
     optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
 
-    for epoch in range(epochs):
+    start_epoch = 0
+    history = {'best_val_loss': float('inf'), 'best_state': None, 'bad_epochs': 0}
+    if checkpoint is not None:
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        torch.set_rng_state(checkpoint['torch_rng'])
+        np.random.set_state(checkpoint['numpy_rng'])
+        start_epoch = checkpoint['epoch']
+        history = checkpoint['history']
+        logger.info(f'Resuming training from epoch {start_epoch}/{epochs}')
+        if patience > 0 and history['bad_epochs'] >= patience:
+            # The checkpointed run had already stopped early
+            start_epoch = epochs
+
+    for epoch in range(start_epoch, epochs):
         model.train()
         total_loss = 0
-        for seq, labels in tqdm(train_loader):
+        for seq, categories, labels in tqdm(train_loader, disable=not progress):
             optimizer.zero_grad()
-            y_pred = model(seq)
-            loss = loss_function(y_pred.squeeze(), labels)
+            y_pred = model(seq, categories)
+            loss = loss_function(y_pred, labels)
             loss.backward()
             optimizer.step()
             total_loss += loss.item()
@@ -135,124 +296,585 @@ def train_model(model, train_loader, learning_rate=0.001, epochs=10):
         avg_loss = total_loss / len(train_loader)
         logger.info(f'Epoch {epoch}/{epochs} - Loss: {avg_loss:.4f}')
 
+        if val_loader is not None:
+            val_loss = evaluate_model(model, val_loader, loss_function)
+            logger.info(f'Epoch {epoch}/{epochs} - Val Loss: {val_loss:.4f}')
+            if val_loss < history['best_val_loss']:
+                history['best_val_loss'] = val_loss
+                history['best_state'] = {key: value.clone() for key, value in model.state_dict().items()}
+                history['bad_epochs'] = 0
+            else:
+                history['bad_epochs'] += 1
+
+        stop = patience > 0 and history['bad_epochs'] >= patience
+        if checkpoint_path is not None and ((epoch + 1) % checkpoint_every == 0 or stop or epoch + 1 == epochs):
+            save_checkpoint(checkpoint_path, model, optimizer, epoch + 1, history, scalers)
+        if stop:
+            logger.info(f'Early stopping at epoch {epoch}/{epochs}, best Val Loss: {history["best_val_loss"]:.4f}')
+            break
+
+    if history['best_state'] is not None:
+        model.load_state_dict(history['best_state'])
+    return history['best_val_loss'] if val_loader is not None else None
+
 def evaluate_model(model, val_loader, loss_function):
     """
     Evaluate the model.
 
     :param model: Model to evaluate.
-    :param val_loader: DataLoader containing the validation data.
+    :param val_loader: BatchIterator over the validation data.
     :param loss_function: Loss function to use.
     """
     model.eval()
-    total_loss = 0
+    total_loss, total_count = 0, 0
     with torch.no_grad():
-        for seq, labels in val_loader:
-            y_pred = model(seq)
-            loss = loss_function(y_pred.squeeze(), labels)
-            total_loss += loss.item()
-    return total_loss / len(val_loader)
+        for seq, categories, labels in val_loader:
+            y_pred = model(seq, categories)
+            loss = loss_function(y_pred, labels)
+            # Weighted by batch length so the loss does not depend on the batch size
+            total_loss += loss.item() * len(labels)
+            total_count += len(labels)
+    return total_loss / max(total_count, 1)
+
+def train_stateful_model(model, inputs, labels, split, learning_rate=0.001, epochs=10, bptt=24, segments=8, patience=0, progress=True):
+    """
+    Train a stateful LSTM with truncated backpropagation through time.
+
+    The training hours of every region are cut into contiguous segments, streamed in parallel as
+    one batch row per (segment, region). Every epoch walks through them in chunks of bptt hours: the
+    (h, c) states after a chunk are carried, detached, into the next one. The model thus learns to
+    forecast from a state that has seen the whole stream, instead of a window of lags hours from a
+    zero state. The validation loss streams every region from its first hour, as the inference
+    does, and is scored on the hours from split on. The weights of the best epoch are restored.
+
+    :param model: LSTMModel with a region embedding.
+    :param inputs: Array (region x timestamp x feature) with the scaled inputs.
+    :param labels: Array (region x timestamp x horizon) with the scaled labels, NaN where unknown.
+    :param split: First validation timestamp.
+    :param learning_rate: Learning rate for the optimizer.
+    :param epochs: Maximum number of epochs to train for.
+    :param bptt: Number of hours backpropagated through.
+    :param segments: Number of segments of the training hours of every region.
+    :param patience: Number of epochs without validation improvement before stopping.
+    :param progress: Whether to show a progress bar over the chunks.
+    :return: Best validation loss.
+    """
+    n_regions = inputs.shape[0]
+    length = split // segments
+
+    def to_segments(array):
+        # (region x segment * length x ...) -> (segment * region x length x ...)
+        array = array[:, :segments * length].reshape(n_regions, segments, length, -1).swapaxes(0, 1)
+        return torch.from_numpy(np.ascontiguousarray(array).reshape(segments * n_regions, length, -1))
+
+    x_train, y_train = to_segments(inputs), to_segments(labels)
+    categories = torch.arange(n_regions).repeat(segments)
+    x_stream, stream_categories = torch.from_numpy(np.ascontiguousarray(inputs)), torch.arange(n_regions)
+    y_val = torch.from_numpy(np.ascontiguousarray(labels[:, split:]))
+
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+    history = {'best_val_loss': float('inf'), 'best_state': None, 'bad_epochs': 0}
+    for epoch in range(epochs):
+        model.train()
+        states, total_loss, n_chunks = None, 0, 0
+        for start in tqdm(range(0, length, bptt), disable=not progress):
+            y_pred, states = model.forward_steps(x_train[:, start:start + bptt], categories, states)
+            chunk_labels = y_train[:, start:start + bptt]
+            if not torch.isnan(chunk_labels).all():
+                optimizer.zero_grad()
+                loss = masked_mse_loss(y_pred, chunk_labels)
+                loss.backward()
+                optimizer.step()
+                total_loss += loss.item()
+                n_chunks += 1
+            states = tuple((h.detach(), c.detach()) for h, c in states)
+        logger.info(f'Epoch {epoch}/{epochs} - Loss: {total_loss / max(n_chunks, 1):.4f}')
+
+        model.eval()
+        with torch.no_grad():
+            y_pred, _ = model.forward_steps(x_stream, stream_categories)
+            val_loss = masked_mse_loss(y_pred[:, split:], y_val).item()
+        logger.info(f'Epoch {epoch}/{epochs} - Val Loss: {val_loss:.4f}')
+        if val_loss < history['best_val_loss']:
+            history['best_val_loss'] = val_loss
+            history['best_state'] = {key: value.clone() for key, value in model.state_dict().items()}
+            history['bad_epochs'] = 0
+        else:
+            history['bad_epochs'] += 1
+        if patience > 0 and history['bad_epochs'] >= patience:
+            logger.info(f'Early stopping at epoch {epoch}/{epochs}, best Val Loss: {history["best_val_loss"]:.4f}')
+            break
+
+    if history['best_state'] is not None:
+        model.load_state_dict(history['best_state'])
+    return history['best_val_loss']
+
+def fit_stateful_model(panel, horizons, args):
+    """
+    Train the stateful LSTM on the per-region streams of a panel, and save it with its scalers
+    (stateful_model.pth, stateful_x_scaler.npz and stateful_y_scaler.npz). The latest hours are
+    held out for early stopping.
+
+    :param panel: Panel prepared with prepare_data.
+    :param horizons: List of forecast horizons.
+    :param args: Parsed arguments of the training.
+    """
+    split = int(len(panel.timestamps) * (1 - VAL_SIZE))
+    values = panel.values.astype(np.float32, copy=False)
+    targets = get_panel_horizon_targets(panel, horizons).astype(np.float32, copy=False)
+    observed = panel.valid_mask(['surplus'])
+
+    x_scaler = SeriesScaler(args.scaler).fit(values[:split][observed[:split]])
+    y_scaler = SeriesScaler(args.scaler).fit(targets[:split][observed[:split]])
+    inputs, _ = get_stream_inputs(values, x_scaler, panel.feature_index('surplus'))
+    labels = y_scaler.transform(np.where(observed[:, :, None], targets, np.nan).astype(np.float32))
+    for k, horizon in enumerate(horizons):
+        labels[split - horizon:split, :, k] = np.nan  # Their targets are validation hours
+
+    CONFIG_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'model_config.json')
+    with open(CONFIG_PATH, 'r') as f:
+        model_config = json.load(f)
+    model = build_model('lstm', inputs.shape[2], model_config['hidden_layer_size'], len(horizons), len(panel.regions))
+    val_loss = train_stateful_model(
+        model,
+        inputs.swapaxes(0, 1),
+        labels.swapaxes(0, 1),
+        split,
+        learning_rate=model_config['learning_rate'],
+        epochs=model_config['epochs'],
+        bptt=args.bptt,
+        segments=args.segments,
+        patience=args.patience,
+    )
+    logger.info(f"Best validation loss of the stateful model: {val_loss:.4f}")
+
+    model_path = get_artifact_path('lstm', 'stateful_model.pth')
+    version_path = save_artifact(model_path, lambda path: torch.save(model.state_dict(), path))
+    save_artifact(get_artifact_path('lstm', 'stateful_x_scaler.npz'), x_scaler.save)
+    save_artifact(get_artifact_path('lstm', 'stateful_y_scaler.npz'), y_scaler.save)
+    logger.info(f"Stateful model trained and saved at {model_path} (version {version_path})")
+
+def predict(model, dataset, batch_size=4096):
+    """
+    Predict the sequences of a dataset, materializing one batch of sequences at a time.
+
+    :param model: Model to use, or any runtime with the same call signature and output_size.
+    :param dataset: SequenceDataset with the sequences.
+    :param batch_size: Number of sequences per forward pass.
+    :return: Numpy array (sequence x horizon) with the predictions.
+    """
+    if isinstance(model, nn.Module):
+        model.eval()
+    predictions = []
+    with torch.no_grad():
+        for seq, categories, _ in BatchIterator(dataset, batch_size):
+            output = model(seq, categories)
+            predictions.append(output.numpy() if isinstance(output, torch.Tensor) else output)
+    return np.concatenate(predictions) if predictions else np.empty((0, model.output_size), dtype=np.float32)
+
+def quantize_model(model):
+    """
+    Apply dynamic int8 quantization to the LSTM and linear layers: their weights are stored as int8
+    and their activations are quantized on the fly, while the embedding stays in float.
+
+    :param model: Trained LSTMModel.
+    :return: Quantized copy of the model.
+    """
+    return torch.ao.quantization.quantize_dynamic(model.eval(), {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+def export_model(model, path, lags, formats=('torchscript',)):
+    """
+    Export the model as inference graphs next to its weights.
+
+    TorchScript graphs are traced, frozen and optimized for inference (which fuses operations), and
+    saved as '{path}.pt'. ONNX graphs are saved as '{path}.onnx' if the onnx package is installed.
+    Both take (sequences, categories) inputs, only sequences for the joint architecture, with a
+    dynamic batch size.
+
+    :param model: Trained LSTMModel or TCNModel.
+    :param path: Path of the exported graphs without extension.
+    :param lags: Length of the sequences.
+    :param formats: Formats to export, 'torchscript' and/or 'onnx'.
+    """
+    model.eval()
+    example = (torch.zeros(2, lags, model.input_size),)
+    input_names = ['sequences']
+    if model.embedding is not None:
+        example += (torch.zeros(2, dtype=torch.int64),)
+        input_names.append('categories')
+
+    if 'torchscript' in formats:
+        with torch.no_grad():
+            traced = torch.jit.optimize_for_inference(torch.jit.freeze(torch.jit.trace(model, example)))
+        traced.save(f'{path}.pt')
+        logger.info(f"TorchScript model exported at {path}.pt")
+
+    if 'onnx' in formats:
+        if importlib.util.find_spec('onnx') is None:
+            logger.warning("ONNX export skipped, it requires the onnx package (pip install onnx)")
+            return
+
+        # Legacy TorchScript-based exporter, which newer versions only use when asked for
+        kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+        torch.onnx.export(
+            model, 
+            example, 
+            f'{path}.onnx',
+            input_names=input_names,
+            output_names=['forecasts'],
+            dynamic_axes={name: {0: 'batch'} for name in input_names + ['forecasts']},
+            **kwargs,
+        )
+        logger.info(f"ONNX model exported at {path}.onnx")
+
+### GRID SEARCH ###
+
+# Datasets of the grid search, inherited by the worker processes instead of being pickled per trial
+_GRID_DATA = {}
+
+def _init_grid_worker(train_data, val_data, threads, settings=None):
+    _GRID_DATA['train'] = train_data
+    _GRID_DATA['val'] = val_data
+    _GRID_DATA['settings'] = settings
+    # Cap the intra-op threads so that parallel trials do not oversubscribe the cores
+    torch.set_num_threads(threads)
+
+def run_trial(model_type, hidden_size, learning_rate, num_epochs, input_size, output_size, num_categories, batch_size, patience):
+    """
+    Train one (hidden size, learning rate) pair for every number of epochs of the grid.
+
+    The epochs are sorted and trained as prefixes of a single run: each longer configuration
+    resumes from the checkpoint of the previous one instead of training from scratch.
+
+    :param model_type: Type of forecaster, 'lstm' or 'tcn'.
+    :param hidden_size: Hidden layer size of the model.
+    :param learning_rate: Learning rate of the optimizer.
+    :param num_epochs: Numbers of epochs to evaluate.
+    :param input_size: Number of features of the sequences.
+    :param output_size: Number of values forecasted.
+    :param num_categories: Number of regions embedded, 0 for the joint architecture.
+    :param batch_size: Number of sequences per training batch.
+    :param patience: Number of epochs without validation improvement before stopping.
+    :return: List of (params, validation loss, best weights, wall time) per number of epochs.
+    """
+    # Same initialization whatever the process and order the trial runs in
+    torch.manual_seed(SEED)
+    np.random.seed(SEED)
+
+    train_loader = BatchIterator(_GRID_DATA['train'], batch_size=batch_size, shuffle=True)
+    val_loader = BatchIterator(_GRID_DATA['val'], batch_size=max(batch_size, 4096))
+    model = build_model(model_type, input_size, hidden_size, output_size, num_categories)
+
+    results = []
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        checkpoint_path = os.path.join(tmp_dir, 'checkpoint.pth')
+        checkpoint = None
+        for epochs in sorted(num_epochs):
+            val_loss = train_model(
+                model, 
+                train_loader, 
+                learning_rate=learning_rate, 
+                epochs=epochs, 
+                val_loader=val_loader, 
+                patience=patience,
+                checkpoint_path=checkpoint_path,
+                checkpoint_every=epochs,
+                checkpoint=checkpoint,
+                progress=False,
+            )
+            params = {'hidden_layer_size': hidden_size, 'learning_rate': learning_rate, 'epochs': epochs}
+            state = {key: value.clone() for key, value in model.state_dict().items()}
+            results.append((params, val_loss, state, time.perf_counter() - start))
+            checkpoint = load_checkpoint(checkpoint_path)
+    return results
+
+def tune_trial(config, budget, state):
+    """
+    Training function of the tuner, which continues training a configuration up to a number of epochs.
+
+    :param config: Dictionary with the hidden_layer_size and learning_rate.
+    :param budget: Number of epochs to train up to.
+    :param state: Path to the checkpoint of the configuration, None to start from scratch.
+    :return: Best validation loss and path to the checkpoint.
+    """
+    settings = _GRID_DATA['settings']
+    checkpoint = None
+    if state is None:
+        torch.manual_seed(SEED)
+        np.random.seed(SEED)
+        fd, state = tempfile.mkstemp(suffix='.pth', dir=settings['checkpoint_dir'])
+        os.close(fd)  # Only the unique path is needed, the checkpoint is written by train_model
+    else:
+        checkpoint = load_checkpoint(state)
+
+    model = build_model(
+        settings['model_type'], 
+        settings['input_size'], 
+        config['hidden_layer_size'], 
+        settings['output_size'], 
+        settings['num_categories'],
+    )
+    val_loss = train_model(
+        model, 
+        BatchIterator(_GRID_DATA['train'], batch_size=settings['batch_size'], shuffle=True), 
+        learning_rate=config['learning_rate'], 
+        epochs=budget, 
+        val_loader=BatchIterator(_GRID_DATA['val'], batch_size=max(settings['batch_size'], 4096)), 
+        patience=settings['patience'],
+        checkpoint_path=state,
+        checkpoint_every=budget,
+        checkpoint=checkpoint,
+        progress=False,
+    )
+    return val_loss, state
+
+def adaptive_search(train_data, val_data, configs, max_epochs, args, input_size, output_size, num_categories):
+    """
+    Run the tuner with epochs as budget, training the configurations of every rung in a process pool.
+
+    :param train_data: SequenceDataset with the training sequences.
+    :param val_data: SequenceDataset with the validation sequences.
+    :param configs: List of configuration dictionaries with hidden_layer_size and learning_rate.
+    :param max_epochs: Largest number of epochs of a configuration.
+    :param args: Parsed arguments with model_type, tuner, jobs, threads_per_trial, batch_size and patience.
+    :param input_size: Number of features of the sequences.
+    :param output_size: Number of values forecasted.
+    :param num_categories: Number of regions embedded, 0 for the joint architecture.
+    :return: Best (params, validation loss, best weights).
+    """
+    jobs = args.jobs or max(1, min(len(configs), (os.cpu_count() or 1) // args.threads_per_trial))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        settings = {
+            'model_type': args.model_type,
+            'input_size': input_size,
+            'output_size': output_size,
+            'num_categories': num_categories,
+            'batch_size': args.batch_size,
+            'patience': args.patience,
+            'checkpoint_dir': tmp_dir,
+        }
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_grid_worker,
+            initargs=(train_data, val_data, args.threads_per_trial, settings),
+        ) as executor:
+            best, _ = tune(args.tuner, configs, tune_trial, min_budget=1, max_budget=max_epochs, map_fn=executor.map)
+        best_state = load_checkpoint(best['state'])['history']['best_state']
+    return dict(best['config'], epochs=best['budget']), best['loss'], best_state
+
+def grid_search(train_data, val_data, pairs, num_epochs, args, input_size, output_size, num_categories):
+    """
+    Run the grid search trials in a process pool.
+
+    :param train_data: SequenceDataset with the training sequences.
+    :param val_data: SequenceDataset with the validation sequences.
+    :param pairs: Iterable of (hidden size, learning rate) pairs.
+    :param num_epochs: Numbers of epochs to evaluate for every pair.
+    :param args: Parsed arguments with model_type, jobs, threads_per_trial, batch_size and patience.
+    :param input_size: Number of features of the sequences.
+    :param output_size: Number of values forecasted.
+    :param num_categories: Number of regions embedded, 0 for the joint architecture.
+    :return: List of (params, validation loss, best weights) of every configuration.
+    """
+    pairs = list(pairs)
+    jobs = args.jobs or max(1, min(len(pairs), (os.cpu_count() or 1) // args.threads_per_trial))
+    logger.info(f"Running {len(pairs)} trials over {jobs} processes with {args.threads_per_trial} threads each")
+
+    results = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=_init_grid_worker,
+        initargs=(train_data, val_data, args.threads_per_trial),
+    ) as executor:
+        futures = {
+            executor.submit(
+                run_trial, args.model_type, hidden_size, lr, num_epochs, input_size, output_size, num_categories, args.batch_size, args.patience,
+            ): (hidden_size, lr)
+            for hidden_size, lr in pairs
+        }
+        for future in as_completed(futures):
+            for params, val_loss, state, wall_time in future.result():
+                logger.info(f"Val Loss: {val_loss} for params {params} ({wall_time:.1f}s)")
+                results.append((params, val_loss, state))
+    logger.info(f"Grid search finished in {time.perf_counter() - start:.1f}s")
+    return results
 
 ### MAIN ###
 
 def parser_add_arguments(parser):
     parser.add_argument('--use-grid', action='store_true', help='Use grid search for model tuning')
+    parser.add_argument('--tuner', type=str, default='grid', choices=TUNERS, help='Search used with --use-grid')
     parser.add_argument('--scaler', type=str, default='standard', choices=['standard', 'minmax'], help='Scaler to use')
+    parser.add_argument('--horizons', type=int, default=1, help='Forecast 1..horizons hours ahead with a single multi-output model')
+    parser.add_argument('--model-type', type=str, default='lstm', choices=list(MODEL_TYPES), help='Recurrent LSTM or temporal convolutional network')
+    parser.add_argument('--architecture', type=str, default='per-region', choices=['per-region', 'joint'], help='One sequence per region or one sequence of all the regions per timestamp')
+    parser.add_argument('--batch-size', type=int, default=64, help='Number of sequences per training batch')
+    parser.add_argument('--patience', type=int, default=3, help='Epochs without validation improvement before stopping (0 to disable)')
+    parser.add_argument('--checkpoint-every', type=int, default=1, help='Number of epochs between checkpoints')
+    parser.add_argument('--resume', action='store_true', help='Resume the training from the last checkpoint')
+    parser.add_argument('--export', type=str, nargs='*', default=['torchscript'], choices=['torchscript', 'onnx'], help='Inference graphs exported next to the weights')
+    parser.add_argument('--quantize', action='store_true', help='Also export a dynamic int8 quantized TorchScript model')
+    parser.add_argument('--jobs', type=int, default=None, help='Number of parallel grid search trials (default: cores / threads per trial)')
+    parser.add_argument('--threads-per-trial', type=int, default=1, help='Torch threads of every grid search trial')
+    parser.add_argument('--refresh', action='store_true', help='Fine-tune the current model on the recent sequences instead of a full fit')
+    parser.add_argument('--refresh-hours', type=int, default=168, help='Latest hours of the training data fine-tuned on with --refresh')
+    parser.add_argument('--refresh-epochs', type=int, default=2, help='Number of fine-tuning epochs with --refresh')
+    parser.add_argument('--stateful', action='store_true', help='Train a stateful LSTM on the per-region streams, streamed one step per hour')
+    parser.add_argument('--bptt', type=int, default=24, help='Hours backpropagated through with --stateful')
+    parser.add_argument('--segments', type=int, default=8, help='Contiguous segments of the training hours of every region with --stateful')
     return parser
 
 def main():
     parser = argparse.ArgumentParser(description='Train LSTM model')
     parser_add_arguments(parser)
     args = parser.parse_args()
+    if args.refresh and (args.use_grid or args.resume):
+        parser.error('--refresh fine-tunes the current model, it cannot be combined with --use-grid or --resume')
+    if args.stateful and (args.model_type != 'lstm' or args.architecture != 'per-region' or args.use_grid or args.refresh or args.resume):
+        parser.error('--stateful trains a per-region LSTM from scratch, it cannot be combined with --model-type tcn, --architecture joint, --use-grid, --refresh or --resume')
 
     train, _ = load_data()
     train = prepare_data(train)
-
-    # Splitting data for validation
-    train_data, val_data = train_test_split(train, test_size=VAL_SIZE, random_state=SEED)
-    x_train, y_train = create_sequences(train_data.drop(['timestamp', 'series_id'], axis=1), lags=LSTM_LAGS)
-    x_val, y_val = create_sequences(val_data.drop(['timestamp', 'series_id'], axis=1), lags=LSTM_LAGS)
-
-    # Normalizing the data
-    if args.scaler == 'standard':
-        x_scaler = StandardScaler()
-        y_scaler = StandardScaler()
-    elif args.scaler == 'minmax':
-        x_scaler = MinMaxScaler()
-        y_scaler = MinMaxScaler()
+    horizons = list(range(1, args.horizons + 1))
+    if args.stateful:
+        fit_stateful_model(train, horizons, args)
+        return
+
+    # Build the sequences as window views over the panel and split them for validation. The sequences
+    # are ordered by their last timestamp, the latest ones are held out so that overlapping windows
+    # do not leak into the validation
+    dataset = create_sequences(train, lags=LSTM_LAGS, horizons=horizons, architecture=args.architecture)
+    train_indexes, val_indexes = train_test_split(np.arange(len(dataset)), test_size=VAL_SIZE, shuffle=False)
+    train_data, val_data = dataset.subset(train_indexes), dataset.subset(val_indexes)
+
+    # Load the checkpoint to resume from, if any
+    checkpoint_path = get_artifact_path(args.model_type, 'checkpoint.pth')
+    checkpoint = None
+    if args.resume:
+        if os.path.exists(checkpoint_path):
+            checkpoint = load_checkpoint(checkpoint_path)
+        else:
+            logger.warning(f"No checkpoint found at {checkpoint_path}, training from scratch")
+
+    # Normalizing the data in place, the sequences are views of the scaled panel
+    x_scaler = SeriesScaler(args.scaler)
+    y_scaler = SeriesScaler(args.scaler)
+    x_scaler_path = get_artifact_path(args.model_type, 'x_scaler.npz')
+    y_scaler_path = get_artifact_path(args.model_type, 'y_scaler.npz')
+    if checkpoint is not None:
+        # Keep the statistics the checkpointed weights were trained with
+        x_scaler.load_state_dict(checkpoint['scalers']['x_scaler'])
+        y_scaler.load_state_dict(checkpoint['scalers']['y_scaler'])
+    elif args.refresh:
+        # Same for the saved weights, refitting the scalers would shift every input of the fine-tuned model
+        x_scaler, y_scaler = SeriesScaler.load(x_scaler_path), SeriesScaler.load(y_scaler_path)
     else:
-        raise ValueError("Invalid scaler")
-
-    # Scale training data
-    x_train_scaled = x_scaler.fit_transform(x_train.reshape(-1, x_train.shape[2]))
-    x_train_scaled = x_train_scaled.reshape(-1, LSTM_LAGS, x_train.shape[2])
-
-    # Scale validation data using the same scaler
-    x_val_scaled = x_scaler.transform(x_val.reshape(-1, x_val.shape[2]))
-    x_val_scaled = x_val_scaled.reshape(-1, LSTM_LAGS, x_val.shape[2])
-
-    # If you decide to use the same scaler for y
-    y_train_scaled = y_scaler.fit_transform(y_train.reshape(-1, 1)).flatten()
-    y_val_scaled = y_scaler.transform(y_val.reshape(-1, 1)).flatten()
-
-    # Convert to PyTorch tensors
-    x_train_tensor = torch.tensor(x_train_scaled, dtype=torch.float32)
-    y_train_tensor = torch.tensor(y_train_scaled, dtype=torch.float32)
-    x_val_tensor = torch.tensor(x_val_scaled, dtype=torch.float32)
-    y_val_tensor = torch.tensor(y_val_scaled, dtype=torch.float32)
-
-    # Create TensorDataset and DataLoader for data
-    train_data = TensorDataset(x_train_tensor, y_train_tensor)
-    train_loader = DataLoader(train_data, batch_size=64, shuffle=True)
-    val_data = TensorDataset(x_val_tensor, y_val_tensor)
-    val_loader = DataLoader(val_data, batch_size=64, shuffle=False)
-
-    CONFIG_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'model_config.json')
-    if args.use_grid:
+        x_scaler.fit(dataset.values[train_data.positions, train_data.codes])
+        y_scaler.fit(train_data.labels())
+    dataset.scale(x_scaler)
+    y_scaler.transform(dataset.targets)
+    scalers = {'x_scaler': x_scaler, 'y_scaler': y_scaler}
+
+    # Create the batch iterators, validation batches do not affect the loss so they can be larger
+    train_loader = BatchIterator(train_data, batch_size=args.batch_size, shuffle=True)
+    val_loader = BatchIterator(val_data, batch_size=max(args.batch_size, 4096))
+    input_size = dataset.values.shape[2]
+    output_size = dataset.targets.shape[2]
+    num_categories = len(REGIONS) if args.architecture == 'per-region' else 0
+
+    CONFIG_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'model_config.json' if args.model_type == 'lstm' else f'{args.model_type}_config.json')
+    model_path = get_artifact_path(args.model_type, 'model.pth')
+    if args.refresh:
+        with open(CONFIG_PATH, 'r') as f:
+            model_config = json.load(f)
+        model = build_model(args.model_type, input_size, model_config['hidden_layer_size'], output_size, num_categories)
+        model.load_state_dict(torch.load(model_path))
+        logger.info(f"Validation loss of the current model: {evaluate_model(model, val_loader, masked_mse_loss):.4f}")
+
+        # Fine-tune on the sequences ending in the latest hours of the training split, the older ones are already learnt
+        recent = np.flatnonzero(train_data.positions > train_data.positions.max() - args.refresh_hours)
+        if not len(recent):
+            parser.error(f"No training sequences in the latest {args.refresh_hours} hours to refresh on")
+        recent_data = train_data.subset(recent)
+        logger.info(f"Refreshing on the latest {args.refresh_hours} hours of the training split ({len(recent_data)} sequences)")
+        train_model(
+            model,
+            BatchIterator(recent_data, batch_size=args.batch_size, shuffle=True),
+            learning_rate=model_config['learning_rate'],
+            epochs=args.refresh_epochs,
+            val_loader=val_loader,
+        )
+    elif args.use_grid:
         hidden_layer_sizes = [50, 100, 150]
         learning_rates = [0.0001, 0.001, 0.01]
         num_epochs = [5, 10]
 
-        best_val_loss = float('inf')
-        best_model_params = {}
-
-        for hidden_size, lr, epochs in product(hidden_layer_sizes, learning_rates, num_epochs):
-            model = LSTMModel(input_size=x_train_tensor.shape[2], hidden_layer_size=hidden_size)
-            train_model(model, train_loader, learning_rate=lr, epochs=epochs)
-            
-            val_loss = evaluate_model(model, val_loader, nn.MSELoss())
-            logger.info(f"Val Loss: {val_loss} for params {hidden_size}, {lr}, {epochs}")
-
-            if val_loss < best_val_loss:
-                best_val_loss = val_loss
-                best_model_params = {'hidden_layer_size': hidden_size, 'learning_rate': lr, 'epochs': epochs}
-                best_model = model
-
+        if args.tuner == 'grid':
+            results = grid_search(
+                train_data, 
+                val_data, 
+                product(hidden_layer_sizes, learning_rates), 
+                num_epochs, 
+                args,
+                input_size=input_size,
+                output_size=output_size,
+                num_categories=num_categories,
+            )
+            best_model_params, best_val_loss, best_state = min(results, key=lambda result: result[1])
+        else:
+            # Adaptive search with epochs as budget, up to the longest epochs of the grid
+            best_model_params, best_val_loss, best_state = adaptive_search(
+                train_data, 
+                val_data, 
+                get_configs({'hidden_layer_size': hidden_layer_sizes, 'learning_rate': learning_rates}), 
+                max(num_epochs), 
+                args,
+                input_size=input_size,
+                output_size=output_size,
+                num_categories=num_categories,
+            )
         logger.info(f"Best Model Params: {best_model_params}, Loss: {best_val_loss}")
 
         # Save the best model parameters to config
         with open(CONFIG_PATH, 'w') as f:
             json.dump(best_model_params, f)
 
-        model = best_model
+        model = build_model(args.model_type, input_size, best_model_params['hidden_layer_size'], output_size, num_categories)
+        model.load_state_dict(best_state)
     else:
         # Load model configuration
         with open(CONFIG_PATH, 'r') as f:
             model_config = json.load(f)
-        model = LSTMModel(input_size=x_train_tensor.shape[2], hidden_layer_size=model_config['hidden_layer_size'])
-        train_model(model, train_loader, learning_rate=model_config['learning_rate'], epochs=model_config['epochs'])
+        model = build_model(args.model_type, input_size, model_config['hidden_layer_size'], output_size, num_categories)
+        train_model(
+            model, 
+            train_loader, 
+            learning_rate=model_config['learning_rate'], 
+            epochs=model_config['epochs'],
+            val_loader=val_loader,
+            patience=args.patience,
+            checkpoint_path=checkpoint_path,
+            checkpoint_every=args.checkpoint_every,
+            checkpoint=checkpoint,
+            scalers=scalers,
+        )
 
     # Save Model
-    model_path = os.path.join(MODELS_DIR, 'forecasting', 'lstm', 'model.pth')
-    os.makedirs(os.path.dirname(model_path), exist_ok=True)
-    torch.save(model.state_dict(), model_path)
-    logger.info(f"Model trained and saved at {model_path}")
-
-    # Save scalers
-    x_scaler_path = os.path.join(MODELS_DIR, 'forecasting/lstm', 'x_scaler.pkl')
-    y_scaler_path = os.path.join(MODELS_DIR, 'forecasting/lstm', 'y_scaler.pkl')
-    joblib.dump(x_scaler, x_scaler_path)
-    joblib.dump(y_scaler, y_scaler_path)
-    logger.info(f"Scalers saved at {x_scaler_path} and {y_scaler_path}")
+    version_path = save_artifact(model_path, lambda path: torch.save(model.state_dict(), path))
+    logger.info(f"Model trained and saved at {model_path} (version {version_path})")
+
+    # Save scalers, a refresh keeps the current ones
+    if not args.refresh:
+        save_artifact(x_scaler_path, x_scaler.save)
+        save_artifact(y_scaler_path, y_scaler.save)
+        logger.info(f"Scalers saved at {x_scaler_path} and {y_scaler_path}")
+
+    # Export the inference graphs
+    export_model(model, os.path.splitext(model_path)[0], lags=LSTM_LAGS, formats=args.export)
+    if args.quantize:
+        export_model(quantize_model(model), os.path.splitext(model_path)[0] + '_int8', lags=LSTM_LAGS)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,229 @@
+"""
+Preparation of the LSTM sequences, shared by the training and the prediction scripts.
+
+It only needs numpy, so that the ONNX runtime predicts without importing torch. The sequences are
+converted to tensors when a PyTorch model indexes them.
+"""
+# General imports
+import os
+
+# Data related imports
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Local imports
+from src.data.prepare_data import (
+    get_surplus,
+    get_panel,
+    get_panel_horizon_targets,
+    add_panel_calendar,
+)
+from src.data.calendar_features import CALENDAR_FEATURES
+from src.definitions import MODELS_DIR
+
+
+def get_artifact_path(model_type, name):
+    """
+    Get the path of an artifact (model.pth, checkpoint.pth, x_scaler.npz, ...) of a forecaster type.
+    The artifacts of the LSTM keep their names, the ones of other types are prefixed with the type.
+    """
+    prefix = '' if model_type == 'lstm' else f'{model_type}_'
+    return os.path.join(MODELS_DIR, 'forecasting', 'lstm', prefix + name)
+
+### SEQUENCES ###
+
+def prepare_data(df):
+    """
+    Prepare the data for training a regression (forecasting-like) model.
+
+    :param df: DataFrame containing the data.
+    :return: Panel with the features of every region.
+    """
+    df = get_surplus(df)
+
+    # No need to add lags as separate features, they are the sequence steps
+    panel = get_panel(df, features=['surplus'] + CALENDAR_FEATURES)
+    panel = add_panel_calendar(panel)
+    return panel
+
+class SequenceDataset:
+    """
+    Lazy dataset of the sequences of a panel.
+
+    The sequences are strided window views over the time axis of every region of the panel, so
+    building the dataset copies nothing and windows never cross regions. A sequence is only
+    materialized when indexed, and indexing with an array of indexes gathers a whole batch at once.
+Indexing returns tensors for the PyTorch models, arrays returns the same batch as numpy arrays.
+
+    :param values: Array (timestamp x region x feature) with the sequence features.
+    :param targets: Array (timestamp x region x horizon) with the labels of the sequence ending at each timestamp.
+    :param positions: Timestamp index where every sequence ends.
+    :param codes: Region code of every sequence.
+    :param lags: Length of the sequences.
+    """
+    def __init__(self, values, targets, positions, codes, lags):
+        self.values = values
+        self.targets = targets
+        self.positions = positions
+        self.codes = codes
+        self.lags = lags
+        self.windows = sliding_window_view(values, lags, axis=0)  # (timestamp - lags + 1 x region x feature x lags)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, index):
+        import torch  # Only the PyTorch models index the dataset, the module does not need torch
+        return tuple(torch.as_tensor(array) for array in self.arrays(index))
+
+    def arrays(self, index):
+        """
+        Get the sequences, region codes and labels of an index, slice or array of indexes as numpy arrays.
+        """
+        positions, codes = self.positions[index], self.codes[index]
+        sequences = np.swapaxes(self.windows[positions - self.lags + 1, codes], -1, -2)  # (... x lags x feature)
+        return np.ascontiguousarray(sequences), codes, np.ascontiguousarray(self.targets[positions, codes])
+
+    def scale(self, x_scaler):
+        """
+        Scale the values in place, the sequences are views of them. Missing observations (only kept
+        by the joint architecture) are filled with the scaled mean of their series, which is not 0
+        with the minmax scaler.
+
+        :param x_scaler: Fitted SeriesScaler of the features.
+        :return: The dataset itself.
+        """
+        x_scaler.transform(self.values)
+        missing = np.isnan(self.values)
+        if missing.any():
+            self.values[missing] = np.broadcast_to(get_fill_values(x_scaler), self.values.shape)[missing]
+        return self
+
+    def subset(self, indexes):
+        """
+        Get a dataset with a subset of the sequences, sharing the same memory.
+        """
+        return SequenceDataset(self.values, self.targets, self.positions[indexes], self.codes[indexes], self.lags)
+
+    def labels(self):
+        """
+        Get the (sequence x horizon) labels.
+        """
+        return self.targets[self.positions, self.codes]
+
+class BatchIterator:
+    """
+    Iterator over the batches of a SequenceDataset.
+
+    Replaces DataLoader, which indexes the dataset once per sequence and collates the results. The
+    order is shuffled once per epoch as a permutation of the sequence indexes, and each batch is
+    gathered with a single array index into already contiguous tensors.
+
+    :param dataset: SequenceDataset to iterate.
+    :param batch_size: Number of sequences per batch.
+    :param shuffle: Whether to shuffle the sequences at every epoch.
+    """
+    def __init__(self, dataset, batch_size=64, shuffle=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return -(-len(self.dataset) // self.batch_size)
+
+    def __iter__(self):
+        n = len(self.dataset)
+        order = np.random.permutation(n) if self.shuffle else np.arange(n)
+        for start in range(0, n, self.batch_size):
+            yield self.dataset[order[start:start + self.batch_size]]
+
+def get_window_mask(panel, lags, value='surplus'):
+    """
+    Get a (timestamp x region) mask of the sequences ending at every timestamp whose observations
+    are all usable, checked with a window view of the panel mask.
+
+    :param panel: Panel containing the data.
+    :param lags: Length of the sequences.
+    :param value: Name of the forecasted feature.
+    """
+    mask = np.zeros(panel.shape[:2], dtype=bool)
+    mask[lags - 1:] = sliding_window_view(panel.valid_mask([value]), lags, axis=0).all(axis=-1)
+    return mask
+
+def get_fill_values(scaler):
+    """
+    Get the scaled mean of every series, fed in place of the missing observations. It is 0 with the
+    standard scaler, but not with the minmax one.
+    """
+    return scaler.transform(scaler.mean[None], copy=True)[0].astype(np.float32)
+
+def get_stream_inputs(values, x_scaler, value_index=0):
+    """
+    Scale the observations fed to a stateful model. Those with a zero or missing value are fed as
+    the scaled mean, so that the state keeps advancing every hour.
+
+    :param values: Array (... x feature) with the raw observations.
+    :param x_scaler: Fitted SeriesScaler of the features.
+    :param value_index: Index of the forecasted feature.
+    :return: Array (... x feature) with the scaled inputs, and the (...) mask of the usable observations.
+    """
+    observed = ~np.isnan(values[..., value_index]) & (values[..., value_index] != 0)
+    fill = get_fill_values(x_scaler)
+    inputs = x_scaler.transform(np.asarray(values, dtype=np.float32), copy=True)
+    inputs[~observed, value_index] = fill[value_index]
+    return np.where(np.isnan(inputs), fill, inputs), observed
+
+def create_sequences(panel, lags, value='surplus', horizons=(1,), require_target=True, architecture='per-region'):
+    """
+    Create sequences to be fed into the LSTM.
+
+    The sequence ending at timestamp t is labelled with the values at t + h for every horizon h, so the
+    prediction of the sequence is the forecast issued at t. With the 'per-region' architecture there is
+    one sequence per region, which skips observations with zero or missing values. With the 'joint'
+    architecture there is one sequence per timestamp with the features of all the regions, i.e., a
+    panel with a single series of (region * feature) features labelled with (region * horizon)
+    values. It is kept if any of its regions is usable, the others have missing labels.
+
+    Scale dataset.values and dataset.targets in place (not the sequences, which overlap in memory).
+
+    :param panel: Panel containing the data.
+    :param lags: Number of lags to use.
+    :param value: Name of the forecasted feature.
+    :param horizons: List of forecast horizons (hours ahead).
+    :param require_target: Whether to skip sequences whose label is unknown (set to False to predict).
+    :param architecture: 'per-region' or 'joint'.
+    :return: SequenceDataset over the panel.
+    """
+    values = panel.values.astype(np.float32, copy=False)
+    targets = get_panel_horizon_targets(panel, horizons, value=value).astype(np.float32, copy=False)
+
+    valid = get_window_mask(panel, lags, value=value)
+    if require_target:
+        valid &= ~np.isnan(targets).any(axis=-1)
+
+    if architecture == 'joint':
+        # Wide views of the same memory, labels of unusable regions are masked out of the loss
+        targets = np.where(valid[:, :, None], targets, np.nan).reshape(len(targets), 1, -1)
+        values = values.reshape(len(values), 1, -1)
+        valid = valid.any(axis=1, keepdims=True)
+    elif architecture != 'per-region':
+        raise ValueError("Invalid architecture")
+
+    positions, codes = np.nonzero(valid)
+    return SequenceDataset(values, targets, positions, codes, lags)
+
+def predict_arrays(runtime, dataset, batch_size=4096):
+    """
+    Predict the sequences of a dataset with a runtime taking numpy arrays, such as the ONNX one,
+    materializing one batch of sequences at a time.
+
+    :param runtime: Callable (sequences, categories) -> forecasts with an output_size.
+    :param dataset: SequenceDataset with the sequences.
+    :param batch_size: Number of sequences per forward pass.
+    :return: Numpy array (sequence x horizon) with the predictions.
+    """
+    predictions = []
+    for start in range(0, len(dataset), batch_size):
+        sequences, categories, _ = dataset.arrays(slice(start, start + batch_size))
+        predictions.append(runtime(sequences, categories))
+    return np.concatenate(predictions) if predictions else np.empty((0, runtime.output_size), dtype=np.float32)
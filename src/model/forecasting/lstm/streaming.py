@@ -0,0 +1,137 @@
+"""
+Streaming inference of an LSTM, which advances one step per new hourly observation.
+"""
+# Data related imports
+import numpy as np
+import torch
+
+# Local imports
+from src.definitions import (
+    LSTM_LAGS,
+    REGIONS,
+)
+from src.model.forecasting.lstm.sequences import get_stream_inputs
+
+### STREAMING ###
+
+class StreamingLSTM:
+    """
+    LSTM inference that advances one step per new hourly observation.
+
+    A stateful model (trained with --stateful) carries the (h, c) states of lstm1 and lstm2 of every
+    region over the whole stream, as it was trained. Each new hour advances them by a single step,
+    so the cost per hour is one cell update per region whatever the length of the history.
+
+    A model trained on windows of lags hours starting from a zero state cannot carry its state over
+    the stream. The streamer then keeps the states of lags staggered windows of every region: each
+    new hour advances all of them by one step in a single batched call, and the window that has
+    just seen lags rows emits its forecast and restarts from zero. Its forecasts are identical to
+    the sequence predictions. Every hour still costs lags x regions cell updates, the work of one
+    full window per region, so this only saves the latency of rebuilding and batching the windows.
+
+    :param model: Trained LSTMModel in evaluation mode.
+    :param x_scaler: Fitted SeriesScaler of the features.
+    :param y_scaler: Fitted SeriesScaler of the targets.
+    :param lags: Length of the sequences the windowed model was trained on.
+    :param n_regions: Number of regions of every new hour.
+    :param value_index: Index of the forecasted feature, rows where it is zero or missing are not forecasted.
+    :param stateful: Whether the model was trained as a stateful model.
+    """
+    def __init__(self, model, x_scaler, y_scaler, lags=LSTM_LAGS, n_regions=len(REGIONS), value_index=0, stateful=False):
+        self.model = model
+        self.x_scaler = x_scaler
+        self.y_scaler = y_scaler
+        self.lags = 1 if stateful else lags
+        self.n_regions = n_regions
+        self.value_index = value_index
+        self.stateful = stateful
+
+        # The batch of the LSTM layers holds window k of region r at k * n_regions + r
+        self.categories = torch.arange(n_regions).repeat(self.lags)
+        self.reset()
+
+    def reset(self):
+        """
+        Forget every observation seen so far.
+        """
+        hidden_size = self.model.hidden_layer_size
+        batch = self.lags * self.n_regions
+        self.states = [
+            (torch.zeros(1, batch, hidden_size), torch.zeros(1, batch, hidden_size)) for _ in range(2)
+        ]
+        self.valid = np.zeros((self.lags, self.n_regions), dtype=bool)
+        self.t = 0
+
+    def step(self, new_rows):
+        """
+        Feed the observations of a new hour.
+
+        :param new_rows: Array (region x feature) with the raw features of the new hour.
+        :return: Array (region x horizon) with the forecasts issued at this hour, NaN for the regions
+            whose observation is zero or missing. The windowed model also forecasts NaN until lags
+            hours have been seen, or if any row of the window had a zero or missing value.
+        """
+        new_rows = np.asarray(new_rows, dtype=np.float32)
+        if self.stateful:
+            return self._step_stateful(new_rows)
+
+        observed = ~np.isnan(new_rows[:, self.value_index]) & (new_rows[:, self.value_index] != 0)
+        x = torch.from_numpy(self.x_scaler.transform(new_rows, copy=True))
+
+        # The window starting at this hour restarts from a zero state
+        start = self.t % self.lags
+        rows = slice(start * self.n_regions, (start + 1) * self.n_regions)
+        for h, c in self.states:
+            h[:, rows] = 0
+            c[:, rows] = 0
+        self.valid[start] = True
+        self.valid &= observed
+
+        with torch.no_grad():
+            # Same input as LSTMModel.forward for a single time step of every window
+            inputs = x.repeat(self.lags, 1)
+            if self.model.embedding is not None:
+                inputs = torch.cat([inputs, self.model.embedding(self.categories)], dim=1)
+            out1, self.states[0] = self.model.lstm1(inputs.unsqueeze(1), self.states[0])
+            out2, self.states[1] = self.model.lstm2(self.model.dropout1(out1), self.states[1])
+
+            # The window started lags - 1 hours ago is complete
+            end = (self.t + 1) % self.lags
+            last = self.model.dropout2(out2[end * self.n_regions:(end + 1) * self.n_regions, -1])
+            predictions = self.model.linear(last).numpy()
+
+        forecasts = self.y_scaler.inverse_transform(predictions).astype(np.float64)
+        if self.t < self.lags - 1:
+            forecasts[:] = np.nan
+        forecasts[~self.valid[end]] = np.nan
+        self.t += 1
+        return forecasts
+
+    def _step_stateful(self, new_rows):
+        inputs, observed = get_stream_inputs(new_rows, self.x_scaler, self.value_index)
+        with torch.no_grad():
+            predictions, self.states = self.model.forward_steps(torch.from_numpy(inputs).unsqueeze(1), self.categories, self.states)
+        forecasts = self.y_scaler.inverse_transform(predictions[:, 0].numpy()).astype(np.float64)
+        forecasts[~observed] = np.nan
+        self.t += 1
+        return forecasts
+
+def predict_stream(model, panel, x_scaler, y_scaler, value='surplus'):
+    """
+    Forecast every region of a panel with a stateful model, streaming each region from its first
+    hour in a single forward pass.
+
+    :param model: Stateful LSTMModel.
+    :param panel: Panel prepared with prepare_data.
+    :param x_scaler: Fitted SeriesScaler of the features.
+    :param y_scaler: Fitted SeriesScaler of the targets.
+    :param value: Name of the forecasted feature.
+    :return: Array (timestamp x region x horizon) with the forecasts, NaN where the observation is zero or missing.
+    """
+    inputs, observed = get_stream_inputs(panel.values, x_scaler, panel.feature_index(value))
+    model.eval()
+    with torch.no_grad():
+        predictions, _ = model.forward_steps(torch.from_numpy(np.ascontiguousarray(inputs.swapaxes(0, 1))), torch.arange(len(panel.regions)))
+    forecasts = y_scaler.inverse_transform(predictions.numpy().swapaxes(0, 1)).astype(np.float64)
+    forecasts[~observed] = np.nan
+    return forecasts
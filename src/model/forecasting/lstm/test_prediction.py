@@ -6,9 +6,8 @@ from src.data.prepare_data import load_data  # Adjust imports as needed
 from src.model.forecasting.lstm.test_training import prepare_data, create_sequences, LSTMModel  # Adjust import path
 from src.definitions import PREDICTIONS_DIR, MODELS_DIR
 import torch
-from sklearn.preprocessing import StandardScaler
 import json
-import joblib
+from src.data.scaling import SeriesScaler
 
 def load_model(model_path, input_size, cnn=False):
     # Model configuration
@@ -35,15 +34,14 @@ def main():
     x_predict, _ = create_sequences(validation.drop(['timestamp', 'series_id'], axis=1), lags=3)
     
     # Load the saved scalers
-    x_scaler_path = os.path.join(MODELS_DIR, 'forecasting/lstm', 'x_scaler.pkl')
-    x_scaler = joblib.load(x_scaler_path)
+    x_scaler_path = os.path.join(MODELS_DIR, 'forecasting/lstm', 'x_scaler.npz')
+    x_scaler = SeriesScaler.load(x_scaler_path)
 
-    # Normalize x_predict using the loaded scaler
-    x_predict_scaled = x_scaler.transform(x_predict.reshape(-1, x_predict.shape[2]))
-    x_predict_scaled = x_predict_scaled.reshape(-1, 3, x_predict.shape[2])  # 3 is the number of lags
+    # Normalize x_predict in place using the loaded scaler
+    x_scaler.transform(x_predict)
 
     # Convert to PyTorch tensor
-    x_predict_tensor = torch.tensor(x_predict_scaled, dtype=torch.float32)
+    x_predict_tensor = torch.from_numpy(x_predict)
 
     model_path = args.model
     input_size = x_predict.shape[2]  # Set the correct input size here
@@ -53,8 +51,8 @@ def main():
     with torch.no_grad():
         predictions = model(x_predict_tensor).numpy()
 
-    y_scaler_path = os.path.join(MODELS_DIR, 'forecasting/lstm', 'y_scaler.pkl')
-    y_scaler = joblib.load(y_scaler_path)
+    y_scaler_path = os.path.join(MODELS_DIR, 'forecasting/lstm', 'y_scaler.npz')
+    y_scaler = SeriesScaler.load(y_scaler_path)
     predictions = y_scaler.inverse_transform(predictions)
 
     # Ignore first 3 rows of validation by adding 3 nan predictions with (n, 1) shape
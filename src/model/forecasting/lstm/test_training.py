@@ -3,19 +3,17 @@ Enhanced script to train an LSTM model.
 """
 import pandas as pd
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data import DataLoader, Dataset
 import argparse
 import json
 import os
-from sklearn.preprocessing import StandardScaler, MinMaxScaler
 from sklearn.metrics import mean_squared_error
 from tqdm import tqdm
 import warnings
 from itertools import product
-from sklearn.model_selection import train_test_split
-import joblib
 
 warnings.filterwarnings('ignore', category=FutureWarning)
 
@@ -28,6 +26,7 @@ from src.data.prepare_data import (
     add_is_holiday,
     get_ohe_from_cat,
 )
+from src.data.scaling import SeriesScaler
 from src.definitions import MODELS_DIR, VAL_SIZE, SEED
 from src.config import setup_logger
 
@@ -73,14 +72,48 @@ def prepare_data(df):
     df.dropna(inplace=True)  # Drop rows with NaNs
     return df
 
+class WindowDataset(Dataset):
+    """
+    Lazy windows of lags rows of a series, labelled with the surplus of the row after them.
+
+    The windows are strided views of the values, so building the dataset copies nothing, and a
+    window is only materialized when indexed. Scale values and target in place, not the windows.
+
+    :param values: Array (row x feature) with the rows of every series, one block per series.
+    :param target: Array (row) with the surplus of every row.
+    :param starts: First row of every window, whose window and label rows belong to the same series.
+    :param lags: Length of the windows.
+    """
+    def __init__(self, values, target, starts, lags):
+        self.values = values
+        self.target = target
+        self.starts = starts
+        self.lags = lags
+        self.windows = np.swapaxes(sliding_window_view(values, lags, axis=0), 1, 2)  # (row - lags + 1 x lags x feature)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        start = self.starts[index]
+        return torch.from_numpy(np.array(self.windows[start])), torch.tensor(self.target[start + self.lags])
+
 def create_sequences(data, lags):
-    xs, ys = [], []
-    for i in range(len(data) - lags):
-        x = data.iloc[i:(i + lags)].to_numpy()
-        y = data.iloc[i + lags]['surplus']  # Assuming 'surplus' is your target variable
-        xs.append(x)
-        ys.append(y)
-    return np.array(xs), np.array(ys)
+    """
+    Create the windows of every series of a long frame, none of them crosses two series.
+
+    :param data: Long DataFrame with a series_id column, in time order within every series.
+    :return: WindowDataset over the features of the frame (without timestamp and series_id).
+    """
+    data = data.sort_values('series_id', kind='stable')
+    values = data.drop(['timestamp', 'series_id'], axis=1).to_numpy(dtype=np.float32)
+    target = data['surplus'].to_numpy(dtype=np.float32)  # Copy, the values are scaled separately
+
+    # Rows of the series blocks, a window needs lags rows and its label row in the same block
+    series = data['series_id'].to_numpy()
+    bounds = np.flatnonzero(np.r_[True, series[1:] != series[:-1], True])
+    starts = np.concatenate([np.arange(start, end - lags) for start, end in zip(bounds[:-1], bounds[1:])])
+    return WindowDataset(values, target, starts, lags)
 
 def train_model(model, train_loader, learning_rate=0.001, epochs=10):
     loss_function = nn.MSELoss()
@@ -124,44 +157,23 @@ def main():
     train, _ = load_data()
     train = prepare_data(train)
 
-    # Splitting data for validation
-    train_data, val_data = train_test_split(train, test_size=VAL_SIZE, random_state=SEED)
-    x_train, y_train = create_sequences(train_data.drop(['timestamp', 'series_id'], axis=1), lags=3)
-    x_val, y_val = create_sequences(val_data.drop(['timestamp', 'series_id'], axis=1), lags=3)
-
-    # Normalizing the data
-    if args.scaler == 'standard':
-        x_scaler = StandardScaler()
-        y_scaler = StandardScaler()
-    elif args.scaler == 'minmax':
-        x_scaler = MinMaxScaler()
-        y_scaler = MinMaxScaler()
-    else:
-        raise ValueError("Invalid scaler")
-
-    # Scale training data (features)
-    x_train_scaled = x_scaler.fit_transform(x_train.reshape(-1, x_train.shape[2]))
-    x_train_scaled = x_train_scaled.reshape(-1, 3, x_train.shape[2])  # 3 is the number of lags
-
-    # Scale validation data using the same scaler (features)
-    x_val_scaled = x_scaler.transform(x_val.reshape(-1, x_val.shape[2]))
-    x_val_scaled = x_val_scaled.reshape(-1, 3, x_val.shape[2])
-
-    # If you decide to use the same scaler for y
-    y_train_scaled = y_scaler.fit_transform(y_train.reshape(-1, 1)).flatten()
-    y_val_scaled = y_scaler.transform(y_val.reshape(-1, 1)).flatten()
+    # Splitting data for validation, the latest hours are held out so that windows stay contiguous
+    cutoff = train['timestamp'].quantile(1 - VAL_SIZE)
+    train_data = create_sequences(train[train['timestamp'] < cutoff], lags=3)
+    val_data = create_sequences(train[train['timestamp'] >= cutoff], lags=3)
 
-    # Convert to PyTorch tensors
-    x_train_tensor = torch.tensor(x_train_scaled, dtype=torch.float32)
-    y_train_tensor = torch.tensor(y_train_scaled, dtype=torch.float32)
-    x_val_tensor = torch.tensor(x_val_scaled, dtype=torch.float32)
-    y_val_tensor = torch.tensor(y_val_scaled, dtype=torch.float32)
+    # Normalizing the rows in place, the windows are views of them
+    x_scaler = SeriesScaler(args.scaler)
+    y_scaler = SeriesScaler(args.scaler)
+    x_scaler.fit_transform(train_data.values)
+    x_scaler.transform(val_data.values)
+    y_scaler.fit_transform(train_data.target[:, None])
+    y_scaler.transform(val_data.target[:, None])
 
-    # Create TensorDataset and DataLoader for data
-    train_data = TensorDataset(x_train_tensor, y_train_tensor)
+    # Create the DataLoaders, windows are materialized batch by batch
     train_loader = DataLoader(train_data, batch_size=64, shuffle=True)
-    val_data = TensorDataset(x_val_tensor, y_val_tensor)
     val_loader = DataLoader(val_data, batch_size=64, shuffle=False)
+    input_size = train_data.values.shape[1]
 
     CONFIG_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'model_config.json')
     if args.use_grid:
@@ -174,8 +186,8 @@ def main():
 
         for hidden_size, lr, epochs in product(hidden_layer_sizes, learning_rates, num_epochs):
             architecture = LSTMModel if not args.cnn else CNNLSTMModel
-            model = architecture(input_size=x_train_tensor.shape[2], hidden_layer_size=hidden_size)
-            # model = LSTMModel(input_size=x_train_tensor.shape[2], hidden_layer_size=hidden_size)
+            model = architecture(input_size=input_size, hidden_layer_size=hidden_size)
+            # model = LSTMModel(input_size=input_size, hidden_layer_size=hidden_size)
             train_model(model, train_loader, learning_rate=lr, epochs=epochs)
             
             val_loss = evaluate_model(model, val_loader, nn.MSELoss())
@@ -198,7 +210,7 @@ def main():
         # Load model configuration
         with open(CONFIG_PATH, 'r') as f:
             model_config = json.load(f)
-        model = LSTMModel(input_size=x_train_tensor.shape[2], hidden_layer_size=model_config['hidden_layer_size'])
+        model = LSTMModel(input_size=input_size, hidden_layer_size=model_config['hidden_layer_size'])
         train_model(model, train_loader, learning_rate=model_config['learning_rate'], epochs=model_config['epochs'])
 
     # Save Model
@@ -208,10 +220,10 @@ def main():
     logger.info(f"Model trained and saved at {model_path}")
 
     # Save scalers
-    x_scaler_path = os.path.join(MODELS_DIR, 'forecasting/lstm', 'x_scaler.pkl')
-    y_scaler_path = os.path.join(MODELS_DIR, 'forecasting/lstm', 'y_scaler.pkl')
-    joblib.dump(x_scaler, x_scaler_path)
-    joblib.dump(y_scaler, y_scaler_path)
+    x_scaler_path = os.path.join(MODELS_DIR, 'forecasting/lstm', 'x_scaler.npz')
+    y_scaler_path = os.path.join(MODELS_DIR, 'forecasting/lstm', 'y_scaler.npz')
+    x_scaler.save(x_scaler_path)
+    y_scaler.save(y_scaler_path)
     logger.info(f"Scalers saved at {x_scaler_path} and {y_scaler_path}")
 
 if __name__ == "__main__":
@@ -6,6 +6,7 @@ import argparse
 import os
 
 # Data related imports
+import numpy as np
 import xgboost as xgb
 
 # Local imports
@@ -13,13 +14,20 @@ from src.definitions import (
     PREDICTIONS_DIR,
     XGBOOST_LAGS,
 )
-from src.data.prepare_data import load_data
+from src.data.prepare_data import (
+    load_data,
+    get_panel_features,
+)
 from src.model.forecasting.xgboost.model_training import prepare_data
+from src.model.partitioning import PartitionedModel
 
 ### GENERAL FUNCTIONS ###
 
 def load_model(model_path):
-    model = xgb.XGBRegressor()
+    if os.path.isdir(model_path):
+        # Partitioned model, which routes every region to its own booster
+        return PartitionedModel.load(model_path)
+    model = xgb.XGBRegressor(enable_categorical=True)
     model.load_model(model_path)
     return model
 
@@ -27,7 +35,7 @@ def load_model(model_path):
 
 def main():
     parser = argparse.ArgumentParser(description='Make predictions')
-    parser.add_argument('--model', type=str, help='Path to model')
+    parser.add_argument('--model', type=str, help='Path to model, or to the directory of a partitioned model')
     args = parser.parse_args()
 
     model_path = args.model
@@ -36,21 +44,27 @@ def main():
     # Load and prepare prediction data
     _, validation = load_data()
     validation = prepare_data(validation, lags=XGBOOST_LAGS)
-    x_predict = validation.drop(['timestamp', 'series_id'], axis=1)  # Drop non-feature columns
+    x_predict, mask = get_panel_features(validation)
 
-    # Make predictions
+    # Make predictions, rows with zero or missing surplus are not forecasted
     predictions = model.predict(x_predict)
+    predictions[~mask] = np.nan
 
-    # Convert predictions back to original format
-    validation['predicted_surplus'] = predictions
-    pivoted_df = validation.pivot(index='timestamp', columns='series_id', values='predicted_surplus')
+    # Multi-output models forecast 1..horizons hours ahead, the next hour is the first horizon
+    forecasts = validation.unstack(predictions)
+    if forecasts.ndim == 3:
+        horizons = list(range(1, forecasts.shape[2] + 1))
+        horizon_df = validation.to_horizon_predictions_frame(forecasts, horizons)
+        horizon_path = os.path.join(PREDICTIONS_DIR, 'xgboost_reg_horizon_predictions.json')
+        horizon_df.to_json(horizon_path, orient='records')
+        print(f"Multi-horizon predictions saved to {horizon_path}")
+        forecasts = forecasts[:, :, 0]
 
-    # Get the maximum country code for each row (timestamp)
-    max_col = pivoted_df.idxmax(axis=1)
-    pivoted_df['target'] = max_col
+    # Get the maximum country code for each timestamp from the (timestamp x region) forecasts
+    predictions_df = validation.to_predictions_frame(forecasts)
 
     predictions_path = os.path.join(PREDICTIONS_DIR, 'xgboost_reg_predictions.json')
-    pivoted_df.reset_index()[['timestamp', 'target']].to_json(predictions_path, orient='records')
+    predictions_df.to_json(predictions_path, orient='records')
 
     print(f"Predictions saved to {predictions_path}")
 
@@ -5,40 +5,61 @@ Script to train a regression model using XGBoost.
 import argparse
 import json
 import os
+import time
 import warnings
 warnings.filterwarnings('ignore', category=FutureWarning)
 
 # Data related imports
 import numpy as np
 from sklearn.metrics import mean_squared_error
-from sklearn.model_selection import (
-    train_test_split, 
-    GridSearchCV,
-)
+from sklearn.model_selection import train_test_split
 import xgboost as xgb
 
 # Local imports
 from src.data.prepare_data import (
     load_data,
-    add_is_weekend,
     get_surplus,
-    get_forecast_target,
-    convert_to_timeseries,
-    get_lags,
-    add_is_holiday,
-    get_ohe_from_cat,
+    get_panel,
+    get_panel_features,
+    get_panel_lags,
+    get_panel_horizon_targets,
+    add_panel_calendar,
 )
+from src.data.calendar_features import CALENDAR_FEATURES
 from src.definitions import (
     MODELS_DIR,
-    SEED,
+    REPORTS_DIR,
     VAL_SIZE,
     XGBOOST_LAGS,
 )
+from src.model.tuning import (
+    TUNERS,
+    get_configs,
+    tune,
+)
+from src.model.artifacts import save_artifact
+from src.model.partitioning import (
+    PartitionedModel,
+    get_partitions,
+    get_partition_rows,
+    fit_partitions,
+    evaluate,
+    write_report,
+)
+from src.model.gbm_datasets import (
+    get_folds,
+    get_xgb_dataset,
+    get_xgb_params,
+    take,
+)
 from src.config import setup_logger
 
 # Setup logger
 logger = setup_logger()
 
+# Parameters shared by every configuration of the searches
+BASE_CONFIG = {'enable_categorical': True, 'tree_method': 'hist'}
+
 ### GENERAL FUNCTIONS ###
 
 def prepare_data(df, lags):
@@ -47,28 +68,87 @@ def prepare_data(df, lags):
     
     :param df: DataFrame containing the data.
     :param lags: List of lags to use for the model.
+    :return: Panel with the features of every region.
     """
-    df = add_is_weekend(df)
     df = get_surplus(df)
-    df = convert_to_timeseries(df, metadata_columns=['is_weekend'])
-    df = get_lags(df, lags=lags)
-    df = add_is_holiday(df)
-    df = get_ohe_from_cat(df, cat='series_id')
 
-    df = df.replace(0, np.nan)  # Replace 0s with NaNs
-    df.dropna(inplace=True)  # Drop rows with NaNs created by lagging and shifting
-    return df
+    lag_features = [f'surplus_lag_{lag}' for lag in lags]
+    panel = get_panel(df, features=['surplus'] + lag_features + CALENDAR_FEATURES)
+    panel = get_panel_lags(panel, lags=lags)
+    panel = add_panel_calendar(panel)
+    return panel
+
+def get_train_fn(dfit, x_tune, y_tune):
+    """
+    Get the training function of the tuner, which continues boosting a model up to a number of rounds.
+
+    :param dfit: QuantileDMatrix to fit the models.
+    :param x_tune: Features to score the models.
+    :param y_tune: Target to score the models.
+    :return: Function (config, budget, state) -> (validation MSE, booster).
+    """
+    def train_fn(config, budget, state):
+        rounds = state.num_boosted_rounds() if state is not None else 0
+        params, _ = get_xgb_params({**BASE_CONFIG, **config})
+        booster = xgb.train(params, dfit, num_boost_round=budget - rounds, xgb_model=state)
+        return mean_squared_error(y_tune, booster.inplace_predict(x_tune)), booster
+    return train_fn
+
+def grid_search(x_train, y_train, dtrain, param_grid, n_splits=2):
+    """
+    Score every configuration of a grid with the mean MSE of a k-fold cross-validation, as
+    GridSearchCV does, on fold matrices quantized with the cuts of the training matrix.
+
+    Each configuration is boosted once per fold up to the largest n_estimators of the grid, the
+    smaller ones are scored on the first rounds of the same model.
+
+    :param x_train: Training features.
+    :param y_train: Training target.
+    :param dtrain: QuantileDMatrix of the training data.
+    :param param_grid: Dictionary of XGBRegressor parameter names to lists of values, with n_estimators.
+    :param n_splits: Number of folds.
+    :return: Best configuration and its mean MSE.
+    """
+    folds = [
+        (get_xgb_dataset(take(x_train, fit), take(y_train, fit), ref=dtrain), take(x_train, score), take(y_train, score))
+        for fit, score in get_folds(len(y_train), n_splits)
+    ]
+    n_estimators = sorted(param_grid['n_estimators'])
+    results = []
+    for config in get_configs({key: values for key, values in param_grid.items() if key != 'n_estimators'}):
+        params, _ = get_xgb_params({**BASE_CONFIG, **config})
+        scores = np.zeros((len(folds), len(n_estimators)))
+        for i, (dfit, x_score, y_score) in enumerate(folds):
+            booster = xgb.train(params, dfit, num_boost_round=n_estimators[-1])
+            for j, rounds in enumerate(n_estimators):
+                scores[i, j] = mean_squared_error(y_score, booster.inplace_predict(x_score, iteration_range=(0, rounds)))
+        for j, rounds in enumerate(n_estimators):
+            results.append(({**config, 'n_estimators': rounds}, scores[:, j].mean()))
+            logger.info(f"Grid search {results[-1][0]}: mean MSE {results[-1][1]}")
+    return min(results, key=lambda result: result[1])
 
 ### MAIN ###
 
 def parser_add_arguments(parser):
     parser.add_argument('--use-grid', action='store_true', help='Use grid search for model tuning')
+    parser.add_argument('--tuner', type=str, default='grid', choices=TUNERS, help='Search used with --use-grid')
+    parser.add_argument('--horizons', type=int, default=1, help='Forecast 1..horizons hours ahead with a single multi-output model')
+    parser.add_argument('--early-stopping-rounds', type=int, default=50, help='Rounds without validation improvement before stopping (0 to disable)')
+    parser.add_argument('--refresh', action='store_true', help='Append boosting rounds on the recent data to the current model instead of a full fit')
+    parser.add_argument('--refresh-hours', type=int, default=168, help='Latest hours of the training data boosted on with --refresh')
+    parser.add_argument('--refresh-rounds', type=int, default=50, help='Maximum number of rounds appended with --refresh')
+    parser.add_argument('--partition', action='store_true', help='Also fit one model per region (or cluster) and report it against the global one')
+    parser.add_argument('--clusters', type=int, default=None, help='Number of clusters of correlated regions with --partition (default: one model per region)')
+    parser.add_argument('--cpu-budget', type=int, default=None, help='Threads shared by the partition fits (default: number of cores)')
+    parser.add_argument('--partition-jobs', type=int, default=None, help='Number of concurrent partition fits (default: as many as the budget allows)')
     return parser
 
 def main():
     parser = argparse.ArgumentParser(description='Train XGBoost model')
     parser_add_arguments(parser)
     args = parser.parse_args()
+    if args.refresh and (args.use_grid or args.partition):
+        parser.error('--refresh continues the current model, it cannot be combined with --use-grid or --partition')
 
     # Load data
     train, _, = load_data()
@@ -76,58 +156,141 @@ def main():
     # Data Preparation
     logger.info("Preparing data...")
     train = prepare_data(train, lags=XGBOOST_LAGS)
-    train = get_forecast_target(train, prediction_horizon=1)
-    train.dropna(subset=['target'], inplace=True)
+    features, mask = get_panel_features(train)  # Rows with zero or missing surplus are masked out
+    horizons = list(range(1, args.horizons + 1))
+    target = get_panel_horizon_targets(train, horizons).reshape(-1, len(horizons))
+    mask &= ~np.isnan(target).any(axis=1)
+    if len(horizons) == 1:
+        target = target[:, 0]
 
+    # The latest rows are held out, so that early stopping is scored on the future of the training data
     x_train, x_val, y_train, y_val = train_test_split(
-        train.drop(['timestamp', 'target', 'series_id'], axis=1),
-        train['target'],
+        features[mask],
+        target[mask],
         test_size=VAL_SIZE,
-        random_state=SEED
+        shuffle=False,
     )
+    if args.refresh:
+        # The older rows are already learnt by the current model, long row t * regions + r is at timestamp t.
+        # The window ends at the last hour of the training rows, the validation hours are held out after it
+        hours = x_train.index // len(train.regions)
+        recent = hours > hours.max() - args.refresh_hours
+        if not recent.any():
+            parser.error(f"No training rows in the latest {args.refresh_hours} hours to refresh on")
+        x_train, y_train = x_train[recent], y_train[recent]
+        logger.info(f"Refreshing on the latest {args.refresh_hours} hours of the training rows ({len(x_train)} rows)")
+
+    # Quantize the training data once, every fit below reuses its bins
+    dtrain = get_xgb_dataset(x_train, y_train)
+    dval = get_xgb_dataset(x_val, y_val, ref=dtrain)
 
     CONFIG_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'model_config.json')
     if args.use_grid:
-        # Grid Search
-        param_grid = {
-            'n_estimators': [100, 500, 1000],
-            'max_depth': [3, 6, 10],
-            'learning_rate': [0.01, 0.05, 0.1],
-        }
-        grid_search = GridSearchCV(
-            estimator=xgb.XGBRegressor(),
-            param_grid=param_grid,
-            scoring='neg_mean_squared_error',
-            cv=2,
-            verbose=2
-        )
-        grid_search.fit(x_train, y_train)
-        best_model = grid_search.best_estimator_
+        if args.tuner != 'grid':
+            # Adaptive search over the boosting rounds, scored on the latest rows of the training data
+            x_fit, x_tune, y_fit, y_tune = train_test_split(x_train, y_train, test_size=VAL_SIZE, shuffle=False)
+            configs = get_configs({
+                'max_depth': [3, 6, 10],
+                'learning_rate': [0.01, 0.05, 0.1],
+            })
+            train_fn = get_train_fn(get_xgb_dataset(x_fit, y_fit, ref=dtrain), x_tune, y_tune)
+            best, _ = tune(args.tuner, configs, train_fn, min_budget=100, max_budget=1000)
+            best_config = {**best['config'], 'n_estimators': best['budget']}
+        else:
+            # Grid Search
+            param_grid = {
+                'n_estimators': [100, 500, 1000],
+                'max_depth': [3, 6, 10],
+                'learning_rate': [0.01, 0.05, 0.1],
+            }
+            best_config, _ = grid_search(x_train, y_train, dtrain, param_grid)
 
-        # Save grid search best parameters to config
+        # Save the best parameters to config, the model is refit on the whole training data below
+        model_config = xgb.XGBRegressor(**BASE_CONFIG, **best_config).get_params()
         with open(CONFIG_PATH, 'w') as f:
-            json.dump(best_model.get_params(), f)
+            json.dump(model_config, f)
     else:
         # Load model configuration
         with open(CONFIG_PATH, 'r') as f:
             model_config = json.load(f)
 
-        best_model = xgb.XGBRegressor(**model_config)
-
-        # Train model
-        print("Training model...")
-        best_model.fit(x_train, y_train)
+    # Train model, n_estimators is the maximum number of rounds with early stopping
+    logger.info("Training model...")
+    model_path = os.path.join(MODELS_DIR, 'forecasting', 'xgboost', 'model.json')
+    params, num_boost_round = get_xgb_params(model_config)
+    current_model = None
+    if args.refresh:
+        # Continue from the rounds the current model predicts with, dropping the ones after its best iteration
+        current_model = xgb.Booster(model_file=model_path)
+        if current_model.attr('best_iteration') is not None:
+            current_model = current_model[:int(current_model.attr('best_iteration')) + 1]
+            current_model.set_attr(best_iteration=None, best_score=None)
+        current_mse = mean_squared_error(y_val, current_model.inplace_predict(x_val))
+        logger.info(f"Validation MSE of the current model: {current_mse}")
+        num_boost_round = args.refresh_rounds
+    start = time.perf_counter()
+    best_model = xgb.train(
+        params, 
+        dtrain, 
+        num_boost_round=num_boost_round, 
+        evals=[(dval, 'validation')], 
+        early_stopping_rounds=args.early_stopping_rounds or None, 
+        verbose_eval=False,
+        xgb_model=current_model,
+    )
+    fit_time = time.perf_counter() - start
 
-    # Validate model
-    predictions = best_model.predict(x_val)
+    # Validate model, with the rounds up to the best iteration as the saved model predicts
+    rounds = best_model.best_iteration + 1 if args.early_stopping_rounds else best_model.num_boosted_rounds()
+    logger.info(f"Best iteration {rounds} of {best_model.num_boosted_rounds()} rounds")
+    predictions = best_model.inplace_predict(x_val, iteration_range=(0, rounds))
     val_mse = mean_squared_error(y_val, predictions)
     logger.info(f"Validation MSE: {val_mse}")
+    if args.refresh and val_mse >= current_mse:
+        # Even the first new round is worse, none is kept and no new version is saved
+        logger.info(f"The refresh does not improve the validation MSE ({current_mse}), the current model is kept")
+        return
 
     # Save Model
-    model_path = os.path.join(MODELS_DIR, 'forecasting', 'xgboost', 'model.json')
-    os.makedirs(os.path.dirname(model_path), exist_ok=True)
-    best_model.save_model(model_path)
-    logger.info(f"Model trained and saved at {model_path}")
+    version_path = save_artifact(model_path, best_model.save_model)
+    logger.info(f"Model trained and saved at {model_path} (version {version_path})")
+
+    if args.partition:
+        # One model per partition with the same configuration, each early stopped on its own validation rows
+        partitions = get_partitions(train, args.clusters)
+
+        def fit_partition(name, regions, threads):
+            fit_rows, val_rows = get_partition_rows(x_train, regions), get_partition_rows(x_val, regions)
+            dfit = get_xgb_dataset(take(x_train, fit_rows), take(y_train, fit_rows))
+            return xgb.train(
+                {**params, 'nthread': threads},
+                dfit,
+                num_boost_round=num_boost_round,
+                evals=[(get_xgb_dataset(take(x_val, val_rows), take(y_val, val_rows), ref=dfit), 'validation')],
+                early_stopping_rounds=args.early_stopping_rounds or None,
+                verbose_eval=False,
+            )
+
+        start = time.perf_counter()
+        models, fit_times = fit_partitions(fit_partition, partitions, args.cpu_budget, args.partition_jobs)
+        partitioned_model = PartitionedModel(models, partitions)
+        results = {
+            'global': {'fit': fit_time, **evaluate(best_model, x_val, y_val, train, x_val.index.to_numpy())},
+            'partitioned': {'fit': time.perf_counter() - start, **evaluate(partitioned_model, x_val, y_val, train, x_val.index.to_numpy())},
+        }
+        report = write_report(
+            os.path.join(REPORTS_DIR, 'xgboost_partitioned_report.txt'),
+            f"XGBoost partitioned ({len(partitions)} partitions) vs global model",
+            partitions,
+            fit_times,
+            {name: len(get_partition_rows(x_train, regions)) for name, regions in partitions.items()},
+            results,
+        )
+        print(report)
+
+        partitioned_path = os.path.join(MODELS_DIR, 'forecasting', 'xgboost', 'partitioned')
+        partitioned_model.save(partitioned_path)
+        logger.info(f"Partitioned model saved at {partitioned_path}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
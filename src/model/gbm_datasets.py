@@ -0,0 +1,135 @@
+"""
+Script containing the binned training datasets shared by the boosting models.
+
+Histogram-based boosting quantizes every feature into bins before growing any tree. Fitting the
+sklearn estimators on DataFrames repeats that work on every fit, so a grid search pays it once per
+grid point and fold. The datasets built here are quantized once and reused by every fit:
+
+- XGBoost: a QuantileDMatrix of the training data. The matrices of the folds and of the validation
+  data take it as reference, so they reuse its quantile cuts instead of sketching their own.
+- LightGBM: a constructed lgb.Dataset. The folds are subsets of it, which share its bins.
+
+LightGBM datasets can also be cached on disk as binary files keyed by a hash of the data and the
+binning parameters, so retrains on unchanged data load the bins instead of recomputing them.
+XGBoost can only save plain DMatrix objects, not quantized ones, so its matrices are kept in memory.
+"""
+# General imports
+import hashlib
+import json
+import os
+
+# Data related imports
+import numpy as np
+import pandas as pd
+import lightgbm as lgb
+from sklearn.model_selection import KFold
+import xgboost as xgb
+
+# Local imports
+from src.definitions import INTERIM_DATA_DIR
+from src.config import setup_logger
+
+# Setup logger
+logger = setup_logger()
+
+CACHE_DIR = os.path.join(INTERIM_DATA_DIR, 'datasets')
+
+# Parameters of the sklearn estimators that are not LightGBM training parameters
+LGB_SKLEARN_PARAMS = ('class_weight', 'importance_type')
+
+### GENERAL FUNCTIONS ###
+
+def get_data_hash(x, y, params=None):
+    """
+    Get a hash of a feature matrix, its target and the parameters used to bin them.
+
+    :param x: Feature DataFrame.
+    :param y: Target array.
+    :param params: Dictionary of binning parameters.
+    :return: Hexadecimal digest.
+    """
+    digest = hashlib.sha1()
+    digest.update(','.join(map(str, x.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(x, index=False).to_numpy().tobytes())
+    digest.update(np.ascontiguousarray(y, dtype=np.float64).tobytes())
+    digest.update(json.dumps(params or {}, sort_keys=True, default=str).encode())
+    return digest.hexdigest()[:16]
+
+def get_folds(n_rows, n_splits=2):
+    """
+    Get the (fit, score) row indexes of the folds of a grid search, as GridSearchCV splits them.
+    """
+    return list(KFold(n_splits=n_splits).split(np.arange(n_rows)))
+
+def take(values, indexes):
+    """
+    Get rows of a DataFrame or an array by position.
+    """
+    return values.iloc[indexes] if isinstance(values, (pd.DataFrame, pd.Series)) else values[indexes]
+
+### XGBOOST ###
+
+def get_xgb_dataset(x, y=None, ref=None, max_bin=256):
+    """
+    Get a QuantileDMatrix of the data.
+
+    :param x: Feature DataFrame.
+    :param y: Target, None for prediction data.
+    :param ref: QuantileDMatrix whose quantile cuts are reused, None to compute them from x.
+    :param max_bin: Maximum number of bins per feature.
+    """
+    return xgb.QuantileDMatrix(x, y, enable_categorical=True, max_bin=max_bin, ref=ref)
+
+def get_xgb_params(config):
+    """
+    Get the xgb.train parameters and number of rounds of an XGBRegressor configuration.
+
+    :param config: Dictionary of XGBRegressor parameters, as saved in model_config.json.
+    :return: Tuple of the parameters dictionary and the number of boosting rounds.
+    """
+    model = xgb.XGBRegressor(**config)
+    return model.get_xgb_params(), model.n_estimators or 100
+
+### LIGHTGBM ###
+
+def get_lgb_params(config):
+    """
+    Get the lgb.train parameters and number of rounds of an LGBMRegressor configuration.
+
+    :param config: Dictionary of LGBMRegressor parameters, as saved in model_config.json.
+    :return: Tuple of the parameters dictionary and the number of boosting rounds.
+    """
+    params = {
+        key: value for key, value in lgb.LGBMRegressor(**config).get_params().items()
+        if value is not None and key not in LGB_SKLEARN_PARAMS
+    }
+    params['objective'] = config.get('objective') or 'regression'
+    params['verbose'] = -1
+    return params, params.pop('n_estimators')
+
+def get_lgb_dataset(x, y, params=None, cache=False):
+    """
+    Get a constructed lgb.Dataset of the data, loaded from the cache if it was saved before.
+
+    The raw data is kept in memory to allow continued training from an init_model.
+
+    :param x: Feature DataFrame.
+    :param y: Target array.
+    :param params: Dictionary of LightGBM parameters, only the binning ones are used.
+    :param cache: Whether to load and save the binned dataset in CACHE_DIR.
+    """
+    # Pre-filtering depends on min_data_in_leaf, which would tie the bins to one configuration
+    params = {'verbose': -1, **(params or {}), 'feature_pre_filter': False}
+    binning_params = {key: params.get(key) for key in ('max_bin', 'min_data_in_bin', 'subsample_for_bin', 'feature_pre_filter')}
+
+    path = os.path.join(CACHE_DIR, f'lgb_{get_data_hash(x, y, binning_params)}.bin')
+    if cache and os.path.exists(path):
+        logger.info(f"Loading the binned dataset from {path}")
+        return lgb.Dataset(path, params=params, free_raw_data=False).construct()
+
+    dataset = lgb.Dataset(x, y, params=params, free_raw_data=False).construct()
+    if cache:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        dataset.save_binary(path)
+        logger.info(f"Binned dataset saved at {path}")
+    return dataset
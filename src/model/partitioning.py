@@ -0,0 +1,241 @@
+"""
+Script containing the per-region partitioned boosting models.
+
+The forecasters are global models fitted on the long rows of every region. A partitioned model
+fits one booster per region instead, or per cluster of regions with correlated surplus, and routes
+every row to the booster of its series_id:
+
+- The boosters are fitted concurrently in a thread pool. XGBoost and LightGBM release the GIL in
+  their C++ cores, so the threads run in parallel on the shared training data without copying it.
+  The CPU budget is split between the concurrent fits.
+- PartitionedModel predicts a feature matrix with a single batched call per booster, on the rows of
+  the regions of its partition, and scatters the results back in the row order.
+
+A partitioned model is saved as a directory with partitions.json and one model file per partition.
+"""
+# General imports
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import time
+
+# Data related imports
+import numpy as np
+import pandas as pd
+import lightgbm as lgb
+from sklearn.cluster import AgglomerativeClustering
+from sklearn.metrics import mean_squared_error
+import xgboost as xgb
+
+# Local imports
+from src.data.panel import max_region
+from src.data.prepare_data import get_panel_horizon_targets
+from src.metrics import get_model_performance
+from src.config import setup_logger
+
+# Setup logger
+logger = setup_logger()
+
+LIBRARIES = {
+    'xgboost': '.json',
+    'lightgbm': '.txt',
+}
+
+### GENERAL FUNCTIONS ###
+
+def get_partitions(panel, n_clusters=None):
+    """
+    Get the regions of every partition: one partition per region, or clusters of the regions whose
+    surplus series are correlated (average linkage on 1 - correlation).
+
+    :param panel: Panel with the surplus of every region.
+    :param n_clusters: Number of clusters, None for one partition per region.
+    :return: Dictionary of partition name -> list of regions.
+    """
+    if not n_clusters:
+        return {region: [region] for region in panel.regions}
+
+    correlation = pd.DataFrame(panel['surplus'], columns=panel.regions).corr().fillna(0).to_numpy()
+    labels = AgglomerativeClustering(n_clusters=n_clusters, metric='precomputed', linkage='average').fit_predict(1 - correlation)
+    return {
+        f'cluster_{label}': [region for region, region_label in zip(panel.regions, labels) if region_label == label]
+        for label in sorted(set(labels))
+    }
+
+def get_partition_rows(x, regions):
+    """
+    Get the positions of the rows of a feature DataFrame that belong to some regions.
+    """
+    return np.flatnonzero(x['series_id'].isin(regions).to_numpy())
+
+def fit_partitions(fit, partitions, cpu_budget=None, jobs=None):
+    """
+    Fit the model of every partition in a thread pool under a CPU budget.
+
+    :param fit: Function (name, regions, threads) -> model.
+    :param partitions: Dictionary of partition name -> list of regions.
+    :param cpu_budget: Total number of threads, None for the number of cores.
+    :param jobs: Number of concurrent fits, None to run as many as the budget allows.
+    :return: Dictionary of partition name -> model, and of partition name -> fit seconds.
+    """
+    cpu_budget = cpu_budget or os.cpu_count() or 1
+    jobs = jobs or min(len(partitions), cpu_budget)
+    threads = max(1, cpu_budget // jobs)
+    logger.info(f"Fitting {len(partitions)} partitions, {jobs} at a time with {threads} threads each")
+
+    def timed_fit(name, regions):
+        start = time.perf_counter()
+        model = fit(name, regions, threads)
+        return model, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {name: executor.submit(timed_fit, name, regions) for name, regions in partitions.items()}
+        results = {name: future.result() for name, future in futures.items()}
+    return {name: model for name, (model, _) in results.items()}, {name: seconds for name, (_, seconds) in results.items()}
+
+def get_f1(panel, rows, predictions):
+    """
+    Get the F1 score of the maximum surplus region of the next hour, on the timestamps of some long rows.
+
+    :param panel: Panel the long rows (t * regions + r) belong to.
+    :param rows: Positions of the predicted long rows.
+    :param predictions: Next hour surplus forecast of every row.
+    """
+    forecasts = np.full(panel.shape[0] * panel.shape[1], np.nan)
+    forecasts[rows] = predictions
+    timestamps = np.unique(rows // panel.shape[1])
+    actual = max_region(get_panel_horizon_targets(panel, [1])[timestamps, :, 0])
+    predicted = max_region(panel.unstack(forecasts)[timestamps])
+    scored = pd.notna(actual) & pd.notna(predicted)
+    return get_model_performance(list(actual[scored]), list(predicted[scored]))[0]
+
+### MODEL ###
+
+def predict_booster(model, x):
+    """
+    Predict a feature DataFrame with an XGBoost or LightGBM booster, up to its best iteration.
+    """
+    if isinstance(model, xgb.Booster):
+        best_iteration = model.attr('best_iteration')
+        rounds = int(best_iteration) + 1 if best_iteration is not None else model.num_boosted_rounds()
+        return model.inplace_predict(x, iteration_range=(0, rounds))
+    return model.predict(x)
+
+class PartitionedModel:
+    """
+    Routing predictor over the boosters of the partitions of the regions.
+
+    :param models: Dictionary of partition name -> XGBoost or LightGBM booster.
+    :param partitions: Dictionary of partition name -> list of regions.
+    """
+    def __init__(self, models, partitions):
+        self.models = models
+        self.partitions = partitions
+
+    def predict(self, x):
+        """
+        Predict a feature DataFrame with a series_id column, with one call per booster.
+
+        :param x: Feature DataFrame.
+        :return: Array of predictions in the row order of x, NaN for the rows of unknown regions.
+        """
+        predictions = None
+        for name, regions in self.partitions.items():
+            rows = get_partition_rows(x, regions)
+            if not len(rows):
+                continue
+            values = predict_booster(self.models[name], x.iloc[rows])
+            if predictions is None:
+                predictions = np.full((len(x),) + values.shape[1:], np.nan)
+            predictions[rows] = values
+        return predictions if predictions is not None else np.full(len(x), np.nan)
+
+    def save(self, path):
+        """
+        Save the partitions and the boosters in a directory.
+        """
+        os.makedirs(path, exist_ok=True)
+        library = 'xgboost' if isinstance(next(iter(self.models.values())), xgb.Booster) else 'lightgbm'
+        for name, model in self.models.items():
+            model.save_model(os.path.join(path, name + LIBRARIES[library]))
+        with open(os.path.join(path, 'partitions.json'), 'w') as f:
+            json.dump({'library': library, 'partitions': self.partitions}, f)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a partitioned model saved with save.
+        """
+        with open(os.path.join(path, 'partitions.json'), 'r') as f:
+            spec = json.load(f)
+        load = (lambda file: xgb.Booster(model_file=file)) if spec['library'] == 'xgboost' else (lambda file: lgb.Booster(model_file=file))
+        models = {name: load(os.path.join(path, name + LIBRARIES[spec['library']])) for name in spec['partitions']}
+        return cls(models, spec['partitions'])
+
+### REPORT ###
+
+def get_size(model):
+    """
+    Get the serialized size in bytes of a booster or a partitioned model.
+    """
+    if isinstance(model, PartitionedModel):
+        return sum(get_size(booster) for booster in model.models.values())
+    if isinstance(model, xgb.Booster):
+        return len(model.save_raw('json'))
+    return len(model.model_to_string())
+
+def evaluate(model, x, y, panel, rows):
+    """
+    Get the validation MSE, F1, prediction latency and size of a booster or a partitioned model.
+
+    :param model: Booster or PartitionedModel.
+    :param x: Validation features, stacked per horizon for LightGBM multi-horizon models.
+    :param y: Validation target.
+    :param panel: Panel the validation rows belong to.
+    :param rows: Long rows of the panel of the validation features, before any stacking.
+    :return: Dictionary with the MSE ('mse'), F1 ('f1'), prediction seconds ('predict') and size in bytes ('size').
+    """
+    start = time.perf_counter()
+    predictions = model.predict(x) if isinstance(model, PartitionedModel) else predict_booster(model, x)
+    latency = time.perf_counter() - start
+
+    # Multi-output models have one column per horizon, stacked ones the rows of the first horizon first
+    next_hour = predictions[:, 0] if predictions.ndim > 1 else predictions[:len(rows)]
+    return {
+        'mse': mean_squared_error(y, predictions),
+        'f1': get_f1(panel, rows, next_hour),
+        'predict': latency,
+        'size': get_size(model),
+    }
+
+def write_report(path, title, partitions, fit_times, rows_per_partition, results):
+    """
+    Write the accuracy and cost of the partitioned model against the global one.
+
+    :param path: Path of the report.
+    :param title: First line of the report.
+    :param partitions: Dictionary of partition name -> list of regions.
+    :param fit_times: Dictionary of partition name -> fit seconds.
+    :param rows_per_partition: Dictionary of partition name -> number of training rows.
+    :param results: Dictionary of model ('global', 'partitioned') -> dictionary with the fit wall time
+        ('fit'), validation MSE ('mse'), F1 ('f1'), prediction latency of the validation rows ('predict')
+        and size in bytes ('size').
+    :return: Report text.
+    """
+    lines = [title, '', f"{'partition':<12} {'regions':<28} {'rows':>8} {'fit (s)':>8}"]
+    for name, regions in partitions.items():
+        lines.append(f"{name:<12} {' '.join(regions):<28} {rows_per_partition[name]:>8} {fit_times[name]:>8.2f}")
+    lines.extend([
+        '',
+        f"{'model':<12} {'fit (s)':>8} {'val MSE':>10} {'F1':>7} {'predict (ms)':>13} {'size (KB)':>10}",
+    ])
+    for name, result in results.items():
+        lines.append(
+            f"{name:<12} {result['fit']:>8.2f} {result['mse']:>10.2f} {result['f1']:>7.4f} "
+            f"{result['predict'] * 1e3:>13.2f} {result['size'] / 1024:>10.1f}"
+        )
+    report = '\n'.join(lines)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(report + '\n')
+    return report
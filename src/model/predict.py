@@ -0,0 +1,240 @@
+"""
+Script to predict with any set of trained models in a single process.
+
+Every model_prediction.py script loads the data, prepares its own features and decodes its own
+predictions. This engine loads the prediction data once and prepares one panel with the features of
+every model (surplus, surplus lags and calendar features). The models then read float32 matrices
+built from that panel, each one at most once:
+
+- long: (timestamp * region x feature) with the region code as last column, for the boosting forecasters.
+- wide: (timestamp x region surplus + weekend + current maximum region), for the classifier.
+- sequence panel: the surplus and calendar features, for the LSTM and the TCN.
+- panel: the (timestamp x region x feature) values, for the linear student.
+
+The boosters predict these arrays in place, with the same bits as the DataFrames of the scripts.
+The maximum surplus region is decoded with a numpy argmax over the (timestamp x region) forecasts,
+and every model writes the same prediction files as its script.
+"""
+# General imports
+import argparse
+import os
+import threading
+import time
+import warnings
+warnings.filterwarnings('ignore', category=FutureWarning)
+
+# Data related imports
+import numpy as np
+import pandas as pd
+import lightgbm as lgb
+import xgboost as xgb
+
+# Local imports
+from src.definitions import (
+    MODELS_DIR,
+    PREDICTIONS_DIR,
+    PROCESSED_DATA_DIR,
+    XGBOOST_LAGS,
+    LIGHTGBM_LAGS,
+)
+from src.data.calendar_features import CALENDAR_FEATURES
+from src.data.panel import Panel
+from src.data.scaling import SeriesScaler
+from src.model.distillation import (
+    STUDENT_PATH,
+    LinearStudent,
+)
+from src.model.forecasting.xgboost.model_training import prepare_data
+from src.model.forecasting.lightgbm.model_prediction import load_horizons
+from src.model.forecasting.lstm.model_prediction import (
+    load_runtime,
+    predict_panel,
+)
+from src.model.forecasting.lstm.sequences import get_artifact_path
+from src.model.partitioning import predict_booster
+from src.config import setup_logger
+
+# Setup logger
+logger = setup_logger()
+
+### FEATURES ###
+
+class SharedFeatures:
+    """
+    Feature matrices of every model, built once from the panel of the prediction data. The matrices
+    are built under a lock, so models predicting in parallel threads share them.
+
+    :param panel: Panel prepared with the surplus lags of every boosting model and the calendar features.
+    """
+    def __init__(self, panel):
+        self.panel = panel
+        self._long = None
+        self._wide = None
+        self._lock = threading.Lock()
+
+    def columns(self, names, available):
+        """
+        Get the positions of the features of a model in a matrix, None if they are all its columns in order.
+        """
+        missing = [name for name in names if name not in available]
+        if missing:
+            raise ValueError(f"Features {missing} are not prepared by the engine")
+        return None if list(names) == list(available) else [available.index(name) for name in names]
+
+    def long(self, names):
+        """
+        Get the (row x feature) float32 matrix of the long rows with the given features, the
+        series_id feature holds the region codes.
+        """
+        with self._lock:
+            if self._long is None:
+                self._long = np.concatenate([self.panel.long(), self.panel.series_codes()[:, None].astype(np.float32)], axis=1)
+        index = self.columns(names, self.panel.features + ['series_id'])
+        return self._long if index is None else self._long[:, index]
+
+    def long_mask(self, names):
+        """
+        Get the mask of the long rows usable by a model, those without missing or zero surplus features.
+        """
+        return self.panel.valid_mask([name for name in names if name.startswith('surplus')]).reshape(-1)
+
+    def wide(self, names):
+        """
+        Get the (timestamp x feature) float32 matrix of the classifier, with the surplus of every
+        region, the weekend flag and the code of the current maximum surplus region.
+        """
+        with self._lock:
+            if self._wide is None:
+                surplus = self.panel['surplus']
+                missing = np.isnan(surplus)
+                curr_max = np.argmax(np.where(missing, -np.inf, surplus), axis=1).astype(np.float32)
+                curr_max[missing.all(axis=1)] = np.nan
+                is_weekend = self.panel.timestamps.dayofweek.isin([5, 6]).astype(np.float32)
+                self._wide = np.column_stack([surplus, is_weekend, curr_max])
+        available = [f'{region}_surplus' for region in self.panel.regions] + ['is_weekend', 'curr_max']
+        index = self.columns(names, available)
+        return self._wide if index is None else self._wide[:, index]
+
+    def sequence_panel(self):
+        """
+        Get a copy of the panel with the features of the sequence models, which scale it in place.
+        """
+        features = ['surplus'] + CALENDAR_FEATURES
+        values = self.panel.values[:, :, [self.panel.feature_index(feature) for feature in features]]
+        return Panel(values, self.panel.timestamps, self.panel.regions, features)
+
+### MODELS ###
+
+# Every model is a (default artifact, load, predict) triple, where predict(model, features) returns
+# the (timestamp x region x horizon) surplus forecasts, or the region of every timestamp for the classifier
+
+def load_xgb_classifier(path):
+    return xgb.Booster(model_file=path), np.load(os.path.join(os.path.dirname(path), 'label_encoder.npy'), allow_pickle=True)
+
+def predict_xgb_classifier(model, features):
+    booster, classes = model
+    probabilities = predict_booster(booster, features.wide(booster.feature_names))
+    codes = probabilities.argmax(axis=1) if probabilities.ndim > 1 else probabilities.astype(np.int64)
+    return classes[codes]
+
+def predict_xgb_forecaster(model, features):
+    predictions = predict_booster(model, features.long(model.feature_names))
+    predictions = predictions.reshape(len(predictions), -1)
+    predictions[~features.long_mask(model.feature_names)] = np.nan
+    return features.panel.unstack(predictions)
+
+def load_lgb_forecaster(path):
+    model = lgb.Booster(model_file=path)
+    return model, load_horizons(path, model.feature_name())
+
+def predict_lgb_forecaster(model, features):
+    model, horizons = model
+    names = model.feature_name()
+    x = features.long([name for name in names if name != 'horizon'])
+
+    # Multi-horizon models are conditioned on the horizon, their last feature, the rows are stacked once per horizon
+    if len(horizons) > 1:
+        x = np.column_stack([np.tile(x, (len(horizons), 1)), np.repeat(np.asarray(horizons, dtype=np.float32), len(x))])
+
+    predictions = model.predict(x).reshape(len(horizons), -1).T
+    predictions[~features.long_mask(names)] = np.nan
+    return features.panel.unstack(predictions)
+
+def load_sequence_model(model_type):
+    def load(path):
+        model, runtime = load_runtime('eager', path)
+        scalers = [SeriesScaler.load(get_artifact_path(model_type, name)) for name in ('x_scaler.npz', 'y_scaler.npz')]
+        return runtime, scalers, 'per-region' if model.embedding is not None else 'joint'
+    return load
+
+def predict_sequence_model(model, features):
+    runtime, (x_scaler, y_scaler), architecture = model
+    return predict_panel(runtime, features.sequence_panel(), x_scaler, y_scaler, architecture)
+
+def predict_student(model, features):
+    index = features.columns(model.features, features.panel.features)
+    values = features.panel.values if index is None else features.panel.values[:, :, index]
+    predictions = model.predict(values)
+    predictions[~features.long_mask(model.features).reshape(predictions.shape)] = np.nan
+    return predictions[:, :, None]
+
+MODELS = {
+    'baseline': (None, lambda path: None, lambda model, features: features.panel['surplus'][:, :, None]),
+    'xgboost_cls': (os.path.join(MODELS_DIR, 'classification', 'xgboost', 'model.json'), load_xgb_classifier, predict_xgb_classifier),
+    'xgboost_reg': (os.path.join(MODELS_DIR, 'forecasting', 'xgboost', 'model.json'), lambda path: xgb.Booster(model_file=path), predict_xgb_forecaster),
+    'lightgbm_reg': (os.path.join(MODELS_DIR, 'forecasting', 'lightgbm', 'model.txt'), load_lgb_forecaster, predict_lgb_forecaster),
+    'lstm': (get_artifact_path('lstm', 'model.pth'), load_sequence_model('lstm'), predict_sequence_model),
+    'tcn': (get_artifact_path('tcn', 'model.pth'), load_sequence_model('tcn'), predict_sequence_model),
+    'student': (STUDENT_PATH, LinearStudent.load, predict_student),
+}
+
+def get_output_frames(name, panel, output):
+    """
+    Get the prediction files of a model, named as the ones of its prediction script.
+
+    :param name: Name of the model in MODELS.
+    :param panel: Panel of the prediction data.
+    :param output: Output of the predict function of the model.
+    :return: Dictionary of file name -> DataFrame.
+    """
+    if name == 'xgboost_cls':
+        return {'xgboost_cls_predictions.json': pd.DataFrame({'timestamp': panel.timestamps, 'target': output})}
+    if name == 'baseline':
+        return {'baseline.json': panel.to_predictions_frame(output[:, :, 0])}
+
+    frames = {f'{name}_predictions.json': panel.to_predictions_frame(output[:, :, 0])}
+    if output.shape[2] > 1:
+        horizons = list(range(1, output.shape[2] + 1))
+        frames[f'{name}_horizon_predictions.json'] = panel.to_horizon_predictions_frame(output, horizons)
+    return frames
+
+### MAIN ###
+
+def main():
+    parser = argparse.ArgumentParser(description='Predict with several models in a single process')
+    parser.add_argument('--models', type=str, nargs='+', default=['baseline', 'xgboost_cls', 'xgboost_reg', 'lightgbm_reg', 'lstm'], choices=list(MODELS), help='Models to predict with')
+    parser.add_argument('--data', type=str, default=os.path.join(PROCESSED_DATA_DIR, 'validation.csv'), help='Path to prediction data')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    df = pd.read_csv(args.data, parse_dates=['timestamp'])
+    panel = prepare_data(df, lags=sorted(set(XGBOOST_LAGS) | set(LIGHTGBM_LAGS)))
+    features = SharedFeatures(panel)
+    logger.info(f"Prepared the features in {time.perf_counter() - start:.2f}s")
+
+    frames = {}
+    for name in args.models:
+        path, load, predict = MODELS[name]
+        start = time.perf_counter()
+        model = load(path)
+        loaded = time.perf_counter()
+        frames.update(get_output_frames(name, panel, predict(model, features)))
+        logger.info(f"{name}: loaded in {loaded - start:.2f}s, predicted in {time.perf_counter() - loaded:.2f}s")
+
+    os.makedirs(PREDICTIONS_DIR, exist_ok=True)
+    for file_name, frame in frames.items():
+        frame.to_json(os.path.join(PREDICTIONS_DIR, file_name), orient='records')
+    print(f"Predictions saved to {PREDICTIONS_DIR}: {', '.join(frames)}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""
+Script to serve the next hour forecasts over HTTP with warm models.
+
+Every prediction script imports the libraries, loads the models, reads the data and prepares its
+features before answering. The server does all of this once and keeps the recent feature state:
+
+- The models are loaded at startup, and the features of the last hours of the data (enough for the
+  lags of every model) are prepared once.
+- Every model forecasts the next hour of every region once per data update, and the JSON responses
+  are encoded then. A request only looks its response up, so it is answered in microseconds on the
+  event loop, without blocking it on any model.
+- POST /reload reads the data again, after new hours are appended to it. The models predict in a
+  worker thread while the event loop keeps answering from the previous state, and the new responses
+  replace the previous ones at once.
+
+Endpoints (GET, with an optional ?model= among the served models, the ensemble by default):
+
+- /max-region: {"timestamp", "model", "region"}, the region with the maximum next hour surplus.
+- /forecast: {"timestamp", "model", "forecasts": {region: surplus}}, the next hour surplus of every region.
+- /health: {"timestamp", "models"}, the hour of the forecasts and the served models.
+
+The server speaks a minimal HTTP/1.1 with keep-alive, on asyncio streams, so it needs no web
+framework. To measure its latency under concurrent load, see src/model/server_benchmark.py.
+"""
+# General imports
+import argparse
+import asyncio
+import json
+import os
+import time
+from urllib.parse import (
+    parse_qs,
+    urlsplit,
+)
+
+# Data related imports
+import numpy as np
+import pandas as pd
+
+# Local imports
+from src.definitions import (
+    PROCESSED_DATA_DIR,
+    XGBOOST_LAGS,
+    LIGHTGBM_LAGS,
+    LSTM_LAGS,
+)
+from src.model.ensemble import (
+    MEMBERS,
+    combine,
+    parse_weights,
+)
+from src.model.forecasting.xgboost.model_training import prepare_data
+from src.model.predict import (
+    MODELS,
+    SharedFeatures,
+)
+from src.config import setup_logger
+
+# Setup logger
+logger = setup_logger()
+
+STATUS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    500: 'Internal Server Error',
+}
+
+### STATE ###
+
+def encode(body):
+    return json.dumps(body).encode()
+
+def format_response(status, body, keep_alive):
+    return (
+        f"HTTP/1.1 {status} {STATUS[status]}\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + body
+    )
+
+class ForecastState:
+    """
+    Warm models and the responses of their forecasts of the hour after the last one of the data.
+
+    :param data: Path to the data, a wide CSV with one row per hour.
+    :param models: Names of the forecasters to serve (in MODELS).
+    :param weights: Dictionary of ensemble member name -> weight, None to serve no ensemble.
+    :param window: Number of last hours of the data to prepare the features from.
+    """
+    def __init__(self, data, models, weights=None, window=48):
+        self.data = data
+        self.weights = weights or {}
+        self.window = window
+        self.lags = sorted(set(XGBOOST_LAGS) | set(LIGHTGBM_LAGS))
+        if window <= max(self.lags + [LSTM_LAGS]):
+            raise ValueError(f"The window must be longer than the lags of the models, got {window} hours")
+        for name in dict.fromkeys(list(models) + list(self.weights)):
+            if not os.path.exists(MODELS[name][0]):
+                raise FileNotFoundError(f"The {name} model is missing at {MODELS[name][0]}, train it first")
+
+        self.models = {name: MODELS[name][1](MODELS[name][0]) for name in dict.fromkeys(list(models) + list(self.weights))}
+        self.served = list(models) + (['ensemble'] if self.weights else [])
+        self.default = self.served[0] if not self.weights else 'ensemble'
+        self.timestamp = None
+        self.responses = {}
+        self.refresh()
+
+    def refresh(self):
+        """
+        Read the last hours of the data, forecast their next hour with every model and encode the responses.
+
+        :return: Timestamp of the forecasted hour.
+        """
+        start = time.perf_counter()
+        df = pd.read_csv(self.data, parse_dates=['timestamp']).tail(self.window).reset_index(drop=True)
+        features = SharedFeatures(prepare_data(df, lags=self.lags))
+        panel = features.panel
+
+        # Only the last hour is forecasted, its features include the lags of the previous hours
+        forecasts = {name: MODELS[name][2](model, features)[-1:, :, 0] for name, model in self.models.items()}
+        if self.weights:
+            forecasts['ensemble'] = combine({name: forecasts[name] for name in self.weights}, self.weights)
+
+        timestamp = (panel.timestamps[-1] + pd.Timedelta(hours=1)).isoformat()
+        responses = {('/health', None): encode({'timestamp': timestamp, 'models': self.served})}
+        for name in self.served:
+            values = forecasts[name][0]
+            region = panel.max_region(forecasts[name])[0]
+            responses['/forecast', name] = encode({
+                'timestamp': timestamp,
+                'model': name,
+                'forecasts': {region: None if np.isnan(value) else float(value) for region, value in zip(panel.regions, values)},
+            })
+            responses['/max-region', name] = encode({'timestamp': timestamp, 'model': name, 'region': region})
+
+        # Swapped at once, requests read either the previous responses or the new ones
+        self.timestamp, self.responses = timestamp, responses
+        logger.info(f"Forecasted {timestamp} with {', '.join(self.served)} in {time.perf_counter() - start:.2f}s")
+        return timestamp
+
+    def get(self, path, query):
+        """
+        Get the status and the body of the response to a GET request.
+        """
+        if path == '/health':
+            return 200, self.responses['/health', None]
+        if path not in ('/forecast', '/max-region'):
+            return 404, encode({'error': f"Unknown path {path}"})
+        name = parse_qs(query).get('model', [self.default])[0]
+        if name not in self.served:
+            return 400, encode({'error': f"Unknown model {name}, expected one of {self.served}"})
+        return 200, self.responses[path, name]
+
+### SERVER ###
+
+class ForecastServer:
+    """
+    Asyncio HTTP/1.1 server of a ForecastState.
+
+    :param state: ForecastState.
+    :param reload_interval: Seconds between the reloads of the data, None to only reload on POST /reload.
+    """
+    def __init__(self, state, reload_interval=None):
+        self.state = state
+        self.reload_interval = reload_interval
+        self.reload_lock = None
+
+    async def reload(self):
+        async with self.reload_lock:
+            return await asyncio.get_running_loop().run_in_executor(None, self.state.refresh)
+
+    async def respond(self, method, target):
+        path, _, query = target.partition('?')
+        path = urlsplit(path).path
+        if method == 'GET':
+            return self.state.get(path, query)
+        if method == 'POST' and path == '/reload':
+            return 200, encode({'timestamp': await self.reload()})
+        return 405, encode({'error': f"Method {method} not allowed on {path}"})
+
+    async def handle(self, reader, writer):
+        """
+        Answer the requests of a connection until the client closes it.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                request = request_line.decode('latin-1').split()
+                if len(request) != 3:
+                    writer.write(format_response(400, encode({'error': 'Malformed request line'}), keep_alive=False))
+                    await writer.drain()
+                    break
+                method, target, version = request
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                if 'content-length' in headers:
+                    await reader.readexactly(int(headers['content-length']))
+
+                # Bad requests are answered by respond, an exception is a failure of the server (e.g., of a reload)
+                try:
+                    status, body = await self.respond(method, target)
+                except Exception as e:
+                    logger.exception(f"Failed to answer {method} {target}")
+                    status, body = 500, encode({'error': str(e)})
+
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                writer.write(format_response(status, body, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+            pass  # Malformed headers or connection closed by the client
+        finally:
+            writer.close()
+
+    async def reload_periodically(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                await self.reload()
+            except Exception:
+                logger.exception("Failed to reload the data")
+
+    async def serve(self, host, port):
+        self.reload_lock = asyncio.Lock()
+        server = await asyncio.start_server(self.handle, host, port, backlog=1024)
+        if self.reload_interval:
+            asyncio.get_running_loop().create_task(self.reload_periodically())
+        logger.info(f"Serving the forecasts of {self.state.timestamp} on http://{host}:{port}")
+        print(f"Serving {', '.join(self.state.served)} on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+### MAIN ###
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the next hour forecasts over HTTP with warm models')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--data', type=str, default=os.path.join(PROCESSED_DATA_DIR, 'validation.csv'), help='Path to the data, read again on reload')
+    parser.add_argument('--models', type=str, nargs='+', default=['xgboost_reg', 'lightgbm_reg', 'lstm'], choices=MEMBERS, help='Forecasters to serve (student once distillation.py has been run)')
+    parser.add_argument('--weights', type=str, nargs='*', default=['xgboost_reg=1', 'lightgbm_reg=1', 'lstm=1'], help='Ensemble members and their weights as name=weight, none to serve no ensemble')
+    parser.add_argument('--window', type=int, default=48, help='Number of last hours of the data to prepare the features from')
+    parser.add_argument('--reload-interval', type=float, default=None, help='Seconds between the reloads of the data (default: only on POST /reload)')
+    args = parser.parse_args()
+
+    try:
+        weights = parse_weights(args.weights)
+        state = ForecastState(args.data, args.models, weights, args.window)
+    except (ValueError, FileNotFoundError) as e:
+        parser.error(str(e))
+
+    try:
+        asyncio.run(ForecastServer(state, args.reload_interval).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Script to measure the latency of the forecast server under concurrent load.
+
+Every client keeps one HTTP/1.1 connection open and sends its requests one after the other. The
+latency of every request is measured from its write to the end of its response, and the
+percentiles of all of them are reported with the throughput.
+"""
+# General imports
+import argparse
+import asyncio
+import time
+
+# Data related imports
+import numpy as np
+
+### CLIENT ###
+
+async def run_client(host, port, paths, n_requests, latencies):
+    """
+    Send requests over a keep-alive connection and append their latencies in seconds.
+
+    :param paths: Paths requested in turn.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    requests = [f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode() for path in paths]
+    try:
+        for i in range(n_requests):
+            start = time.perf_counter()
+            writer.write(requests[i % len(requests)])
+            await writer.drain()
+            status = await reader.readline()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                key, _, value = line.decode('latin-1').partition(':')
+                if key.lower() == 'content-length':
+                    length = int(value)
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            if b' 200 ' not in status:
+                raise RuntimeError(f"Request failed: {status.decode().strip()}")
+    finally:
+        writer.close()
+
+async def run_load(host, port, paths, connections, n_requests):
+    """
+    Run concurrent clients sharing the requests.
+
+    :return: Array with the latency of every request in seconds, and the wall time of the load.
+    """
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        run_client(host, port, paths, n_requests // connections, latencies)
+        for _ in range(connections)
+    ])
+    return np.array(latencies), time.perf_counter() - start
+
+### MAIN ###
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the latency of the forecast server under concurrent load')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host of the server')
+    parser.add_argument('--port', type=int, default=8080, help='Port of the server')
+    parser.add_argument('--paths', type=str, nargs='+', default=['/max-region', '/forecast'], help='Paths requested in turn')
+    parser.add_argument('--connections', type=int, default=64, help='Number of concurrent connections')
+    parser.add_argument('--requests', type=int, default=20000, help='Total number of requests')
+    args = parser.parse_args()
+
+    asyncio.run(run_load(args.host, args.port, args.paths, args.connections, args.connections))  # Warm-up
+    latencies, wall_time = asyncio.run(run_load(args.host, args.port, args.paths, args.connections, args.requests))
+
+    print(f"{len(latencies)} requests over {args.connections} connections in {wall_time:.2f}s ({len(latencies) / wall_time:.0f} requests/s)")
+    for name, value in [('p50', 50), ('p90', 90), ('p99', 99), ('max', 100)]:
+        print(f"{name:<4} {np.percentile(latencies, value) * 1e3:>8.3f} ms")
+
+if __name__ == '__main__':
+    main()
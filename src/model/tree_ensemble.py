@@ -0,0 +1,549 @@
+"""
+Script containing a numpy evaluator of the saved XGBoost and LightGBM models.
+
+The trees of a saved booster (XGBoost JSON or LightGBM text model) are compiled into flat node
+arrays, shared by all the trees:
+
+    feature[node], threshold[node], left[node], right[node], value[node], ...
+
+Every (row, tree) pair is traversed at once: each step gathers the next node of all the pairs that
+have not reached a leaf yet, until none is left. The decision rules and the summation order of each library
+are reproduced, so the predictions are bit-for-bit equal to theirs:
+
+- XGBoost: float32 features and thresholds, goes left if value < threshold, missing values follow
+  the default direction, categories in the split set go right, leaves are added in float32 to the
+  base score tree by tree.
+- LightGBM: double features and thresholds, goes left if value <= threshold, missing values (NaN or
+  zero, by decision type) follow the default direction, categories in the split bitset go left,
+  leaves are added in double tree by tree.
+
+Only numpy is needed to predict, neither xgboost nor lightgbm are imported.
+"""
+# General imports
+import argparse
+import json
+import os
+import tempfile
+import time
+
+# Data related imports
+import numpy as np
+
+# LightGBM treats values in [-kZeroThreshold, kZeroThreshold] as zero
+LGB_ZERO_THRESHOLD = 1e-35
+
+# Objectives predicted as the raw sum of the leaves
+IDENTITY_OBJECTIVES = ('reg:squarederror', 'reg:absoluteerror', 'reg:pseudohubererror', 'regression', 'regression_l1', 'huber', 'fair', 'quantile')
+
+### TREE ENSEMBLE ###
+
+class TreeEnsemble:
+    """
+    Tree ensemble compiled into flat node arrays.
+
+    :param nodes: Dictionary of node arrays: feature, threshold, left, right, value, default_left,
+        nan_to_zero, zero_missing and category (row of categories_left, -1 for numerical splits).
+    :param roots: Root node of every tree.
+    :param groups: Output (class or target) of every tree.
+    :param base_score: Initial value of every output.
+    :param categories_left: Boolean matrix (categorical split x category code) of the categories that
+        go left. The last column is used for the codes out of range.
+    :param max_depth: Maximum depth of the trees.
+    :param dtype: Data type of the features, thresholds and sums.
+    :param strict: Whether numerical splits go left if value < threshold, or value <= threshold.
+    :param objective: Objective of the model.
+    :param feature_names: Names of the features.
+    :param categories: Dictionary of categorical feature names to the list of their categories.
+    """
+    def __init__(self, nodes, roots, groups, base_score, categories_left, max_depth, dtype, strict, objective, feature_names, categories=None):
+        for name, values in nodes.items():
+            setattr(self, name, values)
+        self.roots = roots
+        self.groups = groups
+        self.base_score = base_score
+        self.categories_left = categories_left
+        self.max_depth = max_depth
+        self.dtype = dtype
+        self.strict = strict
+        self.objective = objective
+        self.feature_names = feature_names
+        self.categories = categories or {}
+        self.n_outputs = len(base_score)
+
+        # Leaves point to themselves, the optional decision rules are skipped when no node uses them
+        self.is_leaf = self.left == np.arange(len(self.left))
+        self.has_zero_missing = bool(self.nan_to_zero.any() or self.zero_missing.any())
+        self.has_categorical = len(categories_left) > 0
+
+        if objective not in IDENTITY_OBJECTIVES and objective != 'multi:softmax':
+            raise ValueError(f"Unsupported objective {objective}")
+
+    @classmethod
+    def load(cls, path):
+        """
+        Compile a saved model, XGBoost JSON (.json) or LightGBM text (.txt).
+        """
+        if path.endswith('.json'):
+            return cls.from_xgboost(path)
+        if path.endswith('.txt'):
+            return cls.from_lightgbm(path)
+        raise ValueError("Invalid model format, expected an XGBoost .json or LightGBM .txt model")
+
+    @classmethod
+    def from_xgboost(cls, path):
+        """
+        Compile an XGBoost JSON model, up to its best iteration if it was early stopped.
+        """
+        with open(path) as f:
+            learner = json.load(f)['learner']
+        booster = learner['gradient_booster']
+        if booster['name'] != 'gbtree':
+            raise ValueError(f"Unsupported booster {booster['name']}")
+        model = booster['model']
+
+        n_trees = len(model['trees'])
+        best_iteration = learner.get('attributes', {}).get('best_iteration')
+        if best_iteration is not None and 'iteration_indptr' in model:
+            n_trees = model['iteration_indptr'][int(best_iteration) + 1]
+
+        builder = _NodeBuilder()
+        for tree in model['trees'][:n_trees]:
+            if int(tree['tree_param']['size_leaf_vector']) > 1:
+                raise ValueError("Multi-target trees are not supported")
+            segments = zip(tree['categories_nodes'], tree['categories_segments'], tree['categories_sizes'])
+            split_categories = {node: tree['categories'][start:start + size] for node, start, size in segments}
+
+            offset = builder.size
+            for node, left in enumerate(tree['left_children']):
+                if left == -1:
+                    builder.add_leaf(offset + node, tree['split_conditions'][node])
+                elif node in split_categories:
+                    # Categories in the set go right, any other (including invalid codes) goes left
+                    builder.add_categorical(
+                        offset + node, tree['split_indices'][node], offset + left, offset + tree['right_children'][node],
+                        members=split_categories[node], members_left=False, default_left=bool(tree['default_left'][node]),
+                    )
+                else:
+                    builder.add_numerical(
+                        offset + node, tree['split_indices'][node], tree['split_conditions'][node],
+                        offset + left, offset + tree['right_children'][node], default_left=bool(tree['default_left'][node]),
+                    )
+            builder.add_tree(offset)
+
+        # The base score is stored as a float or as a list with one value per output
+        base_score = np.atleast_1d(np.asarray(json.loads(learner['learner_model_param']['base_score']), dtype=np.float32))
+        n_outputs = max(int(learner['learner_model_param']['num_class']), int(learner['learner_model_param']['num_target']), 1)
+        base_score = np.broadcast_to(base_score, n_outputs).copy()
+
+        # Categories of the categorical features, stored as UTF-8 encoded strings
+        categories = {}
+        cats = model.get('cats', {})
+        for name, encoding in zip(learner['feature_names'], cats.get('enc', [])):
+            offsets, values = encoding['offsets'], bytes(encoding['values'])
+            if offsets:
+                bounds = offsets + [len(values)]
+                categories[name] = [values[bounds[i]:bounds[i + 1]].decode() for i in range(len(offsets))]
+
+        return builder.build(
+            cls,
+            groups=np.asarray(model['tree_info'][:n_trees], dtype=np.intp),
+            base_score=base_score,
+            dtype=np.float32,
+            strict=True,
+            objective=learner['objective']['name'],
+            feature_names=learner['feature_names'],
+            categories=categories,
+        )
+
+    @classmethod
+    def from_lightgbm(cls, path):
+        """
+        Compile a LightGBM text model. The saved trees are all used, LightGBM saves the ones up to the
+        best iteration of an early stopped model.
+        """
+        with open(path) as f:
+            text, _, footer = f.read().partition('end of trees')
+        header, *blocks = text.split('\nTree=')
+        header = dict(line.split('=', 1) for line in header.splitlines() if '=' in line)
+        trees = [dict(line.split('=', 1) for line in block.splitlines()[1:] if '=' in line) for block in blocks]
+
+        builder = _NodeBuilder()
+        for tree in trees:
+            if tree.get('is_linear', '0') == '1':
+                raise ValueError("Linear trees are not supported")
+            offset = builder.size
+            n_leaves = int(tree['num_leaves'])
+            leaf_values = [float(value) for value in tree['leaf_value'].split()]
+            if n_leaves == 1:
+                builder.add_leaf(offset, leaf_values[0])
+                builder.add_tree(offset)
+                continue
+
+            # Internal nodes first, then the leaves, encoded as ~leaf by the children
+            def index(child):
+                child = int(child)
+                return offset + child if child >= 0 else offset + n_leaves - 1 + ~child
+
+            features = [int(feature) for feature in tree['split_feature'].split()]
+            thresholds = tree['threshold'].split()
+            decision_types = [int(decision_type) for decision_type in tree['decision_type'].split()]
+            lefts, rights = tree['left_child'].split(), tree['right_child'].split()
+            if int(tree['num_cat']) > 0:
+                boundaries = [int(boundary) for boundary in tree['cat_boundaries'].split()]
+                bitsets = [int(word) for word in tree['cat_threshold'].split()]
+
+            for node, decision_type in enumerate(decision_types):
+                if decision_type & 1:
+                    # Categories in the bitset go left, any other (including NaN and negative codes) goes right
+                    cat_index = int(float(thresholds[node]))
+                    words = bitsets[boundaries[cat_index]:boundaries[cat_index + 1]]
+                    members = [32 * i + bit for i, word in enumerate(words) for bit in range(32) if (word >> bit) & 1]
+                    builder.add_categorical(
+                        offset + node, features[node], index(lefts[node]), index(rights[node]),
+                        members=members, members_left=True, default_left=False,
+                    )
+                else:
+                    missing_type = (decision_type >> 2) & 3
+                    builder.add_numerical(
+                        offset + node, features[node], float(thresholds[node]), index(lefts[node]), index(rights[node]),
+                        default_left=bool((decision_type >> 1) & 1),
+                        nan_to_zero=missing_type != 2,
+                        zero_missing=missing_type == 1,
+                    )
+            for leaf, value in enumerate(leaf_values):
+                builder.add_leaf(offset + n_leaves - 1 + leaf, value)
+            builder.add_tree(offset)
+
+        # Categories of the pandas categorical features, in the order of the features
+        feature_names = header['feature_names'].split()
+        categorical = [
+            name for name, info in zip(feature_names, header['feature_infos'].split())
+            if not info.startswith('[') and info != 'none'
+        ]
+        pandas_categorical = json.loads(footer.split('pandas_categorical:')[1].splitlines()[0]) if 'pandas_categorical:' in footer else None
+
+        n_outputs = int(header['num_tree_per_iteration'])
+        return builder.build(
+            cls,
+            groups=np.arange(len(trees)) % n_outputs,
+            base_score=np.zeros(n_outputs),
+            dtype=np.float64,
+            strict=False,
+            objective=header['objective'].split()[0],
+            feature_names=feature_names,
+            categories=dict(zip(categorical, pandas_categorical or [])),
+        )
+
+    ### PREDICTION ###
+
+    def to_matrix(self, frame):
+        """
+        Get the feature matrix of a DataFrame, with its columns in the order of the model features.
+        Categorical columns are encoded with the codes of the model categories, NaN if unknown.
+
+        :param frame: DataFrame with the model features.
+        :return: Array (row x feature) of the model data type.
+        """
+        columns = []
+        for name in self.feature_names:
+            column = frame[name]
+            if hasattr(column, 'cat'):
+                model_categories = self.categories.get(name, list(column.cat.categories))
+                recode = np.array([
+                    model_categories.index(category) if category in model_categories else np.nan
+                    for category in column.cat.categories
+                ] + [np.nan])
+                columns.append(recode[column.cat.codes.to_numpy()])  # Missing values have code -1
+            else:
+                columns.append(column.to_numpy(dtype=self.dtype, na_value=np.nan))
+        return np.column_stack(columns).astype(self.dtype)
+
+    def apply(self, x):
+        """
+        Get the leaf reached by every row in every tree.
+
+        :param x: Array (row x feature).
+        :return: Array (row x tree) of leaf nodes.
+        """
+        x = np.ascontiguousarray(x, dtype=self.dtype)
+        n_rows, n_features = x.shape
+        flat = x.reshape(-1)
+        offsets = np.repeat(np.arange(n_rows) * n_features, len(self.roots))
+        nodes = np.tile(self.roots, n_rows)
+
+        # Only the (row, tree) pairs that have not reached a leaf are advanced
+        active = np.flatnonzero(~self.is_leaf[nodes])
+        while len(active):
+            current = nodes[active]
+            values = flat[offsets[active] + self.feature[current]]
+            missing = np.isnan(values)
+            if self.has_zero_missing:
+                nan_to_zero = self.nan_to_zero[current]
+                values = np.where(missing & nan_to_zero, 0, values)
+                missing = (missing & ~nan_to_zero) | (self.zero_missing[current] & (np.abs(values) <= LGB_ZERO_THRESHOLD))
+
+            threshold = self.threshold[current]
+            go_left = values < threshold if self.strict else values <= threshold
+            if self.has_categorical:
+                categorical = np.flatnonzero(self.category[current] >= 0)
+                if len(categorical):
+                    cat_values = values[categorical]
+                    n_codes = self.categories_left.shape[1] - 1
+                    codes = np.where((cat_values >= 0) & (cat_values < n_codes), cat_values, n_codes).astype(np.intp)
+                    go_left[categorical] = self.categories_left[self.category[current[categorical]], codes]
+
+            go_left = np.where(missing, self.default_left[current], go_left)
+            current = np.where(go_left, self.left[current], self.right[current])
+            nodes[active] = current
+            active = active[~self.is_leaf[current]]
+        return nodes.reshape(n_rows, -1)
+
+    def predict_margin(self, x):
+        """
+        Get the sum of the leaves of every output, added tree by tree to the base score.
+
+        :param x: Array (row x feature).
+        :return: Array (row x output).
+        """
+        leaves = self.value[self.apply(x)]
+        margin = np.empty((len(leaves), self.n_outputs), dtype=self.dtype)
+        for group in range(self.n_outputs):
+            terms = np.concatenate([
+                np.full((len(leaves), 1), self.base_score[group], dtype=self.dtype),
+                leaves[:, self.groups == group],
+            ], axis=1)
+            # Accumulate is sequential, unlike sum which adds pairwise in a different order
+            margin[:, group] = np.add.accumulate(terms, axis=1)[:, -1]
+        return margin
+
+    def predict(self, x):
+        """
+        Predict a feature matrix, or a DataFrame with the model features.
+
+        :param x: Array (row x feature) or DataFrame.
+        :return: Array (row) for single output models, (row x output) otherwise. Classes for multi:softmax.
+        """
+        if hasattr(x, 'columns'):
+            x = self.to_matrix(x)
+        margin = self.predict_margin(x)
+        if self.objective == 'multi:softmax':
+            return np.argmax(margin, axis=1)
+        return margin[:, 0] if self.n_outputs == 1 else margin
+
+class _NodeBuilder:
+    """
+    Accumulates the nodes of the trees of an ensemble into flat arrays.
+    """
+    def __init__(self):
+        self.nodes = {name: {} for name in ('feature', 'threshold', 'left', 'right', 'value', 'default_left', 'nan_to_zero', 'zero_missing', 'category')}
+        self.categories = []
+        self.roots = []
+        self.depths = []
+        self.size = 0
+
+    def _add(self, node, **fields):
+        defaults = {
+            'feature': 0, 'threshold': 0.0, 'left': node, 'right': node, 'value': 0.0, 'default_left': False,
+            'nan_to_zero': False, 'zero_missing': False, 'category': -1,
+        }
+        for name, value in {**defaults, **fields}.items():
+            self.nodes[name][node] = value
+
+    def add_leaf(self, node, value):
+        self._add(node, value=value)
+
+    def add_numerical(self, node, feature, threshold, left, right, default_left, nan_to_zero=False, zero_missing=False):
+        self._add(
+            node, feature=feature, threshold=threshold, left=left, right=right, default_left=default_left,
+            nan_to_zero=nan_to_zero, zero_missing=zero_missing,
+        )
+
+    def add_categorical(self, node, feature, left, right, members, members_left, default_left):
+        self._add(node, feature=feature, left=left, right=right, default_left=default_left, category=len(self.categories))
+        self.categories.append((members, members_left))
+
+    def add_tree(self, root):
+        """
+        Close the tree rooted at root, whose nodes are the ones added since the previous tree.
+        """
+        n_nodes = len(self.nodes['left']) - self.size
+        depth, level = 0, [root]
+        while True:
+            level = [child for node in level for child in (self.nodes['left'][node], self.nodes['right'][node]) if child != node]
+            if not level:
+                break
+            depth += 1
+        self.roots.append(root)
+        self.depths.append(depth)
+        self.size += n_nodes
+
+    def build(self, cls, dtype, **kwargs):
+        order = range(self.size)
+        nodes = {
+            'feature': np.array([self.nodes['feature'][i] for i in order], dtype=np.intp),
+            'threshold': np.array([self.nodes['threshold'][i] for i in order], dtype=dtype),
+            'left': np.array([self.nodes['left'][i] for i in order], dtype=np.intp),
+            'right': np.array([self.nodes['right'][i] for i in order], dtype=np.intp),
+            'value': np.array([self.nodes['value'][i] for i in order], dtype=dtype),
+            'category': np.array([self.nodes['category'][i] for i in order], dtype=np.intp),
+        }
+        for name in ('default_left', 'nan_to_zero', 'zero_missing'):
+            nodes[name] = np.array([self.nodes[name][i] for i in order], dtype=bool)
+
+        # One row per categorical split, the last column holds the direction of the codes out of range
+        n_codes = max((max(members, default=-1) + 1 for members, _ in self.categories), default=0)
+        categories_left = np.zeros((len(self.categories), n_codes + 1), dtype=bool)
+        for i, (members, members_left) in enumerate(self.categories):
+            categories_left[i] = not members_left
+            categories_left[i, members] = members_left
+
+        return cls(
+            nodes,
+            roots=np.array(self.roots, dtype=np.intp),
+            categories_left=categories_left,
+            max_depth=max(self.depths, default=0),
+            dtype=dtype,
+            **kwargs,
+        )
+
+### CHECK ###
+
+def get_check_data(n_rows, rng):
+    """
+    Get a synthetic regression DataFrame with missing values, exact zeros and a categorical feature.
+    """
+    import pandas as pd
+
+    x = rng.standard_normal((n_rows, 3))
+    x[rng.random(x.shape) < 0.1] = np.nan
+    x[rng.random(n_rows) < 0.2, 1] = 0
+    frame = pd.DataFrame(x, columns=['a', 'b', 'c'])
+    frame['category'] = pd.Categorical(rng.choice(list('pqrstuvw'), n_rows), categories=list('pqrstuvw'))
+    frame.loc[rng.random(n_rows) < 0.05, 'category'] = np.nan
+    y = np.nan_to_num(x[:, 0]) * 2 + np.where(x[:, 1] == 0, 3, np.nan_to_num(x[:, 1])) + frame['category'].cat.codes.isin([1, 4, 6]) * 4
+    return frame, y + rng.standard_normal(n_rows)
+
+def check_libraries(directory, n_rows=2000, seed=0):
+    """
+    Train tiny XGBoost and LightGBM models on synthetic data, with missing values, categorical splits,
+    zero_as_missing (LightGBM) and early stopping, save them and check that the compiled ensembles
+    predict exactly as the trained models.
+
+    :param directory: Directory to save the models to.
+    :return: Dictionary of library name -> number of rows checked.
+    :raises AssertionError: If a prediction differs or a case is not covered by the trained models.
+    """
+    import lightgbm as lgb
+    import xgboost as xgb
+
+    rng = np.random.default_rng(seed)
+    train, y_train = get_check_data(n_rows, rng)
+    valid, y_valid = get_check_data(n_rows // 4, rng)
+    test, _ = get_check_data(n_rows // 2, rng)
+
+    # XGBoost, early stopped on the validation data: predict only uses the trees up to the best iteration
+    model = xgb.XGBRegressor(
+        n_estimators=200, learning_rate=0.5, max_depth=4, tree_method='hist', enable_categorical=True,
+        max_cat_to_onehot=1, early_stopping_rounds=5, random_state=seed,
+    )
+    model.fit(train, y_train, eval_set=[(valid, y_valid)], verbose=False)
+    xgb_path = os.path.join(directory, 'model.json')
+    model.save_model(xgb_path)
+
+    # LightGBM, early stopped on the validation data: save_model only saves the trees up to the best iteration
+    params = {'objective': 'regression', 'learning_rate': 0.5, 'num_leaves': 15, 'min_data_per_group': 10, 'cat_smooth': 1, 'zero_as_missing': True, 'seed': seed, 'verbose': -1}
+    booster = lgb.train(
+        params, lgb.Dataset(train, y_train), num_boost_round=200,
+        valid_sets=[lgb.Dataset(valid, y_valid)], callbacks=[lgb.early_stopping(5, verbose=False)],
+    )
+    lgb_path = os.path.join(directory, 'model.txt')
+    booster.save_model(lgb_path)
+
+    checked = {}
+    for name, path, library, n_rounds, best_iteration in [
+        ('xgboost', xgb_path, model, 200, model.best_iteration + 1),
+        ('lightgbm', lgb_path, booster, 200, booster.best_iteration),
+    ]:
+        ensemble = TreeEnsemble.load(path)
+        assert best_iteration < n_rounds, f"{name} was not early stopped"
+        assert (ensemble.category >= 0).any(), f"{name} has no categorical split"
+        if name == 'lightgbm':
+            assert ensemble.zero_missing.any(), "lightgbm has no zero_as_missing split"
+        assert np.array_equal(ensemble.predict(test), library.predict(test)), f"{name} predictions differ"
+        checked[name] = len(test)
+    return checked
+
+### MAIN ###
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the numpy evaluator with the library of a saved forecasting model')
+    parser.add_argument('--model', type=str, help='Path to an XGBoost .json or LightGBM .txt forecasting model')
+    parser.add_argument('--repeats', type=int, default=100, help='Number of timed predictions of each size')
+    parser.add_argument('--check', action='store_true', help='Check the evaluator against tiny XGBoost and LightGBM models trained on synthetic data')
+    args = parser.parse_args()
+    if not args.check and not args.model:
+        parser.error('Either --model or --check is required')
+
+    if args.check:
+        from src.definitions import SEED
+        with tempfile.TemporaryDirectory() as directory:
+            checked = check_libraries(directory, seed=SEED)
+        for name, n_rows in checked.items():
+            print(f"{name}: {n_rows} rows predicted exactly as the library")
+        if not args.model:
+            return
+
+    # The libraries are only imported to compare against them
+    from src.data.prepare_data import (
+        load_data,
+        get_panel_features,
+    )
+    if args.model.endswith('.json'):
+        import xgboost as xgb
+        from src.definitions import XGBOOST_LAGS
+        from src.model.forecasting.xgboost.model_training import prepare_data
+        model = xgb.XGBRegressor(enable_categorical=True)
+        model.load_model(args.model)
+        lags = XGBOOST_LAGS
+    else:
+        import lightgbm as lgb
+        from src.definitions import LIGHTGBM_LAGS
+        from src.model.forecasting.lightgbm.model_training import prepare_data
+        model = lgb.Booster(model_file=args.model)
+        lags = LIGHTGBM_LAGS
+
+    start = time.perf_counter()
+    ensemble = TreeEnsemble.load(args.model)
+    print(f"Compiled {len(ensemble.roots)} trees ({len(ensemble.feature)} nodes, depth {ensemble.max_depth}) in {time.perf_counter() - start:.2f}s")
+
+    _, validation = load_data()
+    panel = prepare_data(validation, lags=lags)
+    features, _ = get_panel_features(panel)
+    if 'horizon' in ensemble.feature_names:
+        features = features.assign(horizon=1)
+    features = features[ensemble.feature_names]
+
+    expected = model.predict(features)
+    predicted = ensemble.predict(features)
+    print(f"Rows: {len(features)}, mismatches: {np.count_nonzero(expected != predicted)}, max abs diff: {np.abs(expected - predicted).max():.3e}")
+
+    # Latency of a single row and of one hour of every region, from a DataFrame and from a feature
+    # matrix, which is what the serving path (src/model/predict.py) passes to the library
+    predict_matrix = model.get_booster().inplace_predict if args.model.endswith('.json') else model.predict
+    for n_rows in (1, len(panel.regions)):
+        rows = features.iloc[:n_rows]
+        matrix = ensemble.to_matrix(rows)
+        for name, predict, data in [
+            ('library', model.predict, rows),
+            ('library (matrix)', predict_matrix, matrix),
+            ('numpy', ensemble.predict, rows),
+            ('numpy (matrix)', ensemble.predict, matrix),
+        ]:
+            predict(data)
+            start = time.perf_counter()
+            for _ in range(args.repeats):
+                predict(data)
+            print(f"{n_rows:>3} rows, {name:<17} {(time.perf_counter() - start) / args.repeats * 1e6:>10.1f} us per call")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+Script containing the hyperparameter search shared by the training scripts.
+
+Every configuration is trained with an increasing budget (boosting rounds or epochs) and only the
+best ones are given more. Training scripts provide a function that continues the training of a
+configuration up to a budget from its previous state:
+
+    train_fn(config, budget, state) -> (validation loss, new state)
+
+where state is None the first time a configuration is trained. Continuing from the state means
+that promoting a configuration to the next budget only pays for the additional rounds or epochs.
+"""
+# General imports
+from itertools import product
+import math
+import time
+
+# Data related imports
+import numpy as np
+
+# Local imports
+from src.definitions import SEED
+from src.config import setup_logger
+
+# Setup logger
+logger = setup_logger()
+
+TUNERS = ('grid', 'halving', 'hyperband')
+
+### GENERAL FUNCTIONS ###
+
+def get_configs(param_grid):
+    """
+    Get every configuration of a parameter grid.
+
+    :param param_grid: Dictionary of parameter names to lists of values.
+    :return: List of configuration dictionaries.
+    """
+    return [dict(zip(param_grid, values)) for values in product(*param_grid.values())]
+
+def get_budgets(min_budget, max_budget, eta=3):
+    """
+    Get the increasing budgets of the rungs of successive halving, from max_budget down to min_budget
+    dividing by eta.
+
+    :param min_budget: Smallest budget.
+    :param max_budget: Largest budget.
+    :param eta: Ratio between consecutive budgets.
+    """
+    n_rungs = int(math.floor(math.log(max_budget / min_budget, eta) + 1e-9)) + 1
+    return [max(1, int(round(max_budget * eta ** -(n_rungs - 1 - i)))) for i in range(n_rungs)]
+
+def successive_halving(configs, train_fn, min_budget, max_budget, eta=3, map_fn=map):
+    """
+    Train every configuration with min_budget and keep the best 1 / eta of them at every rung,
+    multiplying their budget by eta, until max_budget is reached.
+
+    :param configs: List of configuration dictionaries.
+    :param train_fn: Function (config, budget, state) -> (validation loss, state).
+    :param min_budget: Budget of the first rung.
+    :param max_budget: Budget of the last rung.
+    :param eta: Fraction of configurations pruned and budget increase at every rung.
+    :param map_fn: Function with the signature of map used to train the configurations of a rung,
+        e.g., the map of a process pool.
+    :return: List of trials (config, budget, cost, loss, state), one per configuration and rung trained,
+        where cost is the budget spent on top of the previous rung.
+    """
+    trials = []
+    survivors = [(config, None) for config in configs]
+    previous_budget = 0
+    for rung, budget in enumerate(get_budgets(min_budget, max_budget, eta)):
+        start = time.perf_counter()
+        results = list(map_fn(
+            train_fn,
+            [config for config, _ in survivors],
+            [budget] * len(survivors),
+            [state for _, state in survivors],
+        ))
+        rung_trials = [
+            {'config': config, 'budget': budget, 'cost': budget - previous_budget, 'loss': loss, 'state': state}
+            for (config, _), (loss, state) in zip(survivors, results)
+        ]
+        trials.extend(rung_trials)
+
+        best = min(rung_trials, key=lambda trial: trial['loss'])
+        logger.info(
+            f"Rung {rung}: {len(rung_trials)} configs with budget {budget} in {time.perf_counter() - start:.1f}s, "
+            f"best loss {best['loss']} for {best['config']}"
+        )
+
+        rung_trials.sort(key=lambda trial: trial['loss'])
+        survivors = [(trial['config'], trial['state']) for trial in rung_trials[:max(1, len(rung_trials) // eta)]]
+        previous_budget = budget
+    return trials
+
+def hyperband(configs, train_fn, min_budget, max_budget, eta=3, map_fn=map, seed=SEED):
+    """
+    Run successive halving brackets that trade the number of configurations for the starting budget,
+    from many configurations with min_budget to a few with max_budget. This hedges against
+    configurations that only stand out with larger budgets.
+
+    :param configs: List of configuration dictionaries the brackets sample from.
+    :param train_fn: Function (config, budget, state) -> (validation loss, state).
+    :param min_budget: Smallest budget.
+    :param max_budget: Largest budget.
+    :param eta: Fraction of configurations pruned and budget increase at every rung.
+    :param map_fn: Function with the signature of map used to train the configurations of a rung.
+    :param seed: Seed of the configuration sampling.
+    :return: List of trials (config, budget, cost, loss, state) of every bracket.
+    """
+    rng = np.random.default_rng(seed)
+    s_max = len(get_budgets(min_budget, max_budget, eta)) - 1
+
+    trials = []
+    for s in range(s_max, -1, -1):
+        n_configs = min(len(configs), int(math.ceil((s_max + 1) / (s + 1) * eta ** s)))
+        sample = [configs[i] for i in rng.choice(len(configs), size=n_configs, replace=False)]
+        bracket_min_budget = max(1, int(round(max_budget * eta ** -s)))
+        logger.info(f"Bracket {s_max - s}: {n_configs} configs from budget {bracket_min_budget}")
+        trials.extend(successive_halving(sample, train_fn, bracket_min_budget, max_budget, eta, map_fn))
+    return trials
+
+def tune(tuner, configs, train_fn, min_budget, max_budget, eta=3, map_fn=map):
+    """
+    Search the best configuration and budget.
+
+    :param tuner: 'halving' or 'hyperband'.
+    :param configs: List of configuration dictionaries.
+    :param train_fn: Function (config, budget, state) -> (validation loss, state).
+    :param min_budget: Smallest budget.
+    :param max_budget: Largest budget.
+    :param eta: Fraction of configurations pruned and budget increase at every rung.
+    :param map_fn: Function with the signature of map used to train the configurations of a rung.
+    :return: Best trial (config, budget, cost, loss, state) and the list of every trial.
+    """
+    start = time.perf_counter()
+    if tuner == 'halving':
+        trials = successive_halving(configs, train_fn, min_budget, max_budget, eta, map_fn)
+    elif tuner == 'hyperband':
+        trials = hyperband(configs, train_fn, min_budget, max_budget, eta, map_fn)
+    else:
+        raise ValueError("Invalid tuner")
+
+    best = min(trials, key=lambda trial: trial['loss'])
+    logger.info(
+        f"Tuning with {tuner} spent {sum(trial['cost'] for trial in trials)} budget units "
+        f"(a full grid spends {len(configs) * max_budget}) over {len(trials)} trials in {time.perf_counter() - start:.1f}s, "
+        f"best loss {best['loss']} for {best['config']} with budget {best['budget']}"
+    )
+    return best, trials